@@ -1,4 +1,4 @@
 while :
 do
-    scrapy crawl telegram -a channels_file=channels.json -a fetch_times=crawler/fetch_times.json -a hours=24
+    scrapy crawl telegram -a channels_file=channels.json -a fetch_times=crawler/fetch_times.json -a crawl_state=crawler/crawl_state.json -a hours=24 -a scheduled=true
 done
@@ -0,0 +1,207 @@
+import re
+from datetime import datetime, timezone
+
+import html2text
+from html2text.utils import escape_md_section
+from lxml import etree
+
+
+WHITESPACE_RE = re.compile(r"\s+")
+ENTITY_CHARS_RE = re.compile(r"([&<>])")
+# Text without these can not be changed by escape_md_section
+MD_ESCAPES_RE = re.compile(r"\\|^\s*[\d+-]", re.MULTILINE)
+
+# Elements with post fields, the classes are checked exactly later
+POST_FIELDS_XPATH = etree.XPath(
+    "descendant-or-self::*[contains(@class, 'tgme_widget_message_') or contains(@class, 'time')]"
+)
+
+# Tags that html2text with the settings below outputs as plain text
+PLAIN_TAGS = {"a", "b", "strong", "i", "em", "u", "span", "tg-emoji", "tg-spoiler", "img"}
+
+
+def process_views(views):
+    if "K" in views:
+        views = int(float(views.replace("K", "")) * 1000)
+    elif "M" in views:
+        views = int(float(views.replace("M", "")) * 1000000)
+    else:
+        views = int(views)
+    return views
+
+
+def parse_post_url(url):
+    url = url.split("?")[0]
+    channel_id, post_id = url.split("/")[-2:]
+    return {
+        "url": url,
+        "channel_id": channel_id.lower(),
+        "post_id": int(post_id)
+    }
+
+
+def to_timestamp(dt_str):
+    dt = datetime.strptime(dt_str, "%Y-%m-%dT%H:%M:%S+00:00")
+    dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+
+def html2text_setup():
+    instance = html2text.HTML2Text(bodywidth=0)
+    instance.ignore_links = True
+    instance.ignore_images = True
+    instance.ignore_tables = True
+    instance.ignore_emphasis = True
+    instance.ul_item_mark = ""
+    return instance
+
+
+def has_class(element, class_name):
+    classes = element.get("class")
+    return classes is not None and class_name in classes.split()
+
+
+def is_div(element, class_name):
+    return element is not None and element.tag == "div" and has_class(element, class_name)
+
+
+class PostExtractor:
+    """Extracts a post item from lxml tree of a Telegram widget message.
+
+    All post fields are collected in one XPath walk over the tree. The text is rendered
+    the same way html2text does it for plain tags and line breaks,
+    messages with other markup (quotes, code, lists) are passed to html2text.
+    """
+
+    def __call__(self, post_element, post_url):
+        text_elements, text_alt_elements = [], []
+        views, pub_time, reply_to, forward_from = None, None, None, None
+        images, videos = [], []
+        for element in POST_FIELDS_XPATH(post_element):
+            classes = element.get("class").split()
+            tag = element.tag
+            if tag == "div" and "tgme_widget_message_text" in classes:
+                parent = element.getparent()
+                if is_div(parent, "tgme_widget_message_bubble"):
+                    text_elements.append(element)
+                elif is_div(parent, "media_supported_cont") and is_div(
+                    parent.getparent(), "tgme_widget_message_bubble"
+                ):
+                    text_alt_elements.append(element)
+            elif tag == "span" and "tgme_widget_message_views" in classes:
+                if views is None:
+                    texts = [element.text] + [child.tail for child in element]
+                    views = next((text for text in texts if text), None)
+            elif tag == "time" and "time" in classes:
+                if pub_time is None:
+                    pub_time = element.get("datetime")
+            elif tag == "a" and "tgme_widget_message_photo_wrap" in classes:
+                style = element.get("style")
+                if style is not None:
+                    images.extend(self._parse_image_style(style))
+            elif tag == "video" and "tgme_widget_message_video" in classes:
+                src = element.get("src")
+                if src is not None:
+                    videos.append(src)
+            elif tag == "a" and "tgme_widget_message_reply" in classes:
+                if reply_to is None:
+                    reply_to = element.get("href")
+            elif tag == "a" and "tgme_widget_message_forwarded_from_name" in classes:
+                if forward_from is None:
+                    forward_from = element.get("href")
+
+        if not text_elements:
+            text_elements = text_alt_elements
+        if not text_elements:
+            # Images only
+            return None
+
+        item = parse_post_url(post_url)
+        item["text"] = self.extract_text(text_elements[0])
+        item["links"] = [
+            link.get("href")
+            for text_element in text_elements
+            for link in text_element.iter("a")
+            if link.get("href") is not None
+        ]
+        item["fetch_time"] = int(datetime.now().replace(tzinfo=timezone.utc).timestamp())
+
+        if views is None:
+            # Service messages
+            return None
+        item["views"] = process_views(views)
+        item["pub_time"] = to_timestamp(pub_time)
+        item["images"] = images
+        item["videos"] = videos
+        if reply_to is not None:
+            item["reply_to"] = reply_to
+        if forward_from is not None:
+            item["forward_from"] = forward_from
+        return item
+
+    def extract_text(self, text_element):
+        text = self._render_plain_text(text_element)
+        if text is None:
+            html = etree.tostring(text_element, method="html", encoding="unicode", with_tail=False)
+            # HTML2Text keeps some state between calls, e.g. after an empty <s>
+            text = html2text_setup().handle(html)
+        return self._fix_sentences(text)
+
+    @staticmethod
+    def _parse_image_style(image_style):
+        for style in image_style.split(";"):
+            style = style.strip()
+            if "background-image" in style:
+                yield style.split("url(")[-1][1:-2]
+
+    @staticmethod
+    def _render_plain_text(text_element):
+        # Mirrors HTML2Text.handle_data and HTML2Text.o for the tags from PLAIN_TAGS,
+        # returns None for any other markup
+        parts = []
+        state = {"space": False, "last_nl": False}
+
+        def write(data):
+            if state["space"] and parts and not state["last_nl"]:
+                parts.append(" ")
+            state["space"] = False
+            parts.append(data)
+            state["last_nl"] = data[-1] == "\n"
+
+        def handle_data(data):
+            # Characters that are escaped in HTML are separate unescaped entities
+            for i, chunk in enumerate(ENTITY_CHARS_RE.split(data)):
+                if not chunk:
+                    continue
+                if i % 2 == 0 and MD_ESCAPES_RE.search(chunk):
+                    chunk = escape_md_section(chunk, snob=False)
+                chunk = WHITESPACE_RE.sub(" ", chunk)
+                if chunk[0] == " ":
+                    state["space"] = True
+                    chunk = chunk[1:]
+                if chunk:
+                    write(chunk)
+
+        events = ("start", "end", "comment", "pi")
+        for event, element in etree.iterwalk(text_element, events=events):
+            is_root = element is text_element
+            if event != "start":
+                # Comments and instructions output nothing but their tails
+                if not is_root and element.tail:
+                    handle_data(element.tail)
+                continue
+            if element.tag == "br":
+                write("  \n")
+            elif not is_root and element.tag not in PLAIN_TAGS:
+                return None
+            if element.text:
+                handle_data(element.text)
+        return "".join(parts)
+
+    @staticmethod
+    def _fix_sentences(text):
+        sentences = [s.strip() for s in text.strip().split("\n") if s.strip()]
+        for i, sentence in enumerate(sentences):
+            if sentence[-1].isalpha():
+                sentences[i] = sentence + "."
+        return "\n".join(sentences)
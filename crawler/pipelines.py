@@ -1,9 +1,15 @@
+import os
+import dbm
 import json
-from collections import defaultdict
+import hashlib
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
 
 from itemadapter import ItemAdapter
 from scrapy.exceptions import DropItem
-from pymongo import MongoClient
+from pymongo import MongoClient, ReplaceOne
+from twisted.internet import reactor, task, threads
 
 
 def check_item(item):
@@ -15,35 +21,222 @@ def check_item(item):
             raise DropItem(f"Missing {field} field in {item}")
 
 
+def calc_digest(record):
+    # Documents that differ only by fetch time are considered the same
+    record = {k: v for k, v in record.items() if k not in ("_id", "fetch_time")}
+    data = json.dumps(record, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def confirm_items(spider, items):
+    # The spider skips unchanged posts only after they are stored
+    confirm = getattr(spider, "confirm_items", None)
+    if confirm is not None:
+        confirm(items)
+
+
 class MongoPipeline:
+    """Buffers items and upserts them in batches, outside of the reactor thread.
+
+    Batches are written when the buffer is full, every flush_interval seconds
+    and on close. Unchanged documents are not written. Failed batches are put
+    back to the buffer and retried, written items are confirmed to the spider.
+    """
+
+    def __init__(self, mongo_config_path, buffer_size=500, flush_interval=5.0, max_digests=500000):
+        self.mongo_config_path = mongo_config_path
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.max_digests = max_digests
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        return cls(
+            mongo_config_path=settings.get("MONGO_CONFIG_PATH", "configs/mongo_config.json"),
+            buffer_size=settings.getint("MONGO_BUFFER_SIZE", 500),
+            flush_interval=settings.getfloat("MONGO_FLUSH_INTERVAL", 5.0)
+        )
+
     def open_spider(self, spider):
-        with open("configs/mongo_config.json") as r:
+        with open(self.mongo_config_path) as r:
             config = json.load(r)
         self.client = MongoClient(**config["client"])
         database_name = config["database_name"]
         documents_collection_name = config["documents_collection_name"]
         self.collection = self.client[database_name][documents_collection_name]
 
+        self.spider = spider
+        self.buffer = []
+        self.retry_time = 0.0
+        # url -> digest of the stored document, see calc_digest
+        self.digests = dict()
+        # One writer, so that batches are written in order
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mongo")
+        self.flusher = task.LoopingCall(self.flush)
+        self.flusher.start(self.flush_interval, now=False)
+
+    def close_spider(self, spider):
+        if self.flusher.running:
+            self.flusher.stop()
+        self.flush()
+        # Failed batches are retried once more, a failure is reported by Scrapy
+        deferred = threads.deferToThread(self.executor.shutdown, wait=True)
+        deferred.addCallback(lambda _: self.write_remaining())
+        deferred.addBoth(self.close_client)
+        return deferred
+
+    def write_remaining(self):
+        if not self.buffer:
+            return None
+        items, self.buffer = self.buffer, []
+        deferred = threads.deferToThread(self.write, items)
+        deferred.addCallback(lambda written_items: confirm_items(self.spider, written_items))
+        return deferred
+
+    def close_client(self, result):
+        self.client.close()
+        return result
+
     def process_item(self, item, spider):
         check_item(item)
-        adapter = ItemAdapter(item)
-        url = adapter.get("url")
-        self.collection.replace_one({"url": url}, adapter.asdict(), upsert=True)
+        self.buffer.append(ItemAdapter(item).asdict())
+        if len(self.buffer) >= self.buffer_size and monotonic() >= self.retry_time:
+            self.flush()
         return item
 
+    def flush(self):
+        if not self.buffer:
+            return
+        items, self.buffer = self.buffer, []
+        future = self.executor.submit(self.write, items)
+        future.add_done_callback(lambda f: reactor.callFromThread(self.on_written, items, f))
+
+    def on_written(self, items, future):
+        error = future.exception()
+        if error is None:
+            confirm_items(self.spider, future.result())
+            return
+        print("Mongo: failed to write {} items, retrying".format(len(items)))
+        traceback.print_exception(type(error), error, error.__traceback__)
+        # Later items with the same url are newer, so they stay after the failed ones
+        self.buffer = items + self.buffer
+        self.retry_time = monotonic() + self.flush_interval
+
+    def write(self, items):
+        url2item = {item["url"]: item for item in items}
+        url2digest = {url: calc_digest(item) for url, item in url2item.items()}
+
+        unknown_urls = [url for url in url2item if url not in self.digests]
+        if unknown_urls:
+            stored_docs = self.collection.find({"url": {"$in": unknown_urls}})
+            for doc in stored_docs:
+                self.digests[doc["url"]] = calc_digest(doc)
+
+        requests = [
+            ReplaceOne({"url": url}, item, upsert=True)
+            for url, item in url2item.items()
+            if self.digests.get(url) != url2digest[url]
+        ]
+        if requests:
+            self.collection.bulk_write(requests, ordered=False)
+
+        if len(self.digests) > self.max_digests:
+            self.digests.clear()
+        self.digests.update(url2digest)
+        print("Mongo: {} items, {} written".format(len(items), len(requests)))
+        return list(url2item.values())
+
 
 class JsonlPipeline:
+    """Appends items to rotating JSONL segment files in output_dir.
+
+    Segments are named so that their lexicographic order is the write order.
+    Dedup is done with an on-disk url -> digest index: an item is written again
+    only if it differs from the last written version by more than fetch time.
+    Index entries of posts published before the crawl window of the spider
+    are dropped on open, on close and when a segment is finished.
+    """
+
+    def __init__(self, output_dir="telegram_news", segment_max_items=10000):
+        self.output_dir = output_dir
+        self.segment_max_items = segment_max_items
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        return cls(
+            output_dir=settings.get("JSONL_OUTPUT_DIR", "telegram_news"),
+            segment_max_items=settings.getint("JSONL_SEGMENT_MAX_ITEMS", 10000)
+        )
+
     def open_spider(self, spider):
-        self.items = defaultdict(dict)
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.index = dbm.open(os.path.join(self.output_dir, "index"), "c")
+        self.spider = spider
+        self.prune_index()
+        segments = [f for f in os.listdir(self.output_dir) if f.endswith(".jsonl")]
+        self.segment_number = len(segments)
+        if segments:
+            self.segment_number = max(int(f.split(".")[0]) for f in segments) + 1
+        self.segment = None
+        self.segment_items_count = 0
 
     def close_spider(self, spider):
-        with open("telegram_news.jsonl", "w") as w:
-            for _, item in self.items.items():
-                w.write(json.dumps(item, ensure_ascii=False) + "\n")
+        self.close_segment()
+        self.prune_index()
+        self.index.close()
 
     def process_item(self, item, spider):
         check_item(item)
-        adapter = ItemAdapter(item)
-        url = adapter.get("url")
-        self.items[url] = adapter.asdict()
+        record = ItemAdapter(item).asdict()
+        url = record["url"].encode("utf-8")
+        digest = calc_digest(record)
+        index_value = self.index.get(url)
+        if index_value is not None and index_value.decode("utf-8").split()[0] == digest:
+            confirm_items(spider, [record])
+            return item
+
+        if self.segment is None:
+            file_name = "{:08d}.jsonl".format(self.segment_number)
+            self.segment = open(os.path.join(self.output_dir, file_name), "a")
+        self.segment.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.segment.flush()
+        self.index[url] = "{} {}".format(digest, record["pub_time"]).encode("utf-8")
+        confirm_items(spider, [record])
+
+        self.segment_items_count += 1
+        if self.segment_items_count >= self.segment_max_items:
+            self.close_segment()
+            self.prune_index()
+            self.segment_number += 1
+            self.segment_items_count = 0
         return item
+
+    def prune_index(self):
+        # Older posts are not crawled again, so their digests are never needed
+        min_pub_time = getattr(self.spider, "until_ts", None)
+        if min_pub_time is None:
+            return
+        old_keys = []
+        for key in self.index.keys():
+            fields = self.index[key].decode("utf-8").split()
+            # Entries without pub_time are left from older versions
+            if len(fields) < 2 or int(fields[1]) < min_pub_time:
+                old_keys.append(key)
+        if not old_keys:
+            return
+        for key in old_keys:
+            del self.index[key]
+        # dbm.gnu files do not shrink without it
+        reorganize = getattr(self.index, "reorganize", None)
+        if reorganize is not None:
+            reorganize()
+        print("JSONL: {} old index entries removed".format(len(old_keys)))
+
+    def close_segment(self):
+        if self.segment is None:
+            return
+        os.fsync(self.segment.fileno())
+        self.segment.close()
+        self.segment = None
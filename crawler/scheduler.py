@@ -0,0 +1,102 @@
+import heapq
+from collections import deque
+
+
+class ChannelScheduler:
+    """Decides when every channel should be fetched next.
+
+    Posting rates are learned from growth of channel post ids,
+    interest is a share of recent channel posts that got to published clusters.
+    Channels that post often or are often published are fetched more frequently.
+    """
+
+    def __init__(
+        self,
+        min_interval=60,
+        max_interval=3600,
+        posts_per_fetch=1.0,
+        interest_weight=4.0,
+        rate_smoothing=0.3,
+        requests_per_minute=60
+    ):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.posts_per_fetch = posts_per_fetch
+        self.interest_weight = interest_weight
+        self.rate_smoothing = rate_smoothing
+        self.requests_per_minute = requests_per_minute
+
+        # (due time, channel), outdated entries are skipped on pop
+        self.queue = []
+        self.due_times = dict()
+        self.min_intervals = dict()
+        # channel -> {"rate": posts per hour, "max_post_id", "fetch_time", "interest"}
+        self.stats = dict()
+        self.request_times = deque()
+
+    def add(self, channel, due_time, min_interval=0, stats=None):
+        self.min_intervals[channel] = min_interval
+        if stats is not None:
+            self.stats[channel] = stats
+        self.schedule(channel, due_time)
+
+    def schedule(self, channel, due_time):
+        self.due_times[channel] = due_time
+        heapq.heappush(self.queue, (due_time, channel))
+
+    def is_scheduled(self, channel):
+        return channel in self.due_times
+
+    def pop_due(self, current_ts):
+        due_channels = []
+        limit = self.get_available_requests(current_ts)
+        while self.queue and len(due_channels) < limit:
+            due_time, channel = self.queue[0]
+            if due_time > current_ts:
+                break
+            heapq.heappop(self.queue)
+            if self.due_times.get(channel) != due_time:
+                continue
+            self.due_times.pop(channel)
+            due_channels.append(channel)
+        return due_channels
+
+    def record_request(self, current_ts):
+        self.request_times.append(current_ts)
+
+    def get_available_requests(self, current_ts):
+        while self.request_times and self.request_times[0] <= current_ts - 60:
+            self.request_times.popleft()
+        return max(0, self.requests_per_minute - len(self.request_times))
+
+    def update(self, channel, max_post_id, fetch_time):
+        stats = self.stats.setdefault(channel, dict())
+        prev_post_id = stats.get("max_post_id")
+        prev_fetch_time = stats.get("fetch_time")
+        if prev_post_id is not None and prev_fetch_time and fetch_time > prev_fetch_time:
+            hours = (fetch_time - prev_fetch_time) / 3600
+            rate = max(0, max_post_id - prev_post_id) / hours
+            prev_rate = stats.get("rate")
+            if prev_rate is not None:
+                alpha = self.rate_smoothing
+                rate = alpha * rate + (1.0 - alpha) * prev_rate
+            stats["rate"] = rate
+        stats["max_post_id"] = max(max_post_id, prev_post_id or 0)
+        stats["fetch_time"] = fetch_time
+        self.schedule(channel, fetch_time + self.get_interval(channel))
+
+    def set_interest(self, channel2interest):
+        for channel, stats in self.stats.items():
+            stats["interest"] = channel2interest.get(channel, 0.0)
+
+    def get_interval(self, channel):
+        stats = self.stats.get(channel, dict())
+        min_interval = max(self.min_interval, self.min_intervals.get(channel, 0))
+        rate = stats.get("rate")
+        if rate is None:
+            return min_interval
+        if rate <= 0.0:
+            return self.max_interval
+        interval = self.posts_per_fetch / rate * 3600
+        interval /= 1.0 + self.interest_weight * stats.get("interest", 0.0)
+        return int(min(self.max_interval, max(min_interval, interval)))
@@ -12,3 +12,24 @@ ITEM_PIPELINES = {
 }
 DNS_RESOLVER = "scrapy.resolver.CachingHostnameResolver"
 LOG_LEVEL = "INFO"
+
+# Views of already crawled posts are refreshed every age * ratio seconds
+VIEWS_REFRESH_RATIO = 0.25
+VIEWS_REFRESH_MIN_INTERVAL = 300
+VIEWS_REFRESH_MAX_INTERVAL = 6 * 3600
+
+MONGO_CONFIG_PATH = "configs/mongo_config.json"
+MONGO_BUFFER_SIZE = 500
+MONGO_FLUSH_INTERVAL = 5.0
+
+JSONL_OUTPUT_DIR = "telegram_news"
+JSONL_SEGMENT_MAX_ITEMS = 10000
+
+# Long-running mode, "scrapy crawl telegram -a scheduled=true ..."
+SCHEDULER_MIN_INTERVAL = 60
+SCHEDULER_MAX_INTERVAL = 3600
+SCHEDULER_POSTS_PER_FETCH = 1.0
+SCHEDULER_INTEREST_WEIGHT = 4.0
+SCHEDULER_REQUESTS_PER_MINUTE = 60
+SCHEDULER_INTEREST_INTERVAL = 600
+SCHEDULER_SAVE_INTERVAL = 300
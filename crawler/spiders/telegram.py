@@ -1,49 +1,32 @@
+import hashlib
 import json
+import os
 import shutil
+from collections import defaultdict
 from datetime import datetime, timezone, timedelta
 
 import scrapy
-import html2text
+from pymongo import MongoClient
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
+from twisted.internet import task, threads
+
+from crawler.extractor import PostExtractor, to_timestamp
+from crawler.scheduler import ChannelScheduler
 
 
 def get_current_ts():
     return int(datetime.now().replace(tzinfo=timezone.utc).timestamp())
 
 
-def process_views(views):
-    if "K" in views:
-        views = int(float(views.replace("K", "")) * 1000)
-    elif "M" in views:
-        views = int(float(views.replace("M", "")) * 1000000)
-    else:
-        views = int(views)
-    return views
-
-
-def parse_post_url(url):
-    url = url.split("?")[0]
-    channel_id, post_id = url.split("/")[-2:]
-    return {
-        "url": url,
-        "channel_id": channel_id.lower(),
-        "post_id": int(post_id)
-    }
+def calc_digest(data):
+    return hashlib.sha256(data).hexdigest()[:16]
 
 
-def to_timestamp(dt_str):
-    dt = datetime.strptime(dt_str, "%Y-%m-%dT%H:%M:%S+00:00")
-    dt = dt.replace(tzinfo=timezone.utc)
-    return int(dt.timestamp())
-
-
-def html2text_setup():
-    instance = html2text.HTML2Text(bodywidth=0)
-    instance.ignore_links = True
-    instance.ignore_images = True
-    instance.ignore_tables = True
-    instance.ignore_emphasis = True
-    instance.ul_item_mark = ""
-    return instance
+def calc_item_digest(item):
+    # Items that differ only by fetch time are not yielded again
+    item = {k: v for k, v in item.items() if k not in ("_id", "fetch_time")}
+    return calc_digest(json.dumps(item, ensure_ascii=False, sort_keys=True).encode("utf-8"))
 
 
 class TelegramSpider(scrapy.Spider):
@@ -61,16 +44,52 @@ class TelegramSpider(scrapy.Spider):
         with open(self.fetch_times_path) as r:
             self.fetch_times = json.load(r)
 
+        # Per channel high-water post ids and recently seen posts,
+        # so that only new pages and posts with stale views are fetched
+        self.crawl_state_path = kwargs.pop("crawl_state", None)
+        self.crawl_state = dict()
+        # url -> (channel state, post id) of yielded items not yet stored by pipelines
+        self.pending_items = dict()
+        if self.crawl_state_path and os.path.exists(self.crawl_state_path):
+            with open(self.crawl_state_path) as r:
+                self.crawl_state = json.load(r)
+
         assert "hours" in kwargs
-        hours = int(kwargs.pop("hours"))
-        self.until_ts = int((datetime.now() - timedelta(hours=hours)).timestamp())
-        print("Considering last {} hours".format(hours))
+        self.hours = int(kwargs.pop("hours"))
+        print("Considering last {} hours".format(self.hours))
 
-        self.html2text = html2text_setup()
+        # Long-running mode, channels are fetched by ChannelScheduler
+        self.is_scheduled = kwargs.pop("scheduled", "false").lower() in ("1", "true")
+        self.scheduler = None
+        self.dispatcher = None
+        self.save_time = 0
+        self.interest_time = 0
+
+        self.extractor = PostExtractor()
 
         super().__init__(*args, **kwargs)
 
+    @property
+    def until_ts(self):
+        return int((datetime.now() - timedelta(hours=self.hours)).timestamp())
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        if spider.is_scheduled:
+            crawler.signals.connect(spider.on_idle, signal=signals.spider_idle)
+            crawler.signals.connect(spider.on_request, signal=signals.request_reached_downloader)
+        return spider
+
+    async def start(self):
+        # Scrapy >= 2.13 calls start() instead of start_requests()
+        for request in self.start_requests():
+            yield request
+
     def start_requests(self):
+        if self.is_scheduled:
+            self.start_scheduler()
+            return
         channels = self.channels
         channels = [ch for ch in channels.values() if not ch.get("disabled", False)]
         urls = {self.channel_url_template.format(ch["name"]) for ch in channels}
@@ -85,21 +104,247 @@ class TelegramSpider(scrapy.Spider):
                     url, current_ts, last_fetch_time, recrawl_time
                 ))
                 continue
-            yield scrapy.Request(url=url, callback=self.parse_channel)
+            channel_state = self.get_channel_state(channel_name)
+            yield self.make_page_request(url, channel_state, meta={"high_water": channel_state["max_post_id"]})
+
+    def start_scheduler(self):
+        settings = self.settings
+        self.scheduler = ChannelScheduler(
+            min_interval=settings.getint("SCHEDULER_MIN_INTERVAL", 60),
+            max_interval=settings.getint("SCHEDULER_MAX_INTERVAL", 3600),
+            posts_per_fetch=settings.getfloat("SCHEDULER_POSTS_PER_FETCH", 1.0),
+            interest_weight=settings.getfloat("SCHEDULER_INTEREST_WEIGHT", 4.0),
+            requests_per_minute=settings.getint("SCHEDULER_REQUESTS_PER_MINUTE", 60)
+        )
+        for channel in self.channels.values():
+            if channel.get("disabled", False):
+                continue
+            channel_name = channel["name"]
+            channel_state = self.get_channel_state(channel_name)
+            stats = channel_state.setdefault("schedule", dict())
+            last_fetch_time = self.fetch_times.get(channel_name, 0)
+            self.scheduler.add(
+                channel_name,
+                due_time=last_fetch_time + self.scheduler.get_interval(channel_name),
+                min_interval=channel.get("recrawl_time", 0),
+                stats=stats
+            )
+        self.dispatcher = task.LoopingCall(self.dispatch)
+        self.dispatcher.start(settings.getfloat("SCHEDULER_TICK", 1.0))
+
+    def dispatch(self):
+        current_ts = get_current_ts()
+        for channel_name in self.scheduler.pop_due(current_ts):
+            # Reserves the request in the budget until it reaches the downloader
+            self.scheduler.record_request(current_ts)
+            request = self.make_channel_request(channel_name)
+            self.crawler.engine.crawl(request)
+
+        save_interval = self.settings.getint("SCHEDULER_SAVE_INTERVAL", 300)
+        if current_ts - self.save_time >= save_interval:
+            self.save_time = current_ts
+            self.save_state()
+
+        interest_interval = self.settings.getint("SCHEDULER_INTEREST_INTERVAL", 600)
+        if current_ts - self.interest_time >= interest_interval:
+            self.interest_time = current_ts
+            # Only Mongo is queried in the thread, crawl state is read in the reactor
+            deferred = threads.deferToThread(self.fetch_published_counts, self.until_ts)
+            deferred.addCallback(self.calc_interest)
+            deferred.addCallback(self.scheduler.set_interest)
+            deferred.addErrback(lambda failure: print("Interest error:", failure.getErrorMessage()))
+
+    def make_channel_request(self, channel_name):
+        channel_state = self.get_channel_state(channel_name)
+        return self.make_page_request(
+            self.channel_url_template.format(channel_name),
+            channel_state,
+            meta={"high_water": channel_state["max_post_id"], "channel_name": channel_name},
+            callback=self.parse_scheduled_channel,
+            errback=self.on_channel_error
+        )
+
+    def make_page_request(self, url, channel_state, meta, callback=None, errback=None):
+        # Validators of the previous response, unchanged pages can be answered with 304
+        headers = dict()
+        page_state = channel_state["pages"].get(url, dict())
+        if page_state.get("etag"):
+            headers["If-None-Match"] = page_state["etag"]
+        if page_state.get("last_modified"):
+            headers["If-Modified-Since"] = page_state["last_modified"]
+        return scrapy.Request(
+            url=url,
+            callback=callback or self.parse_channel,
+            errback=errback,
+            headers=headers,
+            meta={**meta, "handle_httpstatus_list": [304]},
+            dont_filter=True
+        )
+
+    def fetch_published_counts(self, until_ts):
+        mongo_config_path = self.settings.get("MONGO_CONFIG_PATH")
+        if not mongo_config_path or not os.path.exists(mongo_config_path):
+            return dict()
+        with open(mongo_config_path) as r:
+            config = json.load(r)
+        client = MongoClient(**config["client"])
+        collection_name = config.get("clusters_collection_name", "clusters")
+        collection = client[config["database_name"]][collection_name]
+        published_counts = defaultdict(int)
+        records = collection.find(
+            {"create_time": {"$gte": until_ts}},
+            {"docs.channel_id": 1}
+        )
+        for record in records:
+            for doc in record.get("docs", []):
+                published_counts[doc["channel_id"]] += 1
+        client.close()
+        return published_counts
+
+    def calc_interest(self, published_counts):
+        # Share of recently crawled channel posts that got to published clusters,
+        # channel ids of documents are lowercased, see parse_post_url
+        interest = dict()
+        for channel_name in self.channels:
+            count = published_counts.get(channel_name.lower(), 0)
+            channel_state = self.crawl_state.get(channel_name)
+            if not count or not channel_state:
+                continue
+            posts_count = len(channel_state["posts"])
+            interest[channel_name] = min(1.0, count / max(posts_count, 1))
+        return interest
+
+    def on_idle(self, spider):
+        raise DontCloseSpider()
+
+    def on_request(self, request, spider):
+        if "before=" in request.url:
+            self.scheduler.record_request(get_current_ts())
+
+    def on_channel_error(self, failure):
+        channel_name = failure.request.meta["channel_name"]
+        print("Fetch error at {}: {}".format(channel_name, failure.getErrorMessage()))
+        # Older pages are requested after the channel is already rescheduled
+        if "before=" not in failure.request.url:
+            self.ensure_scheduled(channel_name)
+
+    def ensure_scheduled(self, channel_name):
+        if not self.scheduler.is_scheduled(channel_name):
+            self.scheduler.schedule(channel_name, get_current_ts() + self.scheduler.min_interval)
 
     def closed(self, reason):
+        if self.dispatcher is not None and self.dispatcher.running:
+            self.dispatcher.stop()
+        self.save_state()
+
+    def save_state(self):
         temp_path = self.fetch_times_path + ".new"
         with open(temp_path, "w") as w:
             json.dump(self.fetch_times, w)
         shutil.move(temp_path, self.fetch_times_path)
 
+        if not self.crawl_state_path:
+            return
+        for channel_state in self.crawl_state.values():
+            posts = channel_state["posts"]
+            for post_id, post_state in list(posts.items()):
+                if post_state[0] < self.until_ts:
+                    posts.pop(post_id)
+            pages = channel_state.get("pages", dict())
+            for url, page_state in list(pages.items()):
+                if "before=" in url and (page_state["min_post_ts"] or 0) < self.until_ts:
+                    pages.pop(url)
+        # Dropped items are never confirmed
+        self.pending_items = {
+            url: (channel_state, post_id)
+            for url, (channel_state, post_id) in self.pending_items.items()
+            if post_id in channel_state["posts"]
+        }
+        temp_path = self.crawl_state_path + ".new"
+        with open(temp_path, "w") as w:
+            json.dump(self.crawl_state, w)
+        shutil.move(temp_path, self.crawl_state_path)
+
+    def get_channel_state(self, channel_name):
+        # posts: post id -> [pub time, fetch time, digest of the last stored item]
+        # pages: url -> body digest, HTTP validators and posts of the last response
+        channel_state = self.crawl_state.setdefault(channel_name, {"max_post_id": 0, "posts": dict()})
+        channel_state.setdefault("pages", dict())
+        return channel_state
+
+    def is_refresh_due(self, pub_time, fetch_time, current_ts):
+        # Views of young posts change fast, old posts are refreshed rarely
+        ratio = self.settings.getfloat("VIEWS_REFRESH_RATIO", 0.25)
+        min_interval = self.settings.getint("VIEWS_REFRESH_MIN_INTERVAL", 300)
+        max_interval = self.settings.getint("VIEWS_REFRESH_MAX_INTERVAL", 6 * 3600)
+        interval = (current_ts - pub_time) * ratio
+        interval = min(max_interval, max(min_interval, interval))
+        return current_ts - fetch_time >= interval
+
+    def parse_scheduled_channel(self, response):
+        # A channel is fetched again even if its page could not be parsed
+        channel_name = response.meta["channel_name"]
+        try:
+            yield from self.parse_channel(response)
+        finally:
+            self.ensure_scheduled(channel_name)
+
     def parse_channel(self, response):
         url = response.url
         channel_name = url.split("/")[-1].split("?")[0]
+        channel_state = self.get_channel_state(channel_name)
+        high_water = response.meta.get("high_water", channel_state["max_post_id"])
+        current_ts = get_current_ts()
+
+        page_state = channel_state["pages"].get(url)
+        body_digest = calc_digest(response.body)
+        if page_state and (response.status == 304 or page_state["digest"] == body_digest):
+            # Nothing changed since the previous fetch, so the page posts are fresh
+            for post_id in page_state["post_ids"]:
+                post_state = channel_state["posts"].get(str(post_id))
+                if post_state:
+                    post_state[1] = current_ts
+        else:
+            page_state = {
+                "digest": body_digest,
+                "etag": response.headers.get("ETag", b"").decode("latin-1"),
+                "last_modified": response.headers.get("Last-Modified", b"").decode("latin-1"),
+                "post_ids": [],
+                "min_post_id": None,
+                "min_post_ts": None
+            }
+            channel_state["pages"][url] = page_state
+            yield from self.parse_posts(response, channel_state, page_state, current_ts)
+        min_post_id, min_post_ts = page_state["min_post_id"], page_state["min_post_ts"]
+
+        self.fetch_times[channel_name] = current_ts
+        if self.scheduler is not None and "before=" not in url:
+            self.scheduler.update(channel_name, channel_state["max_post_id"], current_ts)
+        if not min_post_ts or min_post_ts < self.until_ts:
+            return
+
+        # Older pages are needed only for unseen posts or for posts with stale views
+        has_new_posts = min_post_id > high_water
+        has_stale_posts = any(
+            int(post_id) < min_post_id
+            and post_state[0] >= self.until_ts
+            and self.is_refresh_due(post_state[0], post_state[1], current_ts)
+            for post_id, post_state in channel_state["posts"].items()
+        )
+        if not has_new_posts and not has_stale_posts:
+            return
+        url = url.split("?")[0]
+        url += "?before={}".format(min_post_id)
+        yield self.make_page_request(
+            url,
+            channel_state,
+            meta={**response.meta, "high_water": high_water},
+            errback=response.request.errback
+        )
+
+    def parse_posts(self, response, channel_state, page_state, current_ts):
         history_path = "//body/main/div/section[contains(@class, 'tgme_channel_history')]/div"
         posts = response.xpath(history_path + "/div")
-
-        min_post_id, min_post_ts = None, None
         for post in posts:
             post_path = post.xpath("@data-post")
             post_time = post.css("time.time::attr(datetime)")
@@ -110,89 +355,43 @@ class TelegramSpider(scrapy.Spider):
             post_id = int(post_path.split("/")[-1])
             post_ts = to_timestamp(post_time)
 
-            min_post_id = min(post_id, min_post_id) if min_post_id is not None else post_id
-            min_post_ts = min(post_ts, min_post_ts) if min_post_ts is not None else post_ts
+            min_post_id = page_state["min_post_id"]
+            min_post_ts = page_state["min_post_ts"]
+            page_state["min_post_id"] = min(post_id, min_post_id) if min_post_id is not None else post_id
+            page_state["min_post_ts"] = min(post_ts, min_post_ts) if min_post_ts is not None else post_ts
+            page_state["post_ids"].append(post_id)
+
+            channel_state["max_post_id"] = max(channel_state["max_post_id"], post_id)
+            post_state = channel_state["posts"].get(str(post_id))
+            item_digest = post_state[2] if post_state and len(post_state) > 2 else None
+            post_state = [post_ts, current_ts, item_digest]
+            channel_state["posts"][str(post_id)] = post_state
 
             post_url = self.post_url_template.format(post_path)
             try:
                 item = self._parse_post(post, post_url)
-                if item is None:
-                    continue
-                yield item
             except Exception as e:
                 print(f"Unexpected error at {post_url}:", str(e))
                 continue
+            if item is None:
+                continue
 
-        current_ts = get_current_ts()
-        self.fetch_times[channel_name] = current_ts
-        if not min_post_ts or min_post_ts < self.until_ts:
-            return
-        url = url.split("?")[0]
-        url += "?before={}".format(min_post_id)
-        yield scrapy.Request(url=url, callback=self.parse_channel)
+            # Text, views and media are the same as in the previously yielded item
+            if calc_item_digest(item) == post_state[2]:
+                continue
+            self.pending_items[item["url"]] = (channel_state, str(post_id))
+            yield item
+
+    def confirm_items(self, items):
+        # Called by pipelines, digests are recorded only for stored items
+        for item in items:
+            pending_item = self.pending_items.pop(item["url"], None)
+            if pending_item is None:
+                continue
+            channel_state, post_id = pending_item
+            post_state = channel_state["posts"].get(post_id)
+            if post_state:
+                post_state[2] = calc_item_digest(item)
 
     def _parse_post(self, post_element, post_url):
-        text_path = "div.tgme_widget_message_bubble > div.tgme_widget_message_text"
-        text_alt_path = "div.tgme_widget_message_bubble > div.media_supported_cont > div.tgme_widget_message_text"
-        views_path = "span.tgme_widget_message_views::text"
-        time_path = "time.time::attr(datetime)"
-        images_path = "a.tgme_widget_message_photo_wrap::attr(style)"
-        videos_path = "video.tgme_widget_message_video::attr(src)"
-        reply_path = "a.tgme_widget_message_reply::attr(href)"
-        forward_path = "a.tgme_widget_message_forwarded_from_name::attr(href)"
-
-        item = parse_post_url(post_url)
-        text_element = post_element.css(text_path)
-        text_alt_element = post_element.css(text_alt_path)
-        if not text_element and text_alt_element:
-            text_element = text_alt_element
-
-        if not text_element:
-            # Images only
-            return None
-
-        item["text"] = self._parse_html(text_element.extract_first())
-        item["links"] = text_element.css("a::attr(href)").getall()
-        item["fetch_time"] = int(datetime.now().replace(tzinfo=timezone.utc).timestamp())
-
-        views_element = post_element.css(views_path)
-        if not views_element:
-            # Service messages
-            return None
-
-        item["views"] = process_views(views_element.get())
-
-        time_element = post_element.css(time_path)
-        item["pub_time"] = to_timestamp(time_element.get())
-
-        item["images"] = []
-        image_elements = post_element.css(images_path)
-        for image_style in image_elements:
-            image_style = image_style.get()
-            for style in image_style.split(";"):
-                style = style.strip()
-                if "background-image" in style:
-                    image_url = style.split("url(")[-1][1:-2]
-                    item["images"].append(image_url)
-
-        item["videos"] = []
-        video_elements = post_element.css(videos_path)
-        for video in video_elements:
-            item["videos"].append(video.get())
-
-        reply_element = post_element.css(reply_path)
-        if reply_element:
-            item["reply_to"] = reply_element.get()
-        forward_element = post_element.css(forward_path)
-        if forward_element:
-            item["forward_from"] = forward_element.get()
-
-        return item
-
-    def _parse_html(self, html):
-        text = self.html2text.handle(html)
-        sentences = [s.strip() for s in text.strip().split("\n") if s.strip()]
-        for i, sentence in enumerate(sentences):
-            if sentence[-1].isalpha():
-                sentences[i] = sentence + "."
-        return "\n".join(sentences)
+        return self.extractor(post_element.root, post_url)
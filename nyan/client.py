@@ -1,11 +1,17 @@
 import os
 import json
-from typing import Tuple, Optional, Any, Dict, List, Sequence
+import threading
+from time import sleep, monotonic
+from queue import Queue
+from collections import defaultdict
+from typing import Tuple, Optional, Any, Dict, List, Sequence, Callable
 from dataclasses import dataclass
 
 from httpx import Timeout, Limits, HTTPTransport, Client, Response
 
-from nyan.util import Serializable
+from nyan.discussions import DiscussionsStore, DiscussionRecord
+from nyan.media import MediaCache, MediaRecord
+from nyan.util import Serializable, get_current_ts
 
 
 ISSUE_WARNING = "Warning: Missing issue '{issue_name}' in the client config."
@@ -25,6 +31,8 @@ class MessageId(Serializable):
     message_id: int
     issue: str = "main"
     from_discussion: bool = False
+    # Hash of the last sent text, see nyan.util.get_text_hash
+    text_hash: Optional[str] = None
 
     def as_tuple(self) -> Tuple[str, int]:
         return (self.issue, self.message_id)
@@ -38,6 +46,41 @@ class MessageId(Serializable):
         return self.as_tuple() == another.as_tuple()
 
 
+def fix_cdn_url(url: str) -> str:
+    # TODO: TEMPORARY FIX - Replace telesco.pe with old CDN domain
+    # See issue #31 for proper long-term solutions
+    if "telesco.pe" in url:
+        return url.replace("telesco.pe", "cdn-telegram.org")
+    return url
+
+
+def get_retry_after(response: Response, default: float) -> float:
+    if response.status_code != 429:
+        return default
+    try:
+        parameters = response.json().get("parameters", {})
+        return float(parameters.get("retry_after", default))
+    except ValueError:
+        return default
+
+
+def get_file_ids(result: Any) -> List[Optional[str]]:
+    # sendMediaGroup returns a list of messages, other methods return one message
+    messages = result if isinstance(result, list) else [result]
+    file_ids: List[Optional[str]] = []
+    for message in messages:
+        file_id = None
+        if message.get("photo"):
+            # Photo sizes, the largest is the last one
+            file_id = message["photo"][-1]["file_id"]
+        elif message.get("video"):
+            file_id = message["video"]["file_id"]
+        elif message.get("animation"):
+            file_id = message["animation"]["file_id"]
+        file_ids.append(file_id)
+    return file_ids
+
+
 class TelegramClient:
     def __init__(self, config_path: str) -> None:
         assert os.path.exists(config_path)
@@ -51,21 +94,95 @@ class TelegramClient:
             write=self.config.get("write_timeout", 30.0),
             pool=self.config.get("pool_timeout", 1.0),
         )
+        self.issues: Dict[str, IssueConfig] = {
+            config["name"]: IssueConfig(**config) for config in self.config["issues"]
+        }
+
+        # One connection per issue, issues can be published concurrently
+        pool_size = self.config.get("connection_pool_size", len(self.issues))
         limits = Limits(
-            max_connections=self.config.get("connection_pool_size", 1),
-            max_keepalive_connections=self.config.get("connection_pool_size", 1),
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
         )
         transport = HTTPTransport(retries=self.config.get("retries", 5))
         self.client = Client(timeout=timeout, limits=limits, transport=transport)
 
-        self.issues: Dict[str, IssueConfig] = {
-            config["name"]: IssueConfig(**config) for config in self.config["issues"]
-        }
         self.discussions: Dict[str, Dict[int, Any]] = {
             issue.name: dict() for _, issue in self.issues.items()
         }
-        for issue_name in self.issues:
-            self.update_discussion_mapping(issue_name)
+
+        # Long polling has its own connection pool,
+        # so it never blocks sending through the main one
+        self.poll_timeout: int = self.config.get("poll_timeout", 10)
+        self.poll_error_sleep: float = self.config.get("poll_error_sleep", 5.0)
+        self.polling_client = Client(
+            timeout=timeout,
+            limits=Limits(max_connections=len(self.issues)),
+            transport=HTTPTransport(retries=self.config.get("retries", 5)),
+        )
+        self.discussions_condition = threading.Condition()
+        self.discussions_store: Optional[DiscussionsStore] = None
+        self.pollers: List[threading.Thread] = []
+        self.is_polling = False
+
+        # Discussion messages are sent in background, one queue per issue
+        self.discussion_interval: float = self.config.get("discussion_interval", 0.3)
+        self.discussion_retries: int = self.config.get("discussion_retries", 3)
+        # Senders have their own connection pool, publishing uses all of the main one
+        self.discussion_client = Client(
+            timeout=timeout,
+            limits=Limits(max_connections=len(self.issues)),
+            transport=HTTPTransport(retries=self.config.get("retries", 5)),
+        )
+        self.discussion_queues: Dict[str, "Queue[Tuple[str, MessageId]]"] = dict()
+        self.discussion_queues_lock = threading.Lock()
+
+        self.media_cache: Optional[MediaCache] = None
+
+    def start_polling(self) -> None:
+        if self.pollers:
+            return
+        self.is_polling = True
+
+        # Updates are consumed per bot, several issues can share the same bot
+        token2issues: Dict[str, List[IssueConfig]] = defaultdict(list)
+        for issue in self.issues.values():
+            token2issues[issue.bot_token].append(issue)
+
+        for issues in token2issues.values():
+            poller = threading.Thread(
+                target=self._poll_updates,
+                args=(issues,),
+                name="poller-{}".format(issues[0].name),
+                daemon=True,
+            )
+            poller.start()
+            self.pollers.append(poller)
+
+    def stop_polling(self) -> None:
+        self.is_polling = False
+        for poller in self.pollers:
+            poller.join()
+        self.pollers = []
+        if self.discussions_store is not None:
+            self.discussions_store.flush()
+
+    def set_media_cache(self, cache: MediaCache, min_time: int = 0) -> int:
+        records = cache.load(min_time)
+        self.media_cache = cache
+        return len(records)
+
+    def set_discussions_store(self, store: DiscussionsStore, min_time: int = 0) -> int:
+        records = store.load(min_time)
+        with self.discussions_condition:
+            for record in records:
+                if record.issue not in self.discussions:
+                    continue
+                mapping = self.discussions[record.issue]
+                mapping[record.message_id] = record.discussion_message_id
+            self.discussions_store = store
+            self.discussions_condition.notify_all()
+        return len(records)
 
     def send_message(
         self,
@@ -145,7 +262,7 @@ class TelegramClient:
             params["allow_sending_without_reply"] = True
         return self._post(url_template.format(issue.bot_token), params)
 
-    def update_message(self, message: MessageId, text: str, is_caption: bool) -> None:
+    def update_message(self, message: MessageId, text: str, is_caption: bool) -> bool:
         assert not message.from_discussion
         issue = self.issues[message.issue]
         message_id = message.message_id
@@ -154,8 +271,10 @@ class TelegramClient:
         else:
             response = self._edit_caption(message_id, text, issue=issue)
         print("Update status code:", response.status_code)
-        if response.status_code != 200:
-            print("Update error:", response.text)
+        if response.status_code == 200:
+            return True
+        print("Update error:", response.text)
+        return "message is not modified" in response.text
 
     def update_discussion_mapping(self, issue_name: str) -> None:
         if issue_name not in self.issues:
@@ -163,26 +282,19 @@ class TelegramClient:
             return None
         issue = self.issues[issue_name]
         updates = self._get_updates(issue)
-        if not updates:
-            return
-        for update in updates:
-            if "message" not in update:
-                continue
-            message = update["message"]
-            if "forward_from_chat" not in message:
-                continue
-            if issue.channel_id != message["forward_from_chat"]["id"]:
-                continue
-            if issue.discussion_id != message["chat"]["id"]:
-                continue
-            orig_message_id = message["forward_from_message_id"]
-            discussion_message_id = message["message_id"]
-            self.discussions[issue.name][orig_message_id] = discussion_message_id
+        self._process_updates(updates, [issue])
 
-    def get_discussion(self, message: MessageId) -> MessageId:
-        discussion_message_id = self.discussions[message.issue].get(
-            message.message_id, None
-        )
+    def get_discussion(self, message: MessageId, timeout: float = 0.0) -> MessageId:
+        if not self.is_polling and timeout > 0.0:
+            self.update_discussion_mapping(message.issue)
+
+        mapping = self.discussions[message.issue]
+        with self.discussions_condition:
+            self.discussions_condition.wait_for(
+                lambda: message.message_id in mapping,
+                timeout=timeout if self.is_polling else 0.0,
+            )
+            discussion_message_id = mapping.get(message.message_id, None)
         return MessageId(
             message_id=discussion_message_id, issue=message.issue, from_discussion=True
         )
@@ -205,7 +317,54 @@ class TelegramClient:
             "disable_web_page_preview": disable_web_page_preview,
             "reply_to_message_id": discussion_message.message_id,
         }
-        return self._post(url_template.format(issue.bot_token), params)
+        return self._post(
+            url_template.format(issue.bot_token), params, client=self.discussion_client
+        )
+
+    def queue_discussion_messages(
+        self, texts: Sequence[str], discussion_message: MessageId
+    ) -> None:
+        issue_name = discussion_message.issue
+        with self.discussion_queues_lock:
+            queue = self.discussion_queues.get(issue_name)
+            if queue is None:
+                queue = Queue()
+                sender = threading.Thread(
+                    target=self._send_discussion_messages,
+                    args=(queue,),
+                    name="discussions-{}".format(issue_name),
+                    daemon=True,
+                )
+                sender.start()
+                self.discussion_queues[issue_name] = queue
+        for text in texts:
+            queue.put((text, discussion_message))
+
+    def wait_discussion_messages(self) -> None:
+        with self.discussion_queues_lock:
+            queues = list(self.discussion_queues.values())
+        for queue in queues:
+            queue.join()
+
+    def _send_discussion_messages(self, queue: "Queue[Tuple[str, MessageId]]") -> None:
+        next_time = 0.0
+        while True:
+            text, discussion_message = queue.get()
+            try:
+                for _ in range(self.discussion_retries + 1):
+                    sleep(max(0.0, next_time - monotonic()))
+                    response = self.send_discussion_message(text, discussion_message)
+                    next_time = monotonic() + self.discussion_interval
+                    if response is None or response.status_code == 200:
+                        break
+                    print("Discussion message error:", response.text)
+                    if response.status_code != 429:
+                        break
+                    next_time = monotonic() + get_retry_after(response, 1.0)
+            except Exception as e:
+                print("Discussion message error: {}".format(e))
+            finally:
+                queue.task_done()
 
     def _send_text(
         self,
@@ -235,24 +394,20 @@ class TelegramClient:
         reply_to: Optional[int] = None,
         parse_mode: str = "html",
     ) -> Response:
-        url_template = self.host + "/bot{}/sendPhoto"
-
-        # TODO: TEMPORARY FIX - Replace telesco.pe with old CDN domain
-        # See issue #31 for proper long-term solutions
-        if "telesco.pe" in photo:
-            photo = photo.replace("telesco.pe", "cdn-telegram.org")
+        def build_params(media: List[str]) -> Dict[str, Any]:
+            params = {
+                "chat_id": issue.channel_id,
+                "caption": text,
+                "photo": media[0],
+                "parse_mode": parse_mode,
+                "disable_notification": True,
+            }
+            if reply_to:
+                params["reply_to_message_id"] = reply_to
+                params["allow_sending_without_reply"] = True
+            return params
 
-        params = {
-            "chat_id": issue.channel_id,
-            "caption": text,
-            "photo": photo,
-            "parse_mode": parse_mode,
-            "disable_notification": True,
-        }
-        if reply_to:
-            params["reply_to_message_id"] = reply_to
-            params["allow_sending_without_reply"] = True
-        return self._post(url_template.format(issue.bot_token), params)
+        return self._post_media("sendPhoto", issue, [photo], build_params)
 
     def _send_animation(
         self,
@@ -262,18 +417,20 @@ class TelegramClient:
         reply_to: Optional[int] = None,
         parse_mode: str = "html",
     ) -> Response:
-        url_template = self.host + "/bot{}/sendAnimation"
-        params = {
-            "chat_id": issue.channel_id,
-            "caption": text,
-            "animation": animation,
-            "parse_mode": parse_mode,
-            "disable_notification": True,
-        }
-        if reply_to:
-            params["reply_to_message_id"] = reply_to
-            params["allow_sending_without_reply"] = True
-        return self._post(url_template.format(issue.bot_token), params)
+        def build_params(media: List[str]) -> Dict[str, Any]:
+            params = {
+                "chat_id": issue.channel_id,
+                "caption": text,
+                "animation": media[0],
+                "parse_mode": parse_mode,
+                "disable_notification": True,
+            }
+            if reply_to:
+                params["reply_to_message_id"] = reply_to
+                params["allow_sending_without_reply"] = True
+            return params
+
+        return self._post_media("sendAnimation", issue, [animation], build_params)
 
     def _send_video(
         self,
@@ -283,24 +440,20 @@ class TelegramClient:
         reply_to: Optional[int] = None,
         parse_mode: str = "html",
     ) -> Response:
-        url_template = self.host + "/bot{}/sendVideo"
+        def build_params(media: List[str]) -> Dict[str, Any]:
+            params = {
+                "chat_id": issue.channel_id,
+                "caption": text,
+                "video": media[0],
+                "parse_mode": parse_mode,
+                "disable_notification": True,
+            }
+            if reply_to:
+                params["reply_to_message_id"] = reply_to
+                params["allow_sending_without_reply"] = True
+            return params
 
-        # TODO: TEMPORARY FIX - Replace telesco.pe with old CDN domain
-        # See issue #31 for proper long-term solutions
-        if "telesco.pe" in video:
-            video = video.replace("telesco.pe", "cdn-telegram.org")
-
-        params = {
-            "chat_id": issue.channel_id,
-            "caption": text,
-            "video": video,
-            "parse_mode": parse_mode,
-            "disable_notification": True,
-        }
-        if reply_to:
-            params["reply_to_message_id"] = reply_to
-            params["allow_sending_without_reply"] = True
-        return self._post(url_template.format(issue.bot_token), params)
+        return self._post_media("sendVideo", issue, [video], build_params)
 
     def _send_photos(
         self,
@@ -310,35 +463,65 @@ class TelegramClient:
         reply_to: Optional[int] = None,
         parse_mode: str = "html",
     ) -> Response:
-        url_template = self.host + "/bot{}/sendMediaGroup"
-
-        # TODO: TEMPORARY FIX - Replace telesco.pe with old CDN domain
-        # See issue #31 for proper long-term solutions
-        fixed_photos = []
-        for photo in photos:
-            if "telesco.pe" in photo:
-                fixed_photos.append(photo.replace("telesco.pe", "cdn-telegram.org"))
-            else:
-                fixed_photos.append(photo)
-
-        media = [
-            {
-                "type": "photo",
-                "media": photo,
-                "caption": text if i == 0 else "",
-                "parse_mode": parse_mode,
+        def build_params(media: List[str]) -> Dict[str, Any]:
+            media_group = [
+                {
+                    "type": "photo",
+                    "media": photo,
+                    "caption": text if i == 0 else "",
+                    "parse_mode": parse_mode,
+                }
+                for i, photo in enumerate(media)
+            ]
+            params = {
+                "chat_id": issue.channel_id,
+                "disable_notification": True,
+                "media": json.dumps(media_group),
             }
-            for i, photo in enumerate(fixed_photos)
-        ]
-        params = {
-            "chat_id": issue.channel_id,
-            "disable_notification": True,
-            "media": json.dumps(media),
-        }
-        if reply_to:
-            params["reply_to_message_id"] = reply_to
-            params["allow_sending_without_reply"] = True
-        return self._post(url_template.format(issue.bot_token), params)
+            if reply_to:
+                params["reply_to_message_id"] = reply_to
+                params["allow_sending_without_reply"] = True
+            return params
+
+        return self._post_media("sendMediaGroup", issue, photos, build_params)
+
+    def _post_media(
+        self,
+        method: str,
+        issue: IssueConfig,
+        urls: Sequence[str],
+        build_params: Callable[[List[str]], Dict[str, Any]],
+    ) -> Response:
+        # Media uploaded before are sent by file ids, so that Telegram
+        # does not download them from the CDN again
+        url = self.host + "/bot{}/{}".format(issue.bot_token, method)
+        fixed_urls = [fix_cdn_url(u) for u in urls]
+        cache = self.media_cache
+        if cache is None:
+            return self._post(url, build_params(fixed_urls))
+
+        bot_id = issue.bot_token.split(":")[0]
+        file_ids = [cache.get(bot_id, u) for u in urls]
+        media = [file_id or u for file_id, u in zip(file_ids, fixed_urls)]
+        response = self._post(url, build_params(media))
+        is_cached = any(file_ids)
+        if is_cached and "file identifier" in response.text:
+            print("Bad file ids, sending by URLs:", response.text)
+            for u in urls:
+                cache.remove(bot_id, u)
+            response = self._post(url, build_params(fixed_urls))
+
+        if response.status_code == 200:
+            new_file_ids = get_file_ids(response.json()["result"])
+            create_time = get_current_ts()
+            for u, file_id in zip(urls, new_file_ids):
+                if not file_id:
+                    continue
+                record = MediaRecord(
+                    bot_id=bot_id, url=u, file_id=file_id, create_time=create_time
+                )
+                cache.add(record)
+        return response
 
     def _edit_text(
         self, message_id: int, text: str, issue: IssueConfig, parse_mode: str = "html"
@@ -365,20 +548,89 @@ class TelegramClient:
         }
         return self._post(url_template.format(issue.bot_token), params)
 
-    def _get_updates(self, issue: IssueConfig) -> List[Dict[str, Any]]:
+    def _poll_updates(self, issues: List[IssueConfig]) -> None:
+        main_issue = issues[0]
+        while self.is_polling:
+            try:
+                updates = self._get_updates(
+                    main_issue,
+                    client=self.polling_client,
+                    error_sleep=self.poll_error_sleep,
+                )
+            except Exception as e:
+                print("Polling error at {}: {}".format(main_issue.name, e))
+                sleep(self.poll_error_sleep)
+                continue
+            for issue in issues:
+                issue.last_update_id = main_issue.last_update_id
+            self._process_updates(updates, issues)
+
+    def _process_updates(
+        self, updates: List[Dict[str, Any]], issues: List[IssueConfig]
+    ) -> None:
+        if not updates:
+            return
+        with self.discussions_condition:
+            for update in updates:
+                if "message" not in update:
+                    continue
+                message = update["message"]
+                if "forward_from_chat" not in message:
+                    continue
+                orig_message_id = message["forward_from_message_id"]
+                discussion_message_id = message["message_id"]
+                for issue in issues:
+                    if issue.channel_id != message["forward_from_chat"]["id"]:
+                        continue
+                    if issue.discussion_id != message["chat"]["id"]:
+                        continue
+                    mapping = self.discussions[issue.name]
+                    if mapping.get(orig_message_id) == discussion_message_id:
+                        continue
+                    mapping[orig_message_id] = discussion_message_id
+                    if self.discussions_store is not None:
+                        self.discussions_store.add(
+                            DiscussionRecord(
+                                issue=issue.name,
+                                message_id=orig_message_id,
+                                discussion_message_id=discussion_message_id,
+                                create_time=message.get("date", get_current_ts()),
+                            )
+                        )
+            self.discussions_condition.notify_all()
+
+        if self.discussions_store is not None:
+            self.discussions_store.flush()
+
+    def _get_updates(
+        self,
+        issue: IssueConfig,
+        client: Optional[Client] = None,
+        error_sleep: float = 0.0,
+    ) -> List[Dict[str, Any]]:
         url_template = self.host + "/bot{}/getUpdates"
-        params = {"timeout": 10}
+        params = {"timeout": self.poll_timeout}
         if issue.last_update_id != 0:
             params["offset"] = issue.last_update_id
-        response = self.client.get(
-            url_template.format(issue.bot_token), params=params, timeout=20
+        client = client if client is not None else self.client
+        response = client.get(
+            url_template.format(issue.bot_token),
+            params=params,
+            timeout=self.poll_timeout + 10,
         )
         if response.status_code != 200:
+            print("Updates error at {}: {}".format(issue.name, response.text))
+            # Pollers back off, so that errors do not turn into a busy loop
+            if error_sleep > 0.0:
+                sleep(get_retry_after(response, error_sleep))
             return []
         updates: List[Dict[str, Any]] = response.json()["result"]
         for update in updates:
             issue.last_update_id = max(issue.last_update_id, update["update_id"]) + 1
         return updates
 
-    def _post(self, url: str, params: Dict[str, Any]) -> Response:
-        return self.client.post(url, data=params)
+    def _post(
+        self, url: str, params: Dict[str, Any], client: Optional[Client] = None
+    ) -> Response:
+        client = client if client is not None else self.client
+        return client.post(url, data=params)
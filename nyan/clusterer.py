@@ -39,9 +39,11 @@ class Clusterer:
         embeddings = np.zeros((len(docs), dim), dtype=np.float32)
         for i, doc in enumerate(docs):
             embeddings[i, :] = doc.embedding
-        distances = pairwise_distances(
+        embedding_distances = pairwise_distances(
             embeddings, metric="cosine", force_all_finite=False
         )
+        # Penalties are only for clustering, titles use embedding distances
+        distances = embedding_distances.copy()
         for i1, doc1 in enumerate(docs):
             for i2, doc2 in enumerate(docs):
                 if i1 == i2:
@@ -96,7 +98,9 @@ class Clusterer:
             for index in doc_indices:
                 cluster.add(docs[index])
             doc_indices_np = np.array(doc_indices)
-            cluster.save_distances(distances[doc_indices_np, doc_indices_np])
+            cluster.save_distances(
+                embedding_distances[np.ix_(doc_indices_np, doc_indices_np)]
+            )
             clusters.append(cluster)
         return clusters
 
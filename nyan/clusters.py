@@ -1,26 +1,143 @@
 import json
 import os
-import traceback
 import shutil
 import hashlib
-from pathlib import Path
-from typing import Optional, Dict, List, Any, TypeVar, Sequence
+import threading
+from typing import Optional, Dict, List, Any, TypeVar, Sequence, Tuple, Set
+from typing import Iterable
 from typing import Counter as CounterT
 from collections import Counter, defaultdict
+from dataclasses import dataclass, field
 from functools import cached_property
 
-from jinja2 import Template
+import numpy as np
+from numpy.typing import NDArray
+from pymongo.collection import Collection
 
 from nyan.client import MessageId
 from nyan.document import Document
 from nyan.mongo import get_clusters_collection
 from nyan.title import choose_title
-from nyan.openai import openai_completion
+from nyan.util import get_current_ts
 
 
-BASE_DIR = Path(os.path.dirname(os.path.abspath(__file__)))
 T = TypeVar("T")
 
+SHORT_DOC_FIELDS = ("url", "channel_id", "post_id", "views", "pub_time", "fetch_time")
+
+# Enough to match, relate and update posted clusters without full documents
+CLUSTER_PROJECTION: Dict[str, int] = {
+    "clid": 1,
+    "messages": 1,
+    "hash": 1,
+    "is_important": 1,
+    "create_time": 1,
+    "annotation_doc.embedding": 1,
+    "annotation_doc.patched_text": 1,
+    "annotation_doc.channel_title": 1,
+    # Changed documents are found without hydration, see update_documents
+    "docs.patched_text": 1,
+    **{"docs." + f: 1 for f in SHORT_DOC_FIELDS},
+    **{"annotation_doc." + f: 1 for f in SHORT_DOC_FIELDS},
+    **{"first_doc." + f: 1 for f in SHORT_DOC_FIELDS},
+}
+
+
+def get_most_common(items: List[T]) -> List[T]:
+    if not items:
+        return []
+    counter = Counter(items)
+    max_count = counter.most_common(1)[0][1]
+    return [item for item, count in counter.items() if count == max_count]
+
+
+@dataclass
+class ClusterStats:
+    """Aggregates over cluster documents, computed in a single pass.
+
+    Built by Cluster.stats and dropped by Cluster.invalidate on any change of
+    the documents. The fields are shared, callers should not modify them.
+    """
+
+    views: int = 0
+    debiased_views: int = 0
+    fetch_time: int = 0
+    pub_time_percentile: int = 0
+    unique_docs: List[Document] = field(default_factory=list)
+    image_doc_count: int = 0
+    channels: List[str] = field(default_factory=list)
+    languages: Set[str] = field(default_factory=set)
+    group: str = "purple"
+    external_links: CounterT[str] = field(default_factory=Counter)
+    doc_issues: List[str] = field(default_factory=list)
+    hash: str = ""  # noqa: A003
+
+    @classmethod
+    def build(cls, docs: Sequence[Document]) -> "ClusterStats":
+        stats = cls()
+        pub_times: List[int] = []
+        unique_views: List[int] = []
+        channels: Dict[str, None] = dict()
+        groups: CounterT[str] = Counter()
+        issues: List[str] = []
+        categories: List[str] = []
+        linked_channels: Set[str] = set()
+        for doc in docs:
+            stats.views += doc.views
+            if doc.fetch_time:
+                stats.fetch_time = max(stats.fetch_time, doc.fetch_time)
+            pub_times.append(doc.pub_time)
+            channels[doc.channel_id] = None
+            if doc.language:
+                stats.languages.add(doc.language)
+            if doc.groups:
+                groups[doc.groups["main"]] += 1
+            if doc.issue:
+                issues.append(doc.issue)
+            if doc.category:
+                categories.append(doc.category)
+            if doc.forward_from:
+                continue
+
+            stats.unique_docs.append(doc)
+            unique_views.append(doc.views)
+            stats.image_doc_count += bool(doc.images)
+            if doc.channel_id in linked_channels:
+                continue
+            for link in set(doc.links):
+                if "t.me" not in link and "http" in link:
+                    stats.external_links[link] += 1
+                    linked_channels.add(doc.channel_id)
+
+        if pub_times:
+            pub_times.sort()
+            stats.pub_time_percentile = pub_times[len(pub_times) // 5]
+
+        # Smoothing outliers for cases where
+        # one document has much more views than others
+        if len(unique_views) > 2:
+            unique_views.sort(reverse=True)
+            unique_views[0] = unique_views[1]
+        stats.debiased_views = sum(unique_views)
+
+        stats.channels = list(channels)
+        groups_count = sum(groups.values())
+        if groups_count:
+            blue_part = groups["blue"] / groups_count
+            red_part = groups["red"] / groups_count
+            if blue_part == 0.0 and red_part > 0.5:
+                stats.group = "red"
+            elif red_part == 0.0 and blue_part > 0.5:
+                stats.group = "blue"
+
+        doc_issues = ["main"] + get_most_common(issues) + get_most_common(categories)
+        stats.doc_issues = list(set(doc_issues))
+
+        data = " ".join(sorted(channels))
+        data += " " + str(stats.views // 100000)
+        stats.hash = hashlib.sha256(data.encode("utf-8")).hexdigest()
+        return stats
+
 
 class Cluster:
     def __init__(self) -> None:
@@ -32,18 +149,52 @@ class Cluster:
         self.create_time: Optional[int] = None
         self.messages: List[MessageId] = list()
 
-        self.distances: Optional[List[float]] = None
+        # Embedding distances between docs, saved by the clusterer
+        self.distances: Optional[NDArray[np.float32]] = None
 
         self.saved_annotation_doc: Optional[Document] = None
         self.saved_first_doc: Optional[Document] = None
         self.saved_hash: Optional[str] = None
         self.saved_diff: Optional[List[Dict[str, Any]]] = None
+        self.saved_stats: Optional[ClusterStats] = None
+        # Stats built before an invalidate are not saved after it
+        self.stats_version: int = 0
+        self.stats_lock = threading.Lock()
+
+        # Set by Clusters.add to keep its indices fresh
+        self.collection: Optional["Clusters"] = None
+        # False for clusters loaded with CLUSTER_PROJECTION
+        self.is_hydrated: bool = True
 
     def add(self, doc: Document) -> None:
         self.docs.append(doc)
         self.url2doc[doc.url] = doc
+        self.invalidate()
+        if self.collection is not None:
+            self.collection.index_docs(self, [len(self.docs) - 1])
+
+    def invalidate(self) -> None:
+        # Should be called on any change of docs or of the annotation doc
+        with self.stats_lock:
+            self.saved_stats = None
+            self.stats_version += 1
+        self.distances = None
+        for name in ("videos", "cropped_title"):
+            self.__dict__.pop(name, None)
 
-    def save_distances(self, distances: List[float]) -> None:
+    @property
+    def stats(self) -> ClusterStats:
+        with self.stats_lock:
+            saved_stats, version = self.saved_stats, self.stats_version
+        if saved_stats is not None:
+            return saved_stats
+        stats = ClusterStats.build(list(self.docs))
+        with self.stats_lock:
+            if self.stats_version == version:
+                self.saved_stats = stats
+        return stats
+
+    def save_distances(self, distances: NDArray[np.float32]) -> None:
         self.distances = distances
 
     def has(self, doc: Document) -> bool:
@@ -56,29 +207,17 @@ class Cluster:
     def pub_time(self) -> int:
         return self.first_doc.pub_time
 
-    @cached_property
+    @property
     def fetch_time(self) -> int:
-        times = [doc.fetch_time for doc in self.docs if doc.fetch_time]
-        if not times:
-            return 0
-        return max(times)
+        return self.stats.fetch_time
 
     @property
     def views(self) -> int:
-        return sum([doc.views for doc in self.docs])
+        return self.stats.views
 
     @property
     def debiased_views(self) -> int:
-        views = [doc.views for doc in self.unique_docs]
-        if len(views) <= 2:
-            return sum(views)
-        views.sort(reverse=True)
-
-        # Smoothing outliers for cases where
-        # one document has much more views than others
-        views[0] = views[1]
-
-        return sum(views)
+        return self.stats.debiased_views
 
     @property
     def age(self) -> int:
@@ -94,15 +233,14 @@ class Cluster:
             return None
         return self.annotation_doc.embedding
 
-    @cached_property
+    @property
     def pub_time_percentile(self) -> int:
-        timestamps = sorted([d.pub_time for d in self.docs])
-        return timestamps[len(timestamps) // 5]
+        return self.stats.pub_time_percentile
 
-    @cached_property
+    @property
     def images(self) -> Sequence[str]:
-        image_doc_count = sum([bool(doc.images) for doc in self.unique_docs])
-        doc_count = len(self.unique_docs)
+        image_doc_count = self.stats.image_doc_count
+        doc_count = len(self.stats.unique_docs)
         if doc_count == 0:
             return tuple()
         images = [
@@ -137,7 +275,7 @@ class Cluster:
 
     @property
     def channels(self) -> List[str]:
-        return list({d.channel_id for d in self.docs})
+        return list(self.stats.channels)
 
     @property
     def first_doc(self) -> Document:
@@ -147,108 +285,42 @@ class Cluster:
 
     @property
     def diff(self) -> List[Dict[str, Any]]:
-        if self.saved_diff is not None:
-            return self.saved_diff
-
-        prompt_path: Path = BASE_DIR / "prompts/diff.txt"
-        with open(prompt_path) as f:
-            template = Template(f.read())
-        prompt = template.render(docs=self.docs, annotation_doc=self.annotation_doc)
-        messages = [{"role": "user", "content": prompt}]
-
-        differences: List[Dict[str, Any]] = []
-        try:
-            content = openai_completion(messages=messages, model_name="gpt-4o")
-            content = content[content.find("{") : content.rfind("}") + 1]
-            parsed_content: Dict[str, List[Dict[str, Any]]] = json.loads(content)
-            differences = parsed_content["differences"]
-
-            channel_titles = {doc.channel_id: doc.channel_title for doc in self.docs}
-            doc_urls = {doc.channel_id: doc.url for doc in self.docs}
-            for diff in differences:
-                ids = diff["channel_ids"][:3]
-                ids = [i for i in ids if i in channel_titles and i in doc_urls]
-                channels = [
-                    '<a href="{}">{}</a>'.format(doc_urls[i], channel_titles[i])
-                    for i in ids
-                ]
-                diff["channels"] = ", ".join(channels)
-        except Exception:
-            traceback.print_exc()
-            differences = []
-        return differences
+        # Generated in background by nyan.diff.DiffGenerator
+        if self.saved_diff is None:
+            return []
+        return self.saved_diff
 
     @property
     def annotation_doc(self) -> Document:
         if self.saved_annotation_doc is not None:
             return self.saved_annotation_doc
         assert self.docs
-        self.saved_annotation_doc = choose_title(self.docs, self.issues)
+        self.saved_annotation_doc = choose_title(
+            self.docs, self.issues, self.distances
+        )
         return self.saved_annotation_doc
 
-    @cached_property
+    @property
     def hash(self) -> str:  # noqa: A003
-        data = " ".join(sorted({d.channel_id for d in self.docs}))
-        data += " " + str(self.views // 100000)
-        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+        return self.stats.hash
 
     @property
     def unique_docs(self) -> List[Document]:
-        return [doc for doc in self.docs if not doc.forward_from]
+        return self.stats.unique_docs
 
     @property
     def external_links(self) -> CounterT[str]:
-        links: CounterT[str] = Counter()
-        used_channels = set()
-        for doc in self.unique_docs:
-            doc_links = set(doc.links)
-            if doc.channel_id in used_channels:
-                continue
-            for link in doc_links:
-                if "t.me" not in link and "http" in link:
-                    links[link] += 1
-                    used_channels.add(doc.channel_id)
-        return links
+        return self.stats.external_links
 
     @property
     def group(self) -> str:
-        groups = [doc.groups["main"] for doc in self.docs if doc.groups]
-        if not groups:
-            return "purple"
-
-        groups_count = Counter(groups)
-
-        all_count = len(groups)
-        blue_part = groups_count["blue"] / all_count
-        red_part = groups_count["red"] / all_count
-
-        if blue_part == 0.0 and red_part > 0.5:
-            return "red"
-        if red_part == 0.0 and blue_part > 0.5:
-            return "blue"
-        return "purple"
+        return self.stats.group
 
     @property
     def issues(self) -> List[str]:
         if self.messages:
             return [m.issue for m in self.messages]
-
-        def get_most_common(items: List[T]) -> List[T]:
-            counter = Counter(items)
-            max_count = counter.most_common(1)[0][1]
-            return [item for item, count in counter.items() if count == max_count]
-
-        issues: List[str] = get_most_common(
-            [doc.issue for doc in self.docs if doc.issue]
-        )
-        categories: List[str] = get_most_common(
-            [doc.category for doc in self.docs if doc.category]
-        )
-
-        final_issues: List[str] = ["main"]
-        final_issues.extend(issues)
-        final_issues.extend(categories)
-        return list(set(final_issues))
+        return list(self.stats.doc_issues)
 
     def get_issue_message(self, issue: str) -> Optional[MessageId]:
         messages = [m for m in self.messages if m.issue == issue]
@@ -263,7 +335,21 @@ class Cluster:
         message_id = message.message_id
         return f"{host}/{message_id}"
 
+    def hydrate(self, full_cluster: "Cluster") -> None:
+        assert full_cluster.clid == self.clid
+        self.docs = full_cluster.docs
+        self.url2doc = full_cluster.url2doc
+        self.saved_annotation_doc = full_cluster.saved_annotation_doc
+        self.saved_first_doc = full_cluster.saved_first_doc
+        self.saved_hash = full_cluster.saved_hash
+        self.saved_diff = full_cluster.saved_diff
+        self.is_hydrated = True
+        self.invalidate()
+
     def asdict(self) -> Dict[str, Any]:
+        if not self.is_hydrated and self.collection is not None:
+            self.collection.hydrate([self])
+        assert self.is_hydrated
         docs = [d.asdict(is_short=True) for d in self.docs]
         annotation_doc = self.annotation_doc.asdict()
         first_doc = self.first_doc.asdict(is_short=True)
@@ -274,7 +360,7 @@ class Cluster:
             "annotation_doc": annotation_doc,
             "first_doc": first_doc,
             "hash": self.hash,
-            "diff": self.diff,
+            "diff": self.saved_diff,
             "is_important": self.is_important,
             "create_time": self.create_time,
         }
@@ -315,12 +401,147 @@ class Cluster:
         return cls.fromdict(json.loads(line))
 
 
+@dataclass
+class DocumentsUpdate:
+    """Changes made by Clusters.update_documents."""
+
+    updates_count: int = 0
+    views_deltas: Dict[int, int] = field(default_factory=dict)
+    text_changed_clids: Set[int] = field(default_factory=set)
+
+    def add(self, clid: int, views_delta: int, is_text_changed: bool) -> None:
+        self.updates_count += 1
+        self.views_deltas[clid] = self.views_deltas.get(clid, 0) + views_delta
+        if is_text_changed:
+            self.text_changed_clids.add(clid)
+
+    @property
+    def changed_clids(self) -> Set[int]:
+        return set(self.views_deltas.keys())
+
+
+class EmbeddingIndex:
+    """Normalized embeddings of posted clusters of one issue.
+
+    Rows are kept in insertion order, rows older than max_age
+    are evicted when they make up more than half of the matrix.
+    """
+
+    def __init__(self, max_age: int = 24 * 3600) -> None:
+        self.max_age = max_age
+        self.clusters: List[Cluster] = []
+        self.clids: Dict[int, int] = dict()
+        self.matrix: Optional[NDArray[np.float32]] = None
+        self.pub_times: NDArray[np.int64] = np.zeros(0, dtype=np.int64)
+        self.size = 0
+
+    def add(self, cluster: Cluster) -> None:
+        embedding = cluster.embedding
+        if not embedding or cluster.clid is None:
+            return
+        if cluster.clid in self.clids:
+            return
+
+        vector = np.array(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm > 0.0:
+            vector /= norm
+
+        if self.matrix is None:
+            self.matrix = np.zeros((16, vector.shape[0]), dtype=np.float32)
+            self.pub_times = np.zeros(16, dtype=np.int64)
+        if self.size == self.matrix.shape[0]:
+            self._grow()
+        assert self.matrix is not None
+        self.matrix[self.size] = vector
+        self.pub_times[self.size] = cluster.pub_time
+        self.clids[cluster.clid] = self.size
+        self.clusters.append(cluster)
+        self.size += 1
+
+    def remove(self, clid: int) -> None:
+        index = self.clids.get(clid)
+        if index is None:
+            return
+        mask = np.ones(self.size, dtype=np.bool_)
+        mask[index] = False
+        self._compact(mask)
+
+    def find_closest(
+        self, embedding: List[float], current_ts: int
+    ) -> Tuple[Optional[Cluster], float]:
+        if self.matrix is None or self.size == 0:
+            return None, 0.0
+
+        # Time only goes forward, so outdated rows can be dropped for good
+        is_outdated = self.pub_times[: self.size] < current_ts - self.max_age
+        if 2 * int(is_outdated.sum()) > self.size:
+            self._compact(~is_outdated)
+
+        is_fresh = np.abs(self.pub_times[: self.size] - current_ts) <= self.max_age
+        if not is_fresh.any():
+            return None, 0.0
+
+        vector = np.array(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm > 0.0:
+            vector /= norm
+        sims = self.matrix[: self.size] @ vector
+        sims[~is_fresh] = -np.inf
+        max_index = int(sims.argmax())
+        return self.clusters[max_index], float(sims[max_index])
+
+    def _grow(self) -> None:
+        assert self.matrix is not None
+        capacity = self.matrix.shape[0] * 2
+        matrix = np.zeros((capacity, self.matrix.shape[1]), dtype=np.float32)
+        matrix[: self.size] = self.matrix[: self.size]
+        pub_times = np.zeros(capacity, dtype=np.int64)
+        pub_times[: self.size] = self.pub_times[: self.size]
+        self.matrix, self.pub_times = matrix, pub_times
+
+    def _compact(self, mask: NDArray[np.bool_]) -> None:
+        assert self.matrix is not None
+        indices = np.flatnonzero(mask)
+        self.matrix[: len(indices)] = self.matrix[indices]
+        self.pub_times[: len(indices)] = self.pub_times[indices]
+        self.clusters = [self.clusters[i] for i in indices]
+        self.clids = {
+            cluster.clid: i
+            for i, cluster in enumerate(self.clusters)
+            if cluster.clid is not None
+        }
+        self.size = len(indices)
+
+
 class Clusters:
     def __init__(self) -> None:
         self.clid2cluster: Dict[int, Cluster] = dict()
         self.message2cluster: Dict[MessageId, Cluster] = dict()
         self.max_clid: int = 60000
 
+        # Issues are published concurrently, guards clusters and indices
+        self.lock = threading.RLock()
+
+        self.embedding_indices: Dict[str, EmbeddingIndex] = defaultdict(
+            EmbeddingIndex
+        )
+        self.url2messages: Dict[str, Dict[str, MessageId]] = defaultdict(dict)
+        # url -> clid -> index of the document in the cluster
+        self.url2positions: Dict[str, Dict[int, int]] = defaultdict(dict)
+
+        # Lazy loading from Mongo, see load_from_mongo and refresh_from_mongo
+        self.mongo_collection: Optional[Collection[Dict[str, Any]]] = None
+        self.watermark: int = 0
+
+        # Append-only journal in file mode, see save and load
+        self.journal_path: Optional[str] = None
+        self.journal_size: int = 0
+        self.dirty_clids: Set[int] = set()
+        self.compaction_ratio: float = 2.0
+        self.compaction_thread: Optional[threading.Thread] = None
+        self.compaction_buffer: Optional[List[str]] = None
+
     def find_similar(
         self,
         cluster: Cluster,
@@ -328,132 +549,388 @@ class Clusters:
         min_size_ratio: float = 0.25,
         min_intersection_ratio: float = 0.25,
     ) -> Optional[Cluster]:
-        messages = list()
-        for url in cluster.urls:
-            message = self.urls2messages[issue_name].get(url)
-            if message is None:
-                continue
-            messages.append(message)
-        if not messages:
-            return None
-
-        message, intersection_count = Counter(messages).most_common()[0]
-        old_cluster = self.message2cluster.get(message)
-        if old_cluster is None:
-            return None
-
-        new_cluster_size = len(cluster.urls)
-        old_cluster_size = len(old_cluster.urls)
-        intersection_ratio = intersection_count / new_cluster_size
-        intersection_ratio = min(
-            intersection_ratio, intersection_count / old_cluster_size
-        )
-        size_ratio = new_cluster_size / old_cluster_size
-
-        if size_ratio < min_size_ratio or intersection_ratio < min_intersection_ratio:
-            return None
+        with self.lock:
+            messages = list()
+            for url in cluster.urls:
+                issue_messages = self.url2messages.get(url)
+                if not issue_messages or issue_name not in issue_messages:
+                    continue
+                messages.append(issue_messages[issue_name])
+            if not messages:
+                return None
+
+            message, intersection_count = Counter(messages).most_common()[0]
+            old_cluster = self.message2cluster.get(message)
+            if old_cluster is None:
+                return None
+
+            new_cluster_size = len(cluster.urls)
+            old_cluster_size = len(old_cluster.urls)
+            intersection_ratio = intersection_count / new_cluster_size
+            intersection_ratio = min(
+                intersection_ratio, intersection_count / old_cluster_size
+            )
+            size_ratio = new_cluster_size / old_cluster_size
+
+            if (
+                size_ratio < min_size_ratio
+                or intersection_ratio < min_intersection_ratio
+            ):
+                return None
+        self.hydrate([old_cluster])
         return old_cluster
 
     def get_embedded_clusters(self, current_ts: int, issue: str) -> List[Cluster]:
-        filtered_clusters = []
-        for cluster in self.clid2cluster.values():
-            if not cluster.embedding:
-                continue
-            if not cluster.messages:
-                continue
-            if abs(cluster.pub_time - current_ts) > 24 * 3600:
-                continue
-            if issue not in cluster.issues:
-                continue
-            filtered_clusters.append(cluster)
-        return filtered_clusters
+        with self.lock:
+            filtered_clusters = []
+            for cluster in self.clid2cluster.values():
+                if not cluster.embedding:
+                    continue
+                if not cluster.messages:
+                    continue
+                if abs(cluster.pub_time - current_ts) > 24 * 3600:
+                    continue
+                if issue not in cluster.issues:
+                    continue
+                filtered_clusters.append(cluster)
+            return filtered_clusters
 
-    def add(self, cluster: Cluster) -> None:
-        if cluster.clid is None:
-            self.max_clid += 1
-            cluster.clid = self.max_clid
+    def find_closest(
+        self, embedding: List[float], current_ts: int, issue: str
+    ) -> Tuple[Optional[Cluster], float]:
+        with self.lock:
+            if issue not in self.embedding_indices:
+                return None, 0.0
+            return self.embedding_indices[issue].find_closest(embedding, current_ts)
 
-        for message in cluster.messages:
-            self.message2cluster[message] = cluster
-        self.clid2cluster[cluster.clid] = cluster
-        self.max_clid = max(self.max_clid, cluster.clid)
+    def add(self, cluster: Cluster) -> None:
+        with self.lock:
+            if cluster.clid is None:
+                self.max_clid += 1
+                cluster.clid = self.max_clid
+
+            for message in cluster.messages:
+                self.message2cluster[message] = cluster
+                self.embedding_indices[message.issue].add(cluster)
+            self.clid2cluster[cluster.clid] = cluster
+            self.max_clid = max(self.max_clid, cluster.clid)
+
+            cluster.collection = self
+            self.index_docs(cluster, range(len(cluster.docs)))
+
+    def index_docs(self, cluster: Cluster, doc_indices: Iterable[int]) -> None:
+        assert cluster.clid is not None
+        with self.lock:
+            self.dirty_clids.add(cluster.clid)
+            for doc_index in doc_indices:
+                url = cluster.docs[doc_index].url
+                self.url2positions[url][cluster.clid] = doc_index
+                issue_messages = self.url2messages[url]
+                for message in cluster.messages:
+                    issue_messages[message.issue] = message
+
+    def reset_changes(self, clids: Iterable[int]) -> None:
+        # Cluster.changed() is relative to the previous call
+        with self.lock:
+            for clid in clids:
+                cluster = self.clid2cluster.get(clid)
+                if cluster is not None and cluster.is_hydrated:
+                    cluster.saved_hash = cluster.hash
+
+    def mark_dirty(self, cluster: Cluster) -> None:
+        if cluster.clid is None or cluster.collection is not self:
+            return
+        with self.lock:
+            self.dirty_clids.add(cluster.clid)
+
+    def remove(self, clid: int) -> None:
+        with self.lock:
+            cluster = self.clid2cluster.pop(clid, None)
+            self.dirty_clids.discard(clid)
+            if cluster is None:
+                return
+            for message in cluster.messages:
+                if self.message2cluster.get(message) is cluster:
+                    self.message2cluster.pop(message)
+            for index in self.embedding_indices.values():
+                index.remove(clid)
+            for url in cluster.urls:
+                positions = self.url2positions[url]
+                positions.pop(clid, None)
+                if not positions:
+                    self.url2positions.pop(url)
+                issue_messages = self.url2messages.get(url, dict())
+                freed_issues = set()
+                for message in cluster.messages:
+                    # The slot can be taken by another cluster with this url
+                    issue_message = issue_messages.get(message.issue)
+                    if issue_message is not None and issue_message == message:
+                        issue_messages.pop(message.issue)
+                        freed_issues.add(message.issue)
+                # Freed slots go to other clusters with this url, the last one wins
+                for other_clid in sorted(positions):
+                    for message in self.clid2cluster[other_clid].messages:
+                        if message.issue in freed_issues:
+                            issue_messages[message.issue] = message
+                if not issue_messages:
+                    self.url2messages.pop(url, None)
+            cluster.collection = None
+
+    def hydrate(self, clusters: List[Cluster]) -> None:
+        # Mongo is queried without the lock, so other issues are not blocked
+        with self.lock:
+            clid2cluster = {
+                cl.clid: cl
+                for cl in clusters
+                if not cl.is_hydrated and cl.clid is not None
+            }
+        if not clid2cluster:
+            return
+        assert self.mongo_collection is not None
+        records = list(
+            self.mongo_collection.find({"clid": {"$in": list(clid2cluster.keys())}})
+        )
+        with self.lock:
+            for record in records:
+                cluster = clid2cluster[record["clid"]]
+                # Hydrated by another thread or removed in the meantime
+                if cluster.is_hydrated or cluster.collection is not self:
+                    continue
+                cluster.hydrate(Cluster.fromdict(record))
+                self.index_docs(cluster, range(len(cluster.docs)))
 
     def __len__(self) -> int:
         return len(self.clid2cluster)
 
-    @cached_property
-    def urls2messages(self) -> Dict[str, Dict[str, MessageId]]:
-        result: Dict[str, Dict[str, MessageId]] = defaultdict(dict)
-        for _, cluster in self.clid2cluster.items():
-            for url in cluster.urls:
-                for message in cluster.messages:
-                    result[message.issue][url] = message
-        return result
-
-    def update_documents(self, documents: List[Document]) -> int:
+    def update_documents(self, documents: List[Document]) -> "DocumentsUpdate":
+        update = DocumentsUpdate()
         url2doc = {doc.url: doc for doc in documents}
-        updates_count = 0
-        for _, cluster in self.clid2cluster.items():
-            for doc_index, doc in enumerate(cluster.docs):
-                url = doc.url
-                if url not in url2doc:
-                    continue
-                new_doc = url2doc[url]
-                if (
-                    doc.patched_text == new_doc.patched_text
-                    and doc.views == new_doc.views
-                ):
+        with self.lock:
+            # Short documents of lazy clusters have views and texts,
+            # so only clusters with changed documents are hydrated
+            changed_clids = {
+                clid
+                for new_doc in url2doc.values()
+                for clid, doc_index in self.url2positions.get(new_doc.url, {}).items()
+                if self.is_doc_changed(
+                    self.clid2cluster[clid].docs[doc_index], new_doc
+                )
+            }
+            changed_clusters = [self.clid2cluster[clid] for clid in changed_clids]
+        self.hydrate(changed_clusters)
+        with self.lock:
+            for new_doc in url2doc.values():
+                positions = self.url2positions.get(new_doc.url)
+                if not positions:
                     continue
-                cluster.docs[doc_index] = new_doc
-                cluster.url2doc[url] = new_doc
-                if (
-                    cluster.saved_annotation_doc
-                    and cluster.saved_annotation_doc.url == url
-                ):
-                    cluster.saved_annotation_doc = new_doc
-                updates_count += 1
-        return updates_count
+                for clid, doc_index in positions.items():
+                    if clid not in changed_clids:
+                        continue
+                    cluster = self.clid2cluster[clid]
+                    doc = cluster.docs[doc_index]
+                    if not cluster.is_hydrated or not self.is_doc_changed(doc, new_doc):
+                        continue
+                    views_delta = new_doc.views - doc.views
+                    is_text_changed = doc.patched_text != new_doc.patched_text
+                    cluster.docs[doc_index] = new_doc
+                    cluster.url2doc[new_doc.url] = new_doc
+                    if (
+                        cluster.saved_annotation_doc
+                        and cluster.saved_annotation_doc.url == new_doc.url
+                    ):
+                        cluster.saved_annotation_doc = new_doc
+                    cluster.invalidate()
+                    update.add(clid, views_delta, is_text_changed)
+            self.dirty_clids.update(update.changed_clids)
+        return update
+
+    @staticmethod
+    def is_doc_changed(doc: Document, new_doc: Document) -> bool:
+        return doc.views != new_doc.views or doc.patched_text != new_doc.patched_text
 
     def save(self, path: str) -> None:
+        """Appends changed clusters to the journal at path.
+
+        The journal is a JSONL file, the last record of a cluster wins.
+        It is rewritten in background when it grows too large,
+        see compaction_ratio.
+        """
+        with self.lock:
+            if self.journal_path != path or not os.path.exists(path):
+                self._rewrite_journal(path)
+                return
+
+            lines = [
+                self.clid2cluster[clid].serialize() + "\n"
+                for clid in sorted(self.dirty_clids)
+                if clid in self.clid2cluster
+            ]
+            self.dirty_clids.clear()
+            if lines:
+                with open(path, "a") as w:
+                    w.writelines(lines)
+                    w.flush()
+                    os.fsync(w.fileno())
+                self.journal_size += len(lines)
+                if self.compaction_buffer is not None:
+                    self.compaction_buffer.extend(lines)
+
+            max_size = self.compaction_ratio * max(len(self.clid2cluster), 1)
+            if self.compaction_thread is None and self.journal_size > max_size:
+                snapshot = self._serialize_all()
+                self.compaction_buffer = []
+                self.compaction_thread = threading.Thread(
+                    target=self._compact, args=(path, snapshot), daemon=True
+                )
+                self.compaction_thread.start()
+
+    def wait_compaction(self) -> None:
+        thread = self.compaction_thread
+        if thread is not None:
+            thread.join()
+
+    def _serialize_all(self) -> List[str]:
+        return [
+            cluster.serialize() + "\n"
+            for _, cluster in sorted(self.clid2cluster.items())
+        ]
+
+    def _rewrite_journal(self, path: str) -> None:
+        lines = self._serialize_all()
         temp_path = path + ".new"
-        with open(path + ".new", "w") as w:
-            for _, cluster in sorted(self.clid2cluster.items()):
-                w.write(cluster.serialize() + "\n")
+        with open(temp_path, "w") as w:
+            w.writelines(lines)
+            w.flush()
+            os.fsync(w.fileno())
         shutil.move(temp_path, path)
+        self.journal_path = path
+        self.journal_size = len(lines)
+        self.dirty_clids.clear()
+
+    def _compact(self, path: str, lines: List[str]) -> None:
+        # Records appended while the snapshot is written go to compaction_buffer
+        temp_path = path + ".compact"
+        with open(temp_path, "w") as w:
+            w.writelines(lines)
+        with self.lock:
+            buffered_lines = self.compaction_buffer or []
+            with open(temp_path, "a") as w:
+                w.writelines(buffered_lines)
+                w.flush()
+                os.fsync(w.fileno())
+            if self.journal_path == path:
+                shutil.move(temp_path, path)
+                self.journal_size = len(lines) + len(buffered_lines)
+            else:
+                os.remove(temp_path)
+            self.compaction_buffer = None
+            self.compaction_thread = None
 
     @classmethod
     def load(cls, path: str) -> "Clusters":
         assert os.path.exists(path)
-        clusters = cls()
         with open(path) as r:
-            for line in r:
-                clusters.add(Cluster.deserialize(line))
+            lines = [line for line in r if line.strip()]
+
+        # A torn tail is not appended to, the journal is rewritten on save
+        is_clean = not lines or lines[-1].endswith("\n")
+        records: Dict[int, Dict[str, Any]] = dict()
+        unnumbered_records: List[Dict[str, Any]] = []
+        for line_num, line in enumerate(lines):
+            try:
+                record: Dict[str, Any] = json.loads(line)
+            except ValueError:
+                # The last record may be cut off by a crash during append
+                if line_num + 1 == len(lines):
+                    print("Skipping a broken last record in {}".format(path))
+                    is_clean = False
+                    continue
+                raise
+            clid = record.get("clid")
+            if clid is None:
+                unnumbered_records.append(record)
+                continue
+            records[clid] = record
+
+        clusters = cls()
+        for record in list(records.values()) + unnumbered_records:
+            clusters.add(Cluster.fromdict(record))
+        clusters.journal_path = path if is_clean else None
+        clusters.journal_size = len(lines)
+        clusters.dirty_clids.clear()
         return clusters
 
     def save_to_mongo(self, mongo_config_path: str, only_new: bool = True) -> int:
         collection = get_clusters_collection(mongo_config_path)
-        if not self.clid2cluster:
-            return 0
-        max_cluster_fetch_time = max(
-            [cl.fetch_time for cl in self.clid2cluster.values()]
-        )
-        saved_count = 0
-        for clid, cluster in sorted(self.clid2cluster.items()):
-            if only_new and max_cluster_fetch_time - cluster.fetch_time > 24 * 3600:
-                continue
-            saved_count += 1
-            collection.replace_one({"clid": clid}, cluster.asdict(), upsert=True)
-        return saved_count
+        with self.lock:
+            if not self.clid2cluster:
+                return 0
+            max_cluster_fetch_time = max(
+                [cl.fetch_time for cl in self.clid2cluster.values()]
+            )
+            saved_count = 0
+            update_time = get_current_ts()
+            for clid, cluster in sorted(self.clid2cluster.items()):
+                # Not hydrated clusters were not changed since loading
+                if not cluster.is_hydrated:
+                    continue
+                time_diff = max_cluster_fetch_time - cluster.fetch_time
+                if only_new and time_diff > 24 * 3600:
+                    continue
+                saved_count += 1
+                record = cluster.asdict()
+                record["update_time"] = update_time
+                collection.replace_one({"clid": clid}, record, upsert=True)
+            self.watermark = max(self.watermark, update_time)
+            return saved_count
 
     @classmethod
     def load_from_mongo(
-        cls, mongo_config_path: str, current_ts: int, offset: int
+        cls,
+        mongo_config_path: str,
+        current_ts: int,
+        offset: int,
+        lazy: bool = False,
     ) -> "Clusters":
         collection = get_clusters_collection(mongo_config_path)
+        projection = CLUSTER_PROJECTION if lazy else None
         clusters_dicts = list(
-            collection.find({"create_time": {"$gte": current_ts - offset}})
+            collection.find(
+                {"create_time": {"$gte": current_ts - offset}}, projection
+            )
         )
         clusters = cls()
+        clusters.mongo_collection = collection
+        clusters.watermark = current_ts
         for cluster_dict in clusters_dicts:
-            clusters.add(Cluster.fromdict(cluster_dict))
+            cluster = Cluster.fromdict(cluster_dict)
+            cluster.is_hydrated = not lazy
+            clusters.add(cluster)
         return clusters
+
+    def refresh_from_mongo(self, current_ts: int, offset: int) -> int:
+        """Drops outdated clusters and reloads the ones modified by others."""
+        assert self.mongo_collection is not None
+        with self.lock:
+            min_create_time = current_ts - offset
+            for clid, cluster in list(self.clid2cluster.items()):
+                if cluster.create_time and cluster.create_time < min_create_time:
+                    self.remove(clid)
+
+            records = list(
+                self.mongo_collection.find(
+                    {
+                        "create_time": {"$gte": min_create_time},
+                        "update_time": {"$gt": self.watermark},
+                    },
+                    CLUSTER_PROJECTION,
+                )
+            )
+            for record in records:
+                cluster = Cluster.fromdict(record)
+                cluster.is_hydrated = False
+                assert cluster.clid is not None
+                self.remove(cluster.clid)
+                self.add(cluster)
+            self.watermark = max(self.watermark, current_ts)
+            return len(records)
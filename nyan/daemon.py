@@ -1,12 +1,14 @@
 import os
 import json
+import threading
+import traceback
 from collections import Counter
-from time import sleep
-from typing import Dict, Any, Optional, List, cast
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from time import monotonic, sleep
+from typing import Dict, Any, Optional, List, Set, Union
 from typing import Counter as CounterT
 
-from sklearn.metrics.pairwise import cosine_similarity  # type: ignore
-
 from nyan.annotator import Annotator
 from nyan.client import TelegramClient
 from nyan.clusters import Clusters, Cluster
@@ -14,14 +16,22 @@ from nyan.clusterer import Clusterer
 from nyan.channels import Channels
 from nyan.ranker import Ranker
 from nyan.renderer import Renderer
+from nyan.diff import DiffGenerator, DiffCache, FileDiffCache, MongoDiffCache
+from nyan.discussions import (
+    DiscussionsStore,
+    MongoDiscussionsStore,
+    FileDiscussionsStore,
+)
+from nyan.media import MediaCache, FileMediaCache, MongoMediaCache
 from nyan.document import (
     read_documents_file,
+    DocumentSegments,
     read_documents_mongo,
     Document,
     read_annotated_documents_mongo,
     write_annotated_documents_mongo,
 )
-from nyan.util import get_current_ts, ts_to_dt
+from nyan.util import get_current_ts, get_text_hash, ts_to_dt
 
 
 class Daemon:
@@ -46,14 +56,63 @@ class Daemon:
         with open(daemon_config_path) as r:
             self.config: Dict[str, Any] = json.load(r)
 
+        self.diff_generator: Optional[DiffGenerator] = None
+        self.posted_clusters: Optional[Clusters] = None
+        # Posted clusters with updated or added documents and new clusters
+        # of the current iteration, guarded by the lock of posted clusters
+        self.changed_clids: Set[int] = set()
+        self.document_segments: Optional[DocumentSegments] = None
+        # Sent and skipped message edits in the current iteration
+        self.edit_counts: CounterT[str] = Counter()
+        self.edit_counts_lock = threading.Lock()
+
     def run(
         self,
         input_path: Optional[str],
         mongo_config_path: Optional[str],
         posted_clusters_path: Optional[str],
     ) -> None:
+        self.start_polling(mongo_config_path, posted_clusters_path)
+        if not self.config.get("pipelined", False):
+            while True:
+                self.__call__(input_path, mongo_config_path, posted_clusters_path)
+
+        # Documents for the next iteration are read and annotated
+        # while the current one is being published. Reading starts when
+        # the current iteration is expected to end in the time reading takes,
+        # so that the next snapshot is not an iteration behind.
+        docs_queue: "Queue[Union[List[Document], Exception]]" = Queue(maxsize=1)
+        durations = {"prepare": 0.0, "process": 0.0}
+        processed = threading.Event()
+
+        def produce() -> None:
+            while True:
+                start_time = monotonic()
+                try:
+                    docs = self.prepare_documents(input_path, mongo_config_path)
+                except Exception as e:
+                    docs_queue.put(e)
+                    return
+                if docs is None:
+                    continue
+                durations["prepare"] = monotonic() - start_time
+                docs_queue.put(docs)
+                docs_queue.join()
+                processed.clear()
+                delay = durations["process"] - durations["prepare"]
+                processed.wait(timeout=max(delay, 0.0))
+
+        producer = threading.Thread(target=produce, name="producer", daemon=True)
+        producer.start()
         while True:
-            self.__call__(input_path, mongo_config_path, posted_clusters_path)
+            item = docs_queue.get()
+            docs_queue.task_done()
+            if isinstance(item, Exception):
+                raise item
+            start_time = monotonic()
+            self.process_documents(item, mongo_config_path, posted_clusters_path)
+            durations["process"] = monotonic() - start_time
+            processed.set()
 
     def __call__(
         self,
@@ -61,18 +120,36 @@ class Daemon:
         mongo_config_path: Optional[str],
         posted_clusters_path: Optional[str],
     ) -> None:
+        self.start_polling(mongo_config_path, posted_clusters_path)
+        annotated_docs = self.prepare_documents(input_path, mongo_config_path)
+        if annotated_docs is None:
+            return
+        self.process_documents(annotated_docs, mongo_config_path, posted_clusters_path)
+
+    def start_polling(
+        self,
+        mongo_config_path: Optional[str],
+        posted_clusters_path: Optional[str],
+    ) -> None:
+        # The store is attached first, otherwise mappings from updates
+        # polled before it would be lost
+        if self.client.discussions_store is None:
+            self.load_discussions(
+                mongo_config_path, posted_clusters_path, self.config["clusters_offset"]
+            )
+        self.client.start_polling()
+
+    def prepare_documents(
+        self,
+        input_path: Optional[str],
+        mongo_config_path: Optional[str],
+    ) -> Optional[List[Document]]:
         assert (
             input_path and not mongo_config_path or mongo_config_path and not input_path
         )
         if input_path and not os.path.exists(input_path):
             print("No input documents!")
-            return
-
-        print("===== New iteration =====")
-        clusters_offset = self.config["clusters_offset"]
-        posted_clusters = self.load_posted_clusters(
-            mongo_config_path, posted_clusters_path, clusters_offset
-        )
+            return None
 
         documents_offset = self.config["documents_offset"]
         try:
@@ -80,16 +157,51 @@ class Daemon:
         except Exception as e:
             print(e)
             print("Waiting for correct documents...")
-            return
+            return None
         if not docs:
             print("Waiting for documents...")
             sleep(10)
-            return
+            return None
         self.print_bad_channels(docs)
-        annotated_docs = self.annotate_documents(docs, mongo_config_path)
+        return self.annotate_documents(docs, mongo_config_path)
 
-        updates_count = posted_clusters.update_documents(annotated_docs)
-        print("{} updated documents".format(updates_count))
+    def process_documents(
+        self,
+        annotated_docs: List[Document],
+        mongo_config_path: Optional[str],
+        posted_clusters_path: Optional[str],
+    ) -> None:
+        print("===== New iteration =====")
+        clusters_offset = self.config["clusters_offset"]
+        if self.client.media_cache is None:
+            self.load_media(mongo_config_path, posted_clusters_path, clusters_offset)
+        else:
+            min_time = get_current_ts() - clusters_offset
+            pruned_count = self.client.media_cache.prune(min_time)
+            print("{} old media file ids pruned".format(pruned_count))
+        if self.client.discussions_store is not None:
+            min_time = get_current_ts() - clusters_offset
+            pruned_count = self.client.discussions_store.prune(min_time)
+            print("{} old discussion records pruned".format(pruned_count))
+        if "diff" in self.config and self.diff_generator is None:
+            self.load_diffs(mongo_config_path, posted_clusters_path, clusters_offset)
+        elif self.diff_generator is not None:
+            min_time = get_current_ts() - clusters_offset
+            pruned_count = self.diff_generator.cache.prune(min_time)
+            print("{} old diffs pruned".format(pruned_count))
+
+        posted_clusters = self.load_posted_clusters(
+            mongo_config_path, posted_clusters_path, clusters_offset
+        )
+
+        update = posted_clusters.update_documents(annotated_docs)
+        print(
+            "{} updated documents in {} clusters, {} with new texts".format(
+                update.updates_count,
+                len(update.changed_clids),
+                len(update.text_changed_clids),
+            )
+        )
 
         new_clusters: List[Cluster] = self.clusterer(annotated_docs)
         print("{} clusters overall".format(len(new_clusters)))
@@ -99,15 +211,19 @@ class Daemon:
         print("{} clusters in all issues after filtering".format(num_clusters))
 
         print()
-        for issue, clusters in ranked_clusters.items():
-            for cluster in clusters:
-                self.send_cluster(
-                    cluster,
-                    issue,
-                    posted_clusters,
-                    posted_clusters_path,
-                    mongo_config_path,
-                )
+        self.edit_counts.clear()
+        self.changed_clids = set(update.changed_clids)
+        self.publish(
+            ranked_clusters, posted_clusters, posted_clusters_path, mongo_config_path
+        )
+        posted_clusters.reset_changes(self.changed_clids)
+        print(
+            "{} messages updated, {} failed, {} skipped as not modified".format(
+                self.edit_counts["sent"],
+                self.edit_counts["failed"],
+                self.edit_counts["skipped"],
+            )
+        )
 
         print()
         if posted_clusters_path:
@@ -125,24 +241,90 @@ class Daemon:
         clusters_offset: int,
     ) -> Clusters:
         posted_clusters = Clusters()
-        if mongo_config_path:
+        if mongo_config_path and self.posted_clusters is not None:
+            refreshed_count = self.posted_clusters.refresh_from_mongo(
+                get_current_ts(), clusters_offset
+            )
+            print("{} clusters refreshed from Mongo".format(refreshed_count))
+            posted_clusters = self.posted_clusters
+        elif mongo_config_path:
             print("Reading clusters from Mongo")
             posted_clusters = Clusters.load_from_mongo(
-                mongo_config_path, get_current_ts(), clusters_offset
+                mongo_config_path, get_current_ts(), clusters_offset, lazy=True
             )
+            # Kept between iterations, only changes are loaded later
+            self.posted_clusters = posted_clusters
+        elif posted_clusters_path and self.posted_clusters is not None:
+            posted_clusters = self.posted_clusters
         elif posted_clusters_path and os.path.exists(posted_clusters_path):
             print("Reading clusters from file")
             posted_clusters = Clusters.load(posted_clusters_path)
+            # The daemon is the only writer of the journal, no need to reread it
+            self.posted_clusters = posted_clusters
         print("{} clusters loaded".format(len(posted_clusters)))
         return posted_clusters
 
+    def load_discussions(
+        self,
+        mongo_config_path: Optional[str],
+        posted_clusters_path: Optional[str],
+        clusters_offset: int,
+    ) -> None:
+        store = DiscussionsStore()
+        if mongo_config_path:
+            store = MongoDiscussionsStore(mongo_config_path)
+        elif posted_clusters_path:
+            discussions_path = os.path.splitext(posted_clusters_path)[0]
+            store = FileDiscussionsStore(discussions_path + "_discussions.jsonl")
+        min_time = get_current_ts() - clusters_offset
+        loaded_count = self.client.set_discussions_store(store, min_time)
+        print("{} discussion messages loaded".format(loaded_count))
+
+    def load_media(
+        self,
+        mongo_config_path: Optional[str],
+        posted_clusters_path: Optional[str],
+        clusters_offset: int,
+    ) -> None:
+        cache = MediaCache()
+        if mongo_config_path:
+            cache = MongoMediaCache(mongo_config_path)
+        elif posted_clusters_path:
+            media_path = os.path.splitext(posted_clusters_path)[0]
+            cache = FileMediaCache(media_path + "_media.jsonl")
+        min_time = get_current_ts() - clusters_offset
+        loaded_count = self.client.set_media_cache(cache, min_time)
+        print("{} media file ids loaded".format(loaded_count))
+
+    def load_diffs(
+        self,
+        mongo_config_path: Optional[str],
+        posted_clusters_path: Optional[str],
+        clusters_offset: int,
+    ) -> None:
+        diff_config = self.config["diff"]
+        cache = DiffCache()
+        if mongo_config_path:
+            cache = MongoDiffCache(mongo_config_path)
+        elif posted_clusters_path:
+            diffs_path = os.path.splitext(posted_clusters_path)[0]
+            cache = FileDiffCache(diffs_path + "_diffs.jsonl")
+        records = cache.load(get_current_ts() - clusters_offset)
+        print("{} diffs loaded".format(len(records)))
+        self.diff_generator = DiffGenerator(cache, **diff_config)
+
     def read_documents(
         self,
         input_path: Optional[str],
         documents_offset: int,
         mongo_config_path: Optional[str],
     ) -> List[Document]:
-        if input_path and os.path.exists(input_path):
+        if input_path and os.path.isdir(input_path):
+            print("Reading docs from segments")
+            if self.document_segments is None:
+                self.document_segments = DocumentSegments(input_path)
+            docs = self.document_segments.read(get_current_ts(), documents_offset)
+        elif input_path and os.path.exists(input_path):
             print("Reading docs from file")
             docs = read_documents_file(input_path, get_current_ts(), documents_offset)
         elif mongo_config_path:
@@ -196,6 +378,42 @@ class Daemon:
 
         return final_docs
 
+    def publish(
+        self,
+        ranked_clusters: Dict[str, List[Cluster]],
+        posted_clusters: Clusters,
+        posted_clusters_path: Optional[str],
+        mongo_config_path: Optional[str],
+    ) -> None:
+        if not ranked_clusters:
+            return
+
+        def publish_issue(issue_name: str, clusters: List[Cluster]) -> None:
+            # An error in one cluster does not stop the issue or the daemon
+            for cluster in clusters:
+                try:
+                    self.send_cluster(
+                        cluster,
+                        issue_name,
+                        posted_clusters,
+                        posted_clusters_path,
+                        mongo_config_path,
+                    )
+                except Exception:
+                    print("Failed to send cluster in {}:".format(issue_name))
+                    traceback.print_exc()
+
+        # One worker per issue: clusters of an issue are sent in order,
+        # different issues do not wait for each other
+        with ThreadPoolExecutor(max_workers=len(ranked_clusters)) as executor:
+            futures = [
+                executor.submit(publish_issue, issue_name, clusters)
+                for issue_name, clusters in ranked_clusters.items()
+            ]
+        for future in futures:
+            future.result()
+        self.client.wait_discussion_messages()
+
     def send_cluster(
         self,
         cluster: Cluster,
@@ -204,9 +422,9 @@ class Daemon:
         posted_clusters_path: Optional[str],
         mongo_config_path: Optional[str],
     ) -> None:
-        sleep_time = self.config["sleep_time"]
         max_time_updated = self.config["max_time_updated"]
 
+        # Not under the lock, a lazy cluster can be hydrated from Mongo here
         posted_cluster = posted_clusters.find_similar(
             cluster,
             issue_name,
@@ -214,62 +432,95 @@ class Daemon:
             min_intersection_ratio=self.config["similar_min_intersection_ratio"],
         )
         if posted_cluster:
-            message = posted_cluster.get_issue_message(issue_name)
-            assert message
-            discussion_message = self.client.get_discussion(message)
-
-            new_docs_pub_time = 0
-            for doc in cluster.docs:
-                if not posted_cluster.has(doc):
-                    posted_cluster.add(doc)
-                    discussion_text = self.renderer.render_discussion_message(doc)
-                    self.client.send_discussion_message(
-                        discussion_text, discussion_message
+            # Workers of other issues can add docs to the same posted cluster,
+            # so everything that is read from it is read under the lock
+            new_docs: List[Document] = []
+            with posted_clusters.lock:
+                for doc in cluster.docs:
+                    if not posted_cluster.has(doc):
+                        posted_cluster.add(doc)
+                        new_docs.append(doc)
+                if new_docs and posted_cluster.clid is not None:
+                    self.changed_clids.add(posted_cluster.clid)
+                message = posted_cluster.get_issue_message(issue_name)
+                assert message
+
+                current_ts = get_current_ts()
+                time_diff = abs(current_ts - posted_cluster.pub_time_percentile)
+                is_updatable = time_diff < max_time_updated
+                is_diff_changed = False
+                if is_updatable:
+                    is_diff_changed = self.update_diff(posted_cluster)
+                cluster_text = None
+                # Stats of clusters without changed documents are not rebuilt
+                is_changed = (
+                    posted_cluster.clid in self.changed_clids
+                    and posted_cluster.changed()
+                )
+                if is_updatable and (is_changed or is_diff_changed):
+                    cluster_text = self.renderer.render_cluster(
+                        posted_cluster, issue_name
                     )
-                    new_docs_pub_time = max(doc.pub_time, new_docs_pub_time)
-                    sleep(sleep_time)
+                    # Telegram rejects edits that do not change the text
+                    if get_text_hash(cluster_text) == message.text_hash:
+                        self.count_edit("skipped")
+                        cluster_text = None
+                is_caption = bool(posted_cluster.images) or bool(posted_cluster.videos)
+                cropped_title = posted_cluster.cropped_title
+
+            discussion_message = self.client.get_discussion(message)
+            discussion_texts = self.renderer.render_discussion_messages(new_docs)
+            self.client.queue_discussion_messages(discussion_texts, discussion_message)
 
-            current_ts = get_current_ts()
-            time_diff = abs(current_ts - posted_cluster.pub_time_percentile)
-            if time_diff < max_time_updated and posted_cluster.changed():
-                cluster_text = self.renderer.render_cluster(posted_cluster, issue_name)
+            if cluster_text:
                 print(
                     "Update message {} at {}: {}".format(
-                        message.message_id, message.issue, posted_cluster.cropped_title
+                        message.message_id, message.issue, cropped_title
                     )
                 )
                 print("Discussion message id: {}".format(discussion_message.message_id))
 
-                is_caption = bool(posted_cluster.images) or bool(posted_cluster.videos)
-                self.client.update_message(message, cluster_text, is_caption)
+                if self.client.update_message(message, cluster_text, is_caption):
+                    with posted_clusters.lock:
+                        message.text_hash = get_text_hash(cluster_text)
+                        posted_clusters.mark_dirty(posted_cluster)
+                    self.count_edit("sent")
+                else:
+                    self.count_edit("failed")
             else:
                 print(
                     "Same cluster {} at {}: {}".format(
-                        message.message_id, message.issue, posted_cluster.cropped_title
+                        message.message_id, message.issue, cropped_title
                     )
                 )
             print()
             return
 
-        cluster_text = self.renderer.render_cluster(cluster, issue_name)
-        print("New cluster in {}: {}".format(issue_name, cluster.cropped_title))
-
-        self.client.update_discussion_mapping(issue_name)
+        # The same cluster can be published by a worker of another issue
+        with posted_clusters.lock:
+            self.update_diff(cluster)
+            cluster_text = self.renderer.render_cluster(cluster, issue_name)
+            images, videos = cluster.images, cluster.videos
+            print("New cluster in {}: {}".format(issue_name, cluster.cropped_title))
 
         reply_to = self.calc_reply_to(cluster, posted_clusters, issue_name)
         message = self.client.send_message(
             cluster_text,
             issue_name,
-            photos=cluster.images,
-            videos=cluster.videos,
+            photos=images,
+            videos=videos,
             reply_to=reply_to,
         )
         if message is None:
             return
 
-        cluster.create_time = get_current_ts()
-        cluster.messages.append(message)
-        posted_clusters.add(cluster)
+        with posted_clusters.lock:
+            message.text_hash = get_text_hash(cluster_text)
+            cluster.create_time = get_current_ts()
+            cluster.messages.append(message)
+            posted_clusters.add(cluster)
+            if cluster.clid is not None:
+                self.changed_clids.add(cluster.clid)
 
         print("Message id: {}, saving".format(message.message_id))
         if posted_clusters_path:
@@ -277,34 +528,41 @@ class Daemon:
         if mongo_config_path:
             posted_clusters.save_to_mongo(mongo_config_path)
 
-        self.client.update_discussion_mapping(issue_name)
-        discussion_message = self.client.get_discussion(message)
+        discussion_message = self.client.get_discussion(
+            message, timeout=self.config.get("discussion_timeout", 20.0)
+        )
         print("Discussion message id: {}".format(discussion_message.message_id))
 
-        for doc in cluster.docs:
-            discussion_text = self.renderer.render_discussion_message(doc)
-            self.client.send_discussion_message(discussion_text, discussion_message)
-            sleep(sleep_time)
+        discussion_texts = self.renderer.render_discussion_messages(cluster.docs)
+        self.client.queue_discussion_messages(discussion_texts, discussion_message)
         print()
         return
 
+    def count_edit(self, key: str) -> None:
+        with self.edit_counts_lock:
+            self.edit_counts[key] += 1
+
+    def update_diff(self, cluster: Cluster) -> bool:
+        if self.diff_generator is None:
+            return False
+        self.diff_generator.request(cluster)
+        return self.diff_generator.apply(cluster)
+
     def calc_reply_to(
         self, cluster: Cluster, posted_clusters: Clusters, issue_name: str
     ) -> Optional[int]:
         threshold = float(self.config["related_threshold"])
 
         current_ts = get_current_ts()
-        clusters = posted_clusters.get_embedded_clusters(current_ts, issue_name)
-        if not clusters:
+        embedding = cluster.annotation_doc.embedding
+        if not embedding:
+            return None
+        best_cluster, max_sim = posted_clusters.find_closest(
+            embedding, current_ts, issue_name
+        )
+        if best_cluster is None:
             return None
 
-        pivot_embedding = [cluster.annotation_doc.embedding]
-        embeddings = [cl.embedding for cl in clusters]
-        sims = cosine_similarity(pivot_embedding, embeddings)[0]
-
-        max_index = sims.argmax()
-        max_sim = sims[max_index]
-        best_cluster = clusters[max_index]
         print(
             "Closest cluster:",
             max_sim,
@@ -320,5 +578,5 @@ class Daemon:
 
         for m in best_cluster.messages:
             if m.issue == issue_name:
-                return cast(int, m.message_id)
+                return m.message_id
         return None
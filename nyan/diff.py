@@ -0,0 +1,152 @@
+import os
+import json
+import hashlib
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Any, Optional, Sequence, Set
+
+from jinja2 import Template
+
+from nyan.clusters import Cluster
+from nyan.document import Document
+from nyan.mongo import get_diffs_collection
+from nyan.openai import openai_completion
+from nyan.records import FileRecordStorage, MongoRecordStorage, RecordStore
+from nyan.util import Serializable, get_current_ts
+
+
+BASE_DIR = Path(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_PROMPT_PATH = str(BASE_DIR / "prompts/diff.txt")
+
+
+def calc_diff_key(docs: Sequence[Document]) -> str:
+    parts = sorted("{}\t{}".format(doc.url, doc.patched_text) for doc in docs)
+    return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+
+
+@dataclass
+class DiffRecord(Serializable):
+    key: str
+    diff: List[Dict[str, Any]] = field(default_factory=list)
+    create_time: int = 0
+
+
+class DiffCache(RecordStore[DiffRecord]):
+    """Diffs keyed by the set of cluster documents, see calc_diff_key."""
+
+    def get(self, key: str) -> Optional[List[Dict[str, Any]]]:
+        record = self.get_record(key)
+        return record.diff if record is not None else None
+
+
+class FileDiffCache(DiffCache):
+    def __init__(self, path: str) -> None:
+        super().__init__(FileRecordStorage(path, DiffRecord.fromdict))
+
+
+class MongoDiffCache(DiffCache):
+    def __init__(self, mongo_config_path: str) -> None:
+        collection = get_diffs_collection(mongo_config_path)
+        super().__init__(MongoRecordStorage(collection, DiffRecord.fromdict, ("key",)))
+
+
+class DiffGenerator:
+    """Generates cluster diffs with a language model in background threads.
+
+    request() schedules a job for the current documents of a cluster,
+    apply() sets a ready diff to the cluster. Neither of them waits for the model.
+    Failed requests are not cached and are retried on the next request().
+    """
+
+    def __init__(
+        self,
+        cache: DiffCache,
+        model_name: str = "gpt-4o",
+        max_workers: int = 2,
+        timeout: float = 60.0,
+        prompt_path: str = DEFAULT_PROMPT_PATH,
+    ) -> None:
+        self.cache = cache
+        self.model_name = model_name
+        self.timeout = timeout
+        with open(prompt_path) as f:
+            self.template = Template(f.read())
+
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="diff"
+        )
+        self.pending: Set[str] = set()
+        self.lock = threading.Lock()
+
+    def request(self, cluster: Cluster) -> bool:
+        key = calc_diff_key(cluster.docs)
+        if key in self.cache:
+            return False
+        with self.lock:
+            if key in self.pending:
+                return False
+            self.pending.add(key)
+        docs = list(cluster.docs)
+        self.executor.submit(self._generate, key, docs, cluster.annotation_doc)
+        return True
+
+    def apply(self, cluster: Cluster) -> bool:
+        diff = self.cache.get(calc_diff_key(cluster.docs))
+        if diff is None or diff == cluster.saved_diff:
+            return False
+        cluster.saved_diff = diff
+        if cluster.collection is not None:
+            cluster.collection.mark_dirty(cluster)
+        return True
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=True)
+
+    def _generate(
+        self, key: str, docs: List[Document], annotation_doc: Document
+    ) -> None:
+        try:
+            diff = self._complete(docs, annotation_doc)
+            record = DiffRecord(key=key, diff=diff, create_time=get_current_ts())
+            self.cache.add(record)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            with self.lock:
+                self.pending.discard(key)
+
+    def _complete(
+        self, docs: List[Document], annotation_doc: Document
+    ) -> List[Dict[str, Any]]:
+        if len({doc.channel_id for doc in docs}) < 2:
+            return []
+
+        prompt = self.template.render(docs=docs, annotation_doc=annotation_doc)
+        messages = [{"role": "user", "content": prompt}]
+        content = openai_completion(
+            messages=messages,
+            model_name=self.model_name,
+            request_timeout=self.timeout,
+        )
+        content = content[content.find("{") : content.rfind("}") + 1]
+        try:
+            parsed_content: Dict[str, List[Dict[str, Any]]] = json.loads(content)
+            differences = parsed_content["differences"]
+        except (ValueError, KeyError):
+            print("Bad diff answer: {}".format(content))
+            return []
+
+        channel_titles = {doc.channel_id: doc.channel_title for doc in docs}
+        doc_urls = {doc.channel_id: doc.url for doc in docs}
+        for diff in differences:
+            ids = diff["channel_ids"][:3]
+            ids = [i for i in ids if i in channel_titles and i in doc_urls]
+            channels = [
+                '<a href="{}">{}</a>'.format(doc_urls[i], channel_titles[i])
+                for i in ids
+            ]
+            diff["channels"] = ", ".join(channels)
+        return differences
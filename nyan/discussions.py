@@ -0,0 +1,62 @@
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from nyan.mongo import get_discussions_collection
+from nyan.records import FileRecordStorage, MongoRecordStorage, RecordStorage
+from nyan.records import RecordStore
+from nyan.util import Serializable
+
+
+@dataclass
+class DiscussionRecord(Serializable):
+    issue: str
+    message_id: int
+    discussion_message_id: int
+    create_time: int = 0
+
+    @property
+    def key(self) -> Tuple[str, int]:
+        return (self.issue, self.message_id)
+
+
+class DiscussionsStore(RecordStore[DiscussionRecord]):
+    """Persistent channel message -> discussion message mapping.
+
+    Records are buffered by add() and written in one batch by flush().
+    """
+
+    def __init__(
+        self, storage: Optional[RecordStorage[DiscussionRecord]] = None
+    ) -> None:
+        super().__init__(storage)
+        self.pending: List[DiscussionRecord] = []
+
+    def add(self, record: DiscussionRecord) -> None:
+        with self.lock:
+            self.pending.append(record)
+
+    def flush(self) -> int:
+        with self.lock:
+            records, self.pending = self.pending, []
+            for record in records:
+                self.key2record[record.key] = record
+            if records:
+                self.storage.write(records)
+        return len(records)
+
+
+class MongoDiscussionsStore(DiscussionsStore):
+    def __init__(self, mongo_config_path: str) -> None:
+        collection = get_discussions_collection(mongo_config_path)
+        super().__init__(
+            MongoRecordStorage(
+                collection, DiscussionRecord.fromdict, ("issue", "message_id")
+            )
+        )
+
+
+class FileDiscussionsStore(DiscussionsStore):
+    def __init__(self, path: str, compaction_ratio: float = 2.0) -> None:
+        super().__init__(
+            FileRecordStorage(path, DiscussionRecord.fromdict, compaction_ratio)
+        )
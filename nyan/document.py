@@ -1,4 +1,5 @@
 import os
+import json
 from typing import List, Tuple, Dict, Any, Optional, Sequence
 from dataclasses import dataclass, field
 from datetime import datetime
@@ -91,6 +92,74 @@ def read_documents_file(
     return docs
 
 
+class DocumentSegments:
+    """Tails a directory of JSONL segments written by the crawler.
+
+    Only lines appended since the previous call are parsed. Later records
+    replace earlier ones with the same url, old documents are forgotten.
+    Segments with only old documents are removed, except the last one
+    that can still be written to.
+    """
+
+    def __init__(self, dir_path: str) -> None:
+        self.dir_path = dir_path
+        self.offsets: Dict[str, int] = dict()
+        # url -> (pub_time, line), documents are created anew on every read
+        self.url2record: Dict[str, Tuple[int, str]] = dict()
+        self.max_pub_times: Dict[str, int] = dict()
+
+    def read(
+        self, current_ts: Optional[int] = None, offset: Optional[int] = None
+    ) -> List[Document]:
+        min_time = current_ts - offset if current_ts and offset else 0
+        file_names = sorted(
+            f for f in os.listdir(self.dir_path) if f.endswith(".jsonl")
+        )
+        for file_name in file_names:
+            self._read_segment(file_name)
+
+        old_file_names = [
+            f for f in file_names[:-1] if self.max_pub_times.get(f, 0) < min_time
+        ]
+        for file_name in old_file_names:
+            os.remove(os.path.join(self.dir_path, file_name))
+        if old_file_names:
+            print("{} old segments removed".format(len(old_file_names)))
+        file_names = [f for f in file_names if f not in old_file_names]
+        self.offsets = {f: o for f, o in self.offsets.items() if f in file_names}
+        self.max_pub_times = {
+            f: t for f, t in self.max_pub_times.items() if f in file_names
+        }
+
+        self.url2record = {
+            url: record
+            for url, record in self.url2record.items()
+            if record[0] >= min_time
+        }
+        return [Document.deserialize(line) for _, line in self.url2record.values()]
+
+    def _read_segment(self, file_name: str) -> None:
+        file_path = os.path.join(self.dir_path, file_name)
+        start = self.offsets.get(file_name, 0)
+        if os.path.getsize(file_path) < start:
+            start = 0
+            self.max_pub_times.pop(file_name, None)
+        with open(file_path, "rb") as r:
+            r.seek(start)
+            data = r.read()
+        # The last line can still be being written
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].decode("utf-8").split("\n"):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            pub_time = record["pub_time"]
+            self.url2record[record["url"]] = (pub_time, line)
+            max_pub_time = self.max_pub_times.get(file_name, 0)
+            self.max_pub_times[file_name] = max(max_pub_time, pub_time)
+        self.offsets[file_name] = start + end
+
+
 def read_documents_mongo(
     mongo_config_path: str, current_ts: int, offset: int
 ) -> List[Document]:
@@ -0,0 +1,49 @@
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+from nyan.mongo import get_media_collection
+from nyan.records import FileRecordStorage, MongoRecordStorage, RecordStore
+from nyan.util import Serializable
+
+
+@dataclass
+class MediaRecord(Serializable):
+    # Telegram file ids are valid only for the bot that received them
+    bot_id: str
+    url: str
+    file_id: str
+    create_time: int = 0
+
+    @property
+    def key(self) -> Tuple[str, str]:
+        return (self.bot_id, self.url)
+
+
+class MediaCache(RecordStore[MediaRecord]):
+    """Telegram file ids of already uploaded media by source URLs."""
+
+    def get(self, bot_id: str, url: str) -> Optional[str]:
+        record = self.get_record((bot_id, url))
+        return record.file_id if record is not None else None
+
+    def add(self, record: MediaRecord) -> None:
+        old_record = self.get_record(record.key)
+        if old_record is not None and old_record.file_id == record.file_id:
+            return
+        super().add(record)
+
+    def remove(self, bot_id: str, url: str) -> None:  # type: ignore[override]
+        super().remove((bot_id, url))
+
+
+class FileMediaCache(MediaCache):
+    def __init__(self, path: str) -> None:
+        super().__init__(FileRecordStorage(path, MediaRecord.fromdict))
+
+
+class MongoMediaCache(MediaCache):
+    def __init__(self, mongo_config_path: str) -> None:
+        collection = get_media_collection(mongo_config_path)
+        super().__init__(
+            MongoRecordStorage(collection, MediaRecord.fromdict, ("bot_id", "url"))
+        )
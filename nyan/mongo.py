@@ -55,3 +55,26 @@ def get_topics_collection(mongo_config_path: str) -> Collection[Dict[str, Any]]:
     database = get_database(mongo_config)
     topics_collection_name = mongo_config.get("topics_collection_name", "topics")
     return database[topics_collection_name]
+
+
+def get_discussions_collection(mongo_config_path: str) -> Collection[Dict[str, Any]]:
+    mongo_config = read_config(mongo_config_path)
+    database = get_database(mongo_config)
+    discussions_collection_name = mongo_config.get(
+        "discussions_collection_name", "discussions"
+    )
+    return database[discussions_collection_name]
+
+
+def get_diffs_collection(mongo_config_path: str) -> Collection[Dict[str, Any]]:
+    mongo_config = read_config(mongo_config_path)
+    database = get_database(mongo_config)
+    diffs_collection_name = mongo_config.get("diffs_collection_name", "diffs")
+    return database[diffs_collection_name]
+
+
+def get_media_collection(mongo_config_path: str) -> Collection[Dict[str, Any]]:
+    mongo_config = read_config(mongo_config_path)
+    database = get_database(mongo_config)
+    media_collection_name = mongo_config.get("media_collection_name", "media")
+    return database[media_collection_name]
@@ -1,11 +1,21 @@
+import os
+import json
+import time
+import random
+import asyncio
+import hashlib
 import logging
-from dataclasses import dataclass
-from typing import Optional, Sequence, List, Dict, Any, cast
-from multiprocessing.pool import ThreadPool
+import threading
+from collections import deque
+from dataclasses import dataclass, asdict
+from typing import Optional, Sequence, List, Dict, Any, Tuple, Union, cast
+from typing import AsyncIterator, Deque, Set
 
 import openai
 import copy
 
+from nyan.util import get_current_ts
+
 
 @dataclass
 class OpenAIDecodingArguments:
@@ -22,18 +32,124 @@ class OpenAIDecodingArguments:
 DEFAULT_ARGS = OpenAIDecodingArguments()
 
 
+class CompletionNotFoundError(Exception):
+    pass
+
+
+def get_completion_key(
+    messages: List[Dict[str, Any]],
+    decoding_args: OpenAIDecodingArguments,
+    model_name: str,
+) -> str:
+    data = {
+        "messages": messages,
+        "model_name": model_name,
+        "decoding_args": asdict(decoding_args),
+    }
+    dump = json.dumps(data, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(dump.encode("utf-8")).hexdigest()
+
+
+class CompletionCache:
+    def __init__(self, ttl: Optional[int] = None) -> None:
+        self.ttl = ttl
+
+    def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError()
+
+    def set(self, key: str, content: str) -> None:  # noqa: A003
+        raise NotImplementedError()
+
+    def is_expired(self, create_time: int) -> bool:
+        if self.ttl is None:
+            return False
+        return get_current_ts() - create_time > self.ttl
+
+
+class FileCompletionCache(CompletionCache):
+    """One JSON file per completion, named by the completion key."""
+
+    def __init__(self, directory: str, ttl: Optional[int] = None) -> None:
+        super().__init__(ttl)
+        self.directory = directory
+
+    def get(self, key: str) -> Optional[str]:
+        path = self._get_path(key)
+        if not os.path.exists(path):
+            return None
+        with open(path) as r:
+            record = json.load(r)
+        if self.is_expired(record["create_time"]):
+            return None
+        return cast(str, record["content"])
+
+    def set(self, key: str, content: str) -> None:  # noqa: A003
+        path = self._get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        record = {"content": content, "create_time": get_current_ts()}
+        temp_path = path + ".new"
+        with open(temp_path, "w") as w:
+            json.dump(record, w, ensure_ascii=False)
+        os.replace(temp_path, path)
+
+    def _get_path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+
+def get_env_completion_cache() -> Optional[CompletionCache]:
+    directory = os.getenv("NYAN_LLM_CACHE_DIR")
+    if not directory:
+        return None
+    ttl = os.getenv("NYAN_LLM_CACHE_TTL")
+    return FileCompletionCache(directory, ttl=int(ttl) if ttl else None)
+
+
+COMPLETION_CACHE = get_env_completion_cache()
+
+# "openai" calls the API, "replay" only returns completions from the cache
+LLM_BACKEND = os.getenv("NYAN_LLM_BACKEND", "openai")
+
+
+def set_completion_cache(cache: Optional[CompletionCache]) -> None:
+    global COMPLETION_CACHE
+    COMPLETION_CACHE = cache
+
+
+def set_llm_backend(backend: str) -> None:
+    assert backend in ("openai", "replay")
+    global LLM_BACKEND
+    LLM_BACKEND = backend
+
+
 def openai_completion(
     messages: List[Dict[str, Any]],
     decoding_args: OpenAIDecodingArguments = DEFAULT_ARGS,
     model_name: str = "gpt-4",
     sleep_time: int = 2,
+    request_timeout: Optional[float] = None,
 ) -> str:
     decoding_args = copy.deepcopy(decoding_args)
     assert decoding_args.n == 1
+
+    cache = COMPLETION_CACHE
+    key = get_completion_key(messages, decoding_args, model_name)
+    if cache is not None:
+        content = cache.get(key)
+        if content is not None:
+            return content
+    if LLM_BACKEND == "replay":
+        raise CompletionNotFoundError("No recorded completion for key " + key)
+
+    extra_args: Dict[str, Any] = dict()
+    if request_timeout is not None:
+        extra_args["request_timeout"] = request_timeout
     while True:
         try:
             completions = openai.ChatCompletion.create(  # type: ignore
-                messages=messages, model=model_name, **decoding_args.__dict__
+                messages=messages,
+                model=model_name,
+                **decoding_args.__dict__,
+                **extra_args,
             )
             break
         except Exception as e:
@@ -46,7 +162,243 @@ def openai_completion(
                 )
             else:
                 raise e
-    return cast(str, completions.choices[0].message.content.strip())
+    content = cast(str, completions.choices[0].message.content.strip())
+    if cache is not None:
+        cache.set(key, content)
+    return content
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    if type(error).__name__ == "RateLimitError":
+        return True
+    return "Rate limit" in str(error) or "rate limit" in str(error)
+
+
+def estimate_tokens(
+    messages: List[Dict[str, Any]], decoding_args: OpenAIDecodingArguments
+) -> int:
+    # Rough upper bound without a tokenizer, Cyrillic text is ~3 chars per token
+    chars_count = sum(len(str(m.get("content", ""))) for m in messages)
+    return chars_count // 3 + decoding_args.max_tokens
+
+
+class RateLimiter:
+    """Requests and tokens budgets over a sliding one-minute window."""
+
+    def __init__(
+        self,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+    ) -> None:
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.events: Deque[Tuple[float, int]] = deque()
+        self.tokens_count = 0
+        # Shared by event loops of different threads
+        self.lock = threading.Lock()
+
+    async def acquire(self, tokens: int) -> None:
+        while True:
+            delay = self.try_acquire(tokens)
+            if delay is None:
+                return
+            await asyncio.sleep(delay)
+
+    def try_acquire(self, tokens: int) -> Optional[float]:
+        # Returns None if the request fits, otherwise seconds to wait
+        if self.tokens_per_minute is not None:
+            tokens = min(tokens, self.tokens_per_minute)
+        with self.lock:
+            now = time.monotonic()
+            while self.events and now - self.events[0][0] >= 60.0:
+                _, event_tokens = self.events.popleft()
+                self.tokens_count -= event_tokens
+
+            fits_requests = (
+                self.requests_per_minute is None
+                or len(self.events) < self.requests_per_minute
+            )
+            fits_tokens = (
+                self.tokens_per_minute is None
+                or self.tokens_count + tokens <= self.tokens_per_minute
+            )
+            if fits_requests and fits_tokens:
+                self.events.append((now, tokens))
+                self.tokens_count += tokens
+                return None
+            return 60.0 - (now - self.events[0][0])
+
+
+class CompletionLimits:
+    """Concurrency and rate budgets shared by all completion pools.
+
+    The state is guarded by thread locks instead of asyncio primitives,
+    so pools running in different threads and event loops share it.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 8,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+        poll_interval: float = 0.05,
+    ) -> None:
+        self.max_concurrency = max_concurrency
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.poll_interval = poll_interval
+        self.active_count = 0
+        self.lock = threading.Lock()
+
+    async def acquire(self, tokens: int) -> None:
+        while not self._try_enter():
+            await asyncio.sleep(self.poll_interval)
+        try:
+            await self.rate_limiter.acquire(tokens)
+        except BaseException:
+            self.release()
+            raise
+
+    def release(self) -> None:
+        with self.lock:
+            self.active_count -= 1
+
+    def _try_enter(self) -> bool:
+        with self.lock:
+            if self.active_count >= self.max_concurrency:
+                return False
+            self.active_count += 1
+            return True
+
+
+def get_env_completion_limits() -> CompletionLimits:
+    requests_per_minute = os.getenv("NYAN_LLM_REQUESTS_PER_MINUTE")
+    tokens_per_minute = os.getenv("NYAN_LLM_TOKENS_PER_MINUTE")
+    return CompletionLimits(
+        max_concurrency=int(os.getenv("NYAN_LLM_MAX_CONCURRENCY", "8")),
+        requests_per_minute=int(requests_per_minute) if requests_per_minute else None,
+        tokens_per_minute=int(tokens_per_minute) if tokens_per_minute else None,
+    )
+
+
+COMPLETION_LIMITS = get_env_completion_limits()
+
+
+def set_completion_limits(limits: CompletionLimits) -> None:
+    global COMPLETION_LIMITS
+    COMPLETION_LIMITS = limits
+
+
+class AsyncCompletionPool:
+    """Completions within the process-wide limits, see COMPLETION_LIMITS."""
+
+    def __init__(
+        self,
+        decoding_args: OpenAIDecodingArguments = DEFAULT_ARGS,
+        model_name: str = "gpt-4",
+        max_retries: int = 8,
+        initial_backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        limits: Optional[CompletionLimits] = None,
+    ) -> None:
+        self.decoding_args = decoding_args
+        self.model_name = model_name
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        # Pools share the module limits unless others are injected
+        self.saved_limits = limits
+
+    @property
+    def limits(self) -> CompletionLimits:
+        if self.saved_limits is not None:
+            return self.saved_limits
+        return COMPLETION_LIMITS
+
+    async def complete(self, messages: List[Dict[str, Any]]) -> str:
+        decoding_args = copy.deepcopy(self.decoding_args)
+        assert decoding_args.n == 1
+
+        cache = COMPLETION_CACHE
+        key = get_completion_key(messages, decoding_args, self.model_name)
+        if cache is not None:
+            content = cache.get(key)
+            if content is not None:
+                return content
+        if LLM_BACKEND == "replay":
+            raise CompletionNotFoundError("No recorded completion for key " + key)
+
+        limits = self.limits
+        backoff = self.initial_backoff
+        tokens = estimate_tokens(messages, decoding_args)
+        for attempt in range(self.max_retries + 1):
+            try:
+                await limits.acquire(tokens)
+                try:
+                    completions = await openai.ChatCompletion.acreate(  # type: ignore
+                        messages=messages,
+                        model=self.model_name,
+                        **decoding_args.__dict__,
+                    )
+                finally:
+                    limits.release()
+                break
+            except Exception as e:
+                if is_rate_limit_error(e) and attempt < self.max_retries:
+                    delay = min(backoff, self.max_backoff) * (1.0 + random.random())
+                    logging.warning("OpenAI rate limit, retrying in %.1fs", delay)
+                    await asyncio.sleep(delay)
+                    backoff *= 2
+                    continue
+                logging.warning("OpenAI error: %s.", e)
+                if "Please reduce" in str(e) and attempt < self.max_retries:
+                    decoding_args.max_tokens = int(decoding_args.max_tokens * 0.8)
+                    continue
+                raise e
+
+        content = cast(str, completions.choices[0].message.content.strip())
+        if cache is not None:
+            cache.set(key, content)
+        return content
+
+    async def stream(
+        self,
+        batch: List[List[Dict[str, Any]]],
+        return_exceptions: bool = False,
+        max_pending: Optional[int] = None,
+    ) -> AsyncIterator[Tuple[int, Union[str, Exception]]]:
+        """Yields (index, completion) pairs in the order of completion.
+
+        At most max_pending tasks exist at a time, by default as many
+        as the limits allow to run concurrently.
+        """
+        if max_pending is None:
+            max_pending = self.limits.max_concurrency
+
+        async def complete_indexed(
+            index: int, messages: List[Dict[str, Any]]
+        ) -> Tuple[int, Union[str, Exception]]:
+            try:
+                return index, await self.complete(messages)
+            except Exception as e:
+                if not return_exceptions:
+                    raise e
+                return index, e
+
+        pending: Set["asyncio.Future[Tuple[int, Union[str, Exception]]]"] = set()
+        try:
+            for index, messages in enumerate(batch):
+                if len(pending) >= max_pending:
+                    done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for future in done:
+                        yield future.result()
+                pending.add(asyncio.ensure_future(complete_indexed(index, messages)))
+            for future in asyncio.as_completed(pending):
+                yield await future
+        finally:
+            for task in pending:
+                task.cancel()
 
 
 def openai_batch_completion(
@@ -55,12 +407,13 @@ def openai_batch_completion(
     model_name: str = "gpt-4",
     sleep_time: int = 2,
 ) -> List[str]:
-    completions = []
-    with ThreadPool(len(batch)) as pool:
-        results = pool.starmap(
-            openai_completion,
-            [(messages, decoding_args, model_name, sleep_time) for messages in batch],
-        )
-        for result in results:
-            completions.append(result)
-    return completions
+    # Concurrent calls share COMPLETION_LIMITS, the pool itself has no limits
+    pool = AsyncCompletionPool(decoding_args=decoding_args, model_name=model_name)
+
+    async def run() -> List[str]:
+        completions: List[str] = [""] * len(batch)
+        async for index, result in pool.stream(batch):
+            completions[index] = cast(str, result)
+        return completions
+
+    return asyncio.run(run())
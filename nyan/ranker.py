@@ -1,11 +1,73 @@
 import json
 import os
-from typing import List, Dict
+from typing import List, Dict, Sequence
 from collections import defaultdict
+from dataclasses import dataclass
+
+import numpy as np
+from numpy.typing import NDArray
 
 from nyan.clusters import Cluster
 
 
+GROUPS = ("purple", "blue", "red")
+
+
+@dataclass
+class ClusterFeatures:
+    """Ranking features of all clusters of an iteration, one row per cluster."""
+
+    channels_count: NDArray[np.int64]
+    has_ru: NDArray[np.bool_]
+    age: NDArray[np.int64]
+    views_per_hour: NDArray[np.int64]
+    pub_time_percentile: NDArray[np.int64]
+    # Index in GROUPS
+    group: NDArray[np.int64]
+    # Bit i is set if the cluster belongs to issue_names[i]
+    issues: NDArray[np.int64]
+
+    @classmethod
+    def build(
+        cls, clusters: Sequence[Cluster], issue_names: Sequence[str]
+    ) -> "ClusterFeatures":
+        assert len(issue_names) < 64
+        issue_bits = {name: 1 << i for i, name in enumerate(issue_names)}
+        group_indices = {group: i for i, group in enumerate(GROUPS)}
+
+        n = len(clusters)
+        channels_count = np.zeros(n, dtype=np.int64)
+        has_ru = np.zeros(n, dtype=np.bool_)
+        fetch_time = np.zeros(n, dtype=np.int64)
+        pub_time_percentile = np.zeros(n, dtype=np.int64)
+        debiased_views = np.zeros(n, dtype=np.int64)
+        group = np.zeros(n, dtype=np.int64)
+        issues = np.zeros(n, dtype=np.int64)
+        for i, cluster in enumerate(clusters):
+            stats = cluster.stats
+            channels_count[i] = len(stats.channels)
+            has_ru[i] = "ru" in stats.languages
+            fetch_time[i] = stats.fetch_time
+            pub_time_percentile[i] = stats.pub_time_percentile
+            debiased_views[i] = stats.debiased_views
+            group[i] = group_indices.get(stats.group, 0)
+            issues[i] = sum(issue_bits.get(issue, 0) for issue in cluster.issues)
+
+        age = fetch_time - pub_time_percentile
+        # Same as Cluster.views_per_hour, but without failing on zero age
+        hours = np.where(age == 0, 1, age) / 3600
+        views_per_hour = (debiased_views / hours).astype(np.int64)
+        return cls(
+            channels_count=channels_count,
+            has_ru=has_ru,
+            age=age,
+            views_per_hour=views_per_hour,
+            pub_time_percentile=pub_time_percentile,
+            group=group,
+            issues=issues,
+        )
+
+
 class Ranker:
     def __init__(self, config_path: str) -> None:
         assert os.path.exists(config_path)
@@ -13,114 +75,105 @@ class Ranker:
             self.config = json.load(r)
 
     def __call__(self, all_clusters: List[Cluster]) -> Dict[str, List[Cluster]]:
-        issues = defaultdict(list)
-        for cluster in all_clusters:
-            for issue in cluster.issues:
-                issues[issue].append(cluster)
+        issue_configs = self.config["issues"]
+        issue_names = [issue_config["issue_name"] for issue_config in issue_configs]
+        features = ClusterFeatures.build(all_clusters, issue_names)
 
         final_clusters = defaultdict(list)
-        for issue_config in self.config["issues"]:
+        for issue_bit, issue_config in enumerate(issue_configs):
             issue_name = issue_config["issue_name"]
             min_channels = issue_config["min_channels"]
             max_age_minutes = issue_config["max_age_minutes"]
 
-            clusters = issues[issue_name]
-            filtered_clusters = []
-            for cluster in clusters:
-                unique_channels = {d.channel_id for d in cluster.docs}
-                is_big_cluster = len(unique_channels) >= min_channels
-                has_ru_doc = any(doc.language == "ru" for doc in cluster.docs)
-                is_fresh = cluster.age < max_age_minutes * 60
-                if is_big_cluster and has_ru_doc and is_fresh:
-                    filtered_clusters.append(cluster)
-            clusters = filtered_clusters
+            mask = (features.issues >> issue_bit) & 1 == 1
+            mask &= features.channels_count >= min_channels
+            mask &= features.has_ru
+            mask &= features.age < max_age_minutes * 60
+            indices = np.flatnonzero(mask)
 
             print()
-            print(f"Issue: {issue_name}, clusters after first filter: {len(clusters)}")
+            print(f"Issue: {issue_name}, clusters after first filter: {len(indices)}")
 
-            if len(clusters) <= 3:
-                final_clusters[issue_name].extend(clusters)
-                for cluster in clusters:
+            if len(indices) <= 3:
+                for index in indices:
+                    cluster = all_clusters[index]
+                    final_clusters[issue_name].append(cluster)
                     print(
                         "Added as no other clusters: {} {}".format(
-                            cluster.views_per_hour, cluster.cropped_title
+                            features.views_per_hour[index], cluster.cropped_title
                         )
                     )
                 continue
 
-            clusters = self.filter_by_views(
-                clusters,
+            indices = self.filter_by_views(
+                all_clusters,
+                features,
+                indices,
                 issue_name,
                 issue_config["views_percentile"],
                 issue_config["higher_views_percentile"],
                 issue_config["higher_trigger_age_minutes"],
             )
-            clusters.sort(key=lambda c: c.pub_time_percentile)
-            clusters = clusters[-10:]
-            final_clusters[issue_name].extend(clusters)
+            order = np.argsort(features.pub_time_percentile[indices], kind="stable")
+            indices = indices[order][-10:]
+            final_clusters[issue_name].extend(all_clusters[i] for i in indices)
         print()
         return final_clusters
 
     def filter_by_views(
         self,
         clusters: List[Cluster],
+        features: ClusterFeatures,
+        indices: NDArray[np.int64],
         issue_name: str,
         views_percentile: int,
         higher_views_percentile: int,
         higher_trigger_age_minutes: int,
-    ) -> List[Cluster]:
-        all_views_per_hour = [cluster.views_per_hour for cluster in clusters]
+    ) -> NDArray[np.int64]:
+        views_per_hour = features.views_per_hour[indices]
+        groups = features.group[indices]
+        ages = features.age[indices]
 
-        coefs = {"blue": 1.0, "red": 1.0, "purple": 1.0}
+        coefs = np.ones(len(GROUPS), dtype=np.float64)
         if issue_name == "main":
-            blue_views, red_views = 0, 0
-            for cluster in clusters:
-                group = cluster.group
-                views = cluster.views_per_hour
-                if group == "blue":
-                    blue_views += views
-                if group == "red":
-                    red_views += views
+            group_views = np.bincount(groups, weights=views_per_hour, minlength=3)
+            blue_views = int(group_views[GROUPS.index("blue")])
+            red_views = int(group_views[GROUPS.index("red")])
             max_views = max(blue_views, red_views)
-            coefs = {
-                "blue": (max_views / blue_views) if blue_views != 0 else 1.0,
-                "red": (max_views / red_views) if red_views != 0 else 1.0,
-                "purple": 1.0,
-            }
-            print("Blue views coefficient:", coefs["blue"])
-            print("Red views coefficient:", coefs["red"])
-
-        all_views_per_hour = [
-            int(v * coefs[c.group]) for v, c in zip(all_views_per_hour, clusters)
-        ]
-        all_views_per_hour.sort()
-        n = len(all_views_per_hour)
+            if blue_views != 0:
+                coefs[GROUPS.index("blue")] = max_views / blue_views
+            if red_views != 0:
+                coefs[GROUPS.index("red")] = max_views / red_views
+            print("Blue views coefficient:", coefs[GROUPS.index("blue")])
+            print("Red views coefficient:", coefs[GROUPS.index("red")])
 
+        views_per_hour = (views_per_hour * coefs[groups]).astype(np.int64)
+        n = len(views_per_hour)
         border_index = max(0, min(n - 1, n * views_percentile // 100))
-        border_views_per_hour = all_views_per_hour[border_index]
-        print("Views border:", border_views_per_hour)
-
         higher_border_index = max(0, min(n - 1, n * higher_views_percentile // 100))
-        higher_border_views_per_hour = all_views_per_hour[higher_border_index]
+        borders = np.partition(views_per_hour, [border_index, higher_border_index])
+
+        border_views_per_hour = borders[border_index]
+        print("Views border:", border_views_per_hour)
+        higher_border_views_per_hour = borders[higher_border_index]
         print("Higher views border:", higher_border_views_per_hour)
 
         hta = higher_trigger_age_minutes * 60
-        filtered_clusters = []
-        for cluster in clusters:
-            views_per_hour = int(cluster.views_per_hour * coefs[cluster.group])
+        is_added = (ages > hta) & (views_per_hour >= border_views_per_hour)
+        is_important = ~is_added & (ages < hta)
+        is_important &= views_per_hour >= higher_border_views_per_hour
+
+        for index, views, added, important in zip(
+            indices, views_per_hour, is_added, is_important
+        ):
+            cluster = clusters[index]
             cropped_title = cluster.cropped_title
-            age = cluster.age
-            if age > hta and views_per_hour >= border_views_per_hour:
-                filtered_clusters.append(cluster)
-                print("Added by views: {} {}".format(views_per_hour, cropped_title))
-            elif age < hta and views_per_hour >= higher_border_views_per_hour:
+            if added:
+                print("Added by views: {} {}".format(views, cropped_title))
+            elif important:
                 cluster.is_important = True
-                filtered_clusters.append(cluster)
-                print(
-                    "Added by views (important): {} {}".format(
-                        views_per_hour, cropped_title
-                    )
-                )
+                print("Added by views (important): {} {}".format(views, cropped_title))
             elif not cluster.messages:
-                print("Skipped by views: {} {}".format(views_per_hour, cropped_title))
-        return filtered_clusters
+                print("Skipped by views: {} {}".format(views, cropped_title))
+        filtered_indices: NDArray[np.int64] = indices[is_added | is_important]
+        return filtered_indices
@@ -0,0 +1,198 @@
+import os
+import json
+import shutil
+import threading
+from typing import Any, Callable, Dict, Generic, Hashable, List, Optional, Sequence
+from typing import Protocol, TypeVar
+
+from pymongo import ReplaceOne
+from pymongo.collection import Collection
+
+
+class KeyedRecord(Protocol):
+    create_time: int
+
+    @property
+    def key(self) -> Hashable:
+        ...
+
+    def asdict(self) -> Dict[str, Any]:
+        ...
+
+    def serialize(self) -> str:
+        ...
+
+
+R = TypeVar("R", bound=KeyedRecord)
+
+
+class RecordStorage(Generic[R]):
+    """Persistence of a RecordStore, the base one keeps nothing."""
+
+    def read(self, min_time: int) -> List[R]:
+        return []
+
+    def write(self, records: List[R]) -> None:
+        pass
+
+    def delete(self, record: R, records: List[R]) -> None:
+        pass
+
+    def prune(self, min_time: int, records: List[R]) -> None:
+        pass
+
+
+class FileRecordStorage(RecordStorage[R]):
+    """Append-only JSONL file, the last record of a key wins.
+
+    The file is rewritten without old and overwritten records on load
+    when it has compaction_ratio times more lines than fresh records,
+    and on every prune or delete.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        parse: Callable[[Dict[str, Any]], R],
+        compaction_ratio: float = 1.0,
+    ) -> None:
+        self.path = path
+        self.parse = parse
+        self.compaction_ratio = compaction_ratio
+
+    def read(self, min_time: int) -> List[R]:
+        if not os.path.exists(self.path):
+            return []
+        lines_count = 0
+        key2record: Dict[Hashable, R] = dict()
+        with open(self.path) as r:
+            for line in r:
+                if not line.strip():
+                    continue
+                lines_count += 1
+                record = self.parse(json.loads(line))
+                key2record[record.key] = record
+
+        records = [r for r in key2record.values() if r.create_time >= min_time]
+        if lines_count > self.compaction_ratio * len(records):
+            self._rewrite(records)
+        return records
+
+    def write(self, records: List[R]) -> None:
+        with open(self.path, "a") as w:
+            w.write("".join(r.serialize() + "\n" for r in records))
+            w.flush()
+            os.fsync(w.fileno())
+
+    def delete(self, record: R, records: List[R]) -> None:
+        self._rewrite(records)
+
+    def prune(self, min_time: int, records: List[R]) -> None:
+        self._rewrite(records)
+
+    def _rewrite(self, records: List[R]) -> None:
+        temp_path = self.path + ".new"
+        with open(temp_path, "w") as w:
+            for record in records:
+                w.write(record.serialize() + "\n")
+            w.flush()
+            os.fsync(w.fileno())
+        shutil.move(temp_path, self.path)
+
+
+class MongoRecordStorage(RecordStorage[R]):
+    """One document per key, identified by key_fields of the record."""
+
+    def __init__(
+        self,
+        collection: Collection[Dict[str, Any]],
+        parse: Callable[[Dict[str, Any]], R],
+        key_fields: Sequence[str],
+    ) -> None:
+        self.collection = collection
+        self.parse = parse
+        self.key_fields = key_fields
+        index_name = "_".join("{}_1".format(f) for f in key_fields)
+        indices = self.collection.index_information()
+        if index_name not in indices:
+            self.collection.create_index(
+                [(f, 1) for f in key_fields], name=index_name, unique=True
+            )
+
+    def read(self, min_time: int) -> List[R]:
+        records = self.collection.find({"create_time": {"$gte": min_time}})
+        return [self.parse(r) for r in records]
+
+    def write(self, records: List[R]) -> None:
+        if len(records) == 1:
+            record = records[0]
+            self.collection.replace_one(
+                self._get_filter(record), record.asdict(), upsert=True
+            )
+            return
+        requests = [
+            ReplaceOne(self._get_filter(r), r.asdict(), upsert=True) for r in records
+        ]
+        self.collection.bulk_write(requests, ordered=False)
+
+    def delete(self, record: R, records: List[R]) -> None:
+        self.collection.delete_one(self._get_filter(record))
+
+    def prune(self, min_time: int, records: List[R]) -> None:
+        self.collection.delete_many({"create_time": {"$lt": min_time}})
+
+    def _get_filter(self, record: R) -> Dict[str, Any]:
+        record_dict = record.asdict()
+        return {f: record_dict[f] for f in self.key_fields}
+
+
+class RecordStore(Generic[R]):
+    """Records by keys in memory, written through to a storage.
+
+    load() reads records not older than min_time, prune() drops older ones
+    both from memory and from the storage.
+    """
+
+    def __init__(self, storage: Optional[RecordStorage[R]] = None) -> None:
+        self.storage: RecordStorage[R] = storage or RecordStorage()
+        self.key2record: Dict[Hashable, R] = dict()
+        self.lock = threading.Lock()
+
+    def get_record(self, key: Hashable) -> Optional[R]:
+        with self.lock:
+            return self.key2record.get(key)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self.lock:
+            return key in self.key2record
+
+    def add(self, record: R) -> None:
+        with self.lock:
+            self.key2record[record.key] = record
+            self.storage.write([record])
+
+    def remove(self, key: Hashable) -> None:
+        with self.lock:
+            record = self.key2record.pop(key, None)
+            if record is not None:
+                self.storage.delete(record, list(self.key2record.values()))
+
+    def load(self, min_time: int = 0) -> List[R]:
+        records = [r for r in self.storage.read(min_time) if r.create_time >= min_time]
+        with self.lock:
+            for record in records:
+                self.key2record[record.key] = record
+        return records
+
+    def prune(self, min_time: int) -> int:
+        with self.lock:
+            old_keys = [
+                key
+                for key, record in self.key2record.items()
+                if record.create_time < min_time
+            ]
+            for key in old_keys:
+                self.key2record.pop(key)
+            if old_keys:
+                self.storage.prune(min_time, list(self.key2record.values()))
+        return len(old_keys)
@@ -1,8 +1,12 @@
-import copy
+import dataclasses
+import hashlib
 import os
 import json
+import threading
 from urllib.parse import urlsplit
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence
 
 from jinja2 import Environment, FileSystemLoader
 
@@ -12,6 +16,13 @@ from nyan.document import Document
 from nyan.util import ts_to_dt
 
 
+@dataclass
+class ChannelStyle:
+    group: str
+    emoji: Optional[str] = None
+    color: Optional[str] = None
+
+
 class Renderer:
     def __init__(self, config_path: str, channels: Channels) -> None:
         assert os.path.exists(config_path)
@@ -20,24 +31,76 @@ class Renderer:
 
         self.channels = channels
 
+        # issue -> channel -> style, channels are not changed after loading
+        self.issue2styles: Dict[str, Dict[str, ChannelStyle]] = defaultdict(dict)
+        for channel_id, channel in channels:
+            for issue, group in channel.groups.items():
+                style = ChannelStyle(group=group)
+                if channel.emojis:
+                    style.emoji = channel.emojis[issue]
+                if channel.colors:
+                    style.color = channel.colors[issue]
+                self.issue2styles[issue][channel_id] = style
+
         file_loader = FileSystemLoader(".")
         env = Environment(loader=file_loader)
         self.cluster_template = env.get_template(config["cluster_template"])
         self.tz_offset = config["tz_offset"]
         self.tz_name = config["tz_name"]
+        self.discussion_max_length: int = config.get("discussion_max_length", 4096)
+
+        # Rendered texts by cluster fingerprints, see calc_fingerprint
+        self.cache: OrderedDict[str, str] = OrderedDict()
+        self.cache_size: int = config.get("cache_size", 10000)
+        self.cache_lock = threading.Lock()
 
     def render_cluster(self, cluster: Cluster, issue_name: str) -> str:
+        fingerprint = self.calc_fingerprint(cluster, issue_name)
+        with self.cache_lock:
+            text = self.cache.get(fingerprint)
+            if text is not None:
+                self.cache.move_to_end(fingerprint)
+                return text
+
+        text = self._render_cluster(cluster, issue_name)
+        with self.cache_lock:
+            self.cache[fingerprint] = text
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return text
+
+    def calc_fingerprint(self, cluster: Cluster, issue_name: str) -> str:
+        # Everything the cluster template depends on
+        annotation_doc = cluster.annotation_doc
+        first_doc = cluster.first_doc
+        parts = [
+            issue_name,
+            self.views_to_str(cluster.views),
+            str(cluster.is_important),
+            annotation_doc.url,
+            annotation_doc.patched_text or "",
+            annotation_doc.channel_title,
+            first_doc.url,
+            str(first_doc.pub_time),
+            first_doc.channel_title,
+            json.dumps(cluster.diff, ensure_ascii=False, sort_keys=True),
+            json.dumps(self.get_external_link(cluster), sort_keys=True),
+        ]
+        parts.extend(doc.url for doc in cluster.docs)
+        return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+
+    def _render_cluster(self, cluster: Cluster, issue_name: str) -> str:
+        styles = self.issue2styles[issue_name]
         groups = defaultdict(list)
         emojis = dict()
         colors = dict()
         for doc in cluster.docs:
-            channel = self.channels[doc.channel_id]
-            group = channel.groups[issue_name]
-            groups[group].append(doc)
-            if channel.emojis:
-                emojis[group] = channel.emojis[issue_name]
-            if channel.colors:
-                colors[group] = channel.colors[issue_name]
+            style = styles[doc.channel_id]
+            groups[style.group].append(doc)
+            if style.emoji is not None:
+                emojis[style.group] = style.emoji
+            if style.color is not None:
+                colors[style.group] = style.color
 
         used_channels = set()
         for group_name, group_docs in groups.items():
@@ -51,15 +114,10 @@ class Renderer:
             groups[group_name] = filtered_group
 
         sorted_groups = sorted(groups.items(), key=lambda x: x[0])
-        first_doc = copy.deepcopy(cluster.first_doc)
-        first_doc.pub_time_dt = ts_to_dt(first_doc.pub_time, self.tz_offset)
-
-        external_link = None
-        if cluster.external_links:
-            external_link_url, el_cnt = cluster.external_links.most_common()[0]
-            external_link_host = urlsplit(external_link_url).netloc
-            if el_cnt >= 2:
-                external_link = {"url": external_link_url, "host": external_link_host}
+        first_doc = dataclasses.replace(
+            cluster.first_doc,
+            pub_time_dt=ts_to_dt(cluster.first_doc.pub_time, self.tz_offset),
+        )
 
         views = self.views_to_str(cluster.views)
         return self.cluster_template.render(
@@ -71,13 +129,39 @@ class Renderer:
             colors=colors,
             views=views,
             is_important=cluster.is_important,
-            external_link=external_link,
+            external_link=self.get_external_link(cluster),
             tz_name=self.tz_name,
         )
 
+    @staticmethod
+    def get_external_link(cluster: Cluster) -> Optional[Dict[str, str]]:
+        if not cluster.external_links:
+            return None
+        external_link_url, el_cnt = cluster.external_links.most_common()[0]
+        if el_cnt < 2:
+            return None
+        external_link_host = urlsplit(external_link_url).netloc
+        return {"url": external_link_url, "host": external_link_host}
+
     def render_discussion_message(self, doc: Document) -> str:
         return '<a href="{}">{}</a>'.format(doc.url, doc.channel_title)
 
+    def render_discussion_messages(self, docs: Sequence[Document]) -> List[str]:
+        # As few messages as possible, every link is rendered as before
+        messages: List[str] = []
+        lines: List[str] = []
+        length = 0
+        for doc in docs:
+            line = self.render_discussion_message(doc)
+            if lines and length + 1 + len(line) > self.discussion_max_length:
+                messages.append("\n".join(lines))
+                lines, length = [], 0
+            length += len(line) + bool(lines)
+            lines.append(line)
+        if lines:
+            messages.append("\n".join(lines))
+        return messages
+
     @staticmethod
     def views_to_str(views: int) -> str:
         if views >= 1000000:
@@ -1,7 +1,7 @@
-from typing import List
-from statistics import mean
+from typing import Any, Callable, List, Optional
 
-from scipy.spatial.distance import cosine  # type: ignore
+import numpy as np
+from numpy.typing import NDArray
 
 from nyan.document import Document
 
@@ -30,23 +30,49 @@ def filter_purple(doc: Document) -> bool:
     return doc.groups["main"] == "purple"
 
 
-def choose_title(docs: List[Document], issues: List[str]) -> Document:
+def calc_cosine_distances(docs: List[Document]) -> NDArray[np.float64]:
+    embeddings = np.array([doc.embedding for doc in docs], dtype=np.float64)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    embeddings /= np.where(norms > 0.0, norms, 1.0)
+    distances: NDArray[np.float64] = 1.0 - embeddings @ embeddings.T
+    np.fill_diagonal(distances, 0.0)
+    return distances
+
+
+def apply_filter(
+    docs: List[Document], mask: NDArray[np.bool_], flt: Callable[[Document], bool]
+) -> NDArray[np.bool_]:
+    filtered_mask = mask.copy()
+    for index in np.flatnonzero(mask):
+        filtered_mask[index] = flt(docs[index])
+    return filtered_mask
+
+
+def choose_title(
+    docs: List[Document],
+    issues: List[str],
+    distances: Optional[NDArray[np.floating[Any]]] = None,
+) -> Document:
     assert docs
 
-    avg_distances = dict()
-    for doc1 in docs:
-        distances = [cosine(doc1.embedding, doc2.embedding) for doc2 in docs]
-        avg_distances[doc1.url] = mean(distances)
+    # Cosine distances between doc embeddings, the clusterer saves them
+    n = len(docs)
+    if distances is None or distances.shape != (n, n):
+        distances = calc_cosine_distances(docs)
+    # Symmetric rounding, so that ties are broken by the order of docs
+    distances = (distances + distances.T) / 2
+    avg_distances = np.nan_to_num(distances.mean(axis=1), nan=np.inf)
 
+    mask = np.ones(n, dtype=np.bool_)
     hard_filters = (filter_ru_only, filter_not_obscene, filter_fresh)
     for flt in hard_filters:
-        filtered_docs = list(filter(flt, docs))
-        if filtered_docs:
-            docs = filtered_docs
+        filtered_mask = apply_filter(docs, mask, flt)
+        if filtered_mask.any():
+            mask = filtered_mask
 
     # Choosing documents specific for issues
     issue_filters = []
-    possible_issues = set(docs[0].groups.keys())
+    possible_issues = set(docs[int(np.argmax(mask))].groups.keys())
     for issue in issues:
         if issue == "main":
             continue
@@ -61,8 +87,8 @@ def choose_title(docs: List[Document], issues: List[str]) -> Document:
     for f in soft_filters:
         if not f:
             continue
-        filtered_docs = list(filter(f, docs))
-        if len(filtered_docs) >= 2:
-            docs = filtered_docs
+        filtered_mask = apply_filter(docs, mask, f)
+        if filtered_mask.sum() >= 2:
+            mask = filtered_mask
 
-    return min(docs, key=lambda x: avg_distances[x.url])
+    return docs[int(np.argmin(np.where(mask, avg_distances, np.inf)))]
@@ -1,5 +1,6 @@
 import os
 import json
+import hashlib
 import random
 from typing import TypeVar, List, Any, Iterable, Dict, Type
 from datetime import datetime, timezone, timedelta
@@ -30,6 +31,10 @@ def get_current_ts() -> int:
     return int(datetime.now().replace(tzinfo=timezone.utc).timestamp())
 
 
+def get_text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
 def ts_to_dt(timestamp: int, offset: int = 3) -> datetime:
     return datetime.fromtimestamp(timestamp, timezone(timedelta(hours=offset)))
 
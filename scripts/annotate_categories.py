@@ -1,12 +1,13 @@
 import argparse
+import asyncio
 import random
 import json
 
 from jinja2 import Template
 from tqdm import tqdm
 
-from nyan.util import read_jsonl, gen_batch, write_jsonl
-from nyan.openai import openai_batch_completion
+from nyan.util import read_jsonl
+from nyan.openai import AsyncCompletionPool, CompletionLimits, set_completion_limits
 
 
 def process_text(text, max_words: int = 100):
@@ -19,53 +20,69 @@ def process_text(text, max_words: int = 100):
     return " ".join(words)
 
 
-def annotate_categories(
+async def annotate_categories(
     documents,
     prompt_template,
-    model_name
+    pool
 ):
-    prompts = []
+    batch = []
     for document in tqdm(documents):
         text = document["patched_text"]
         text = process_text(text)
         prompt = prompt_template.render(text=text).strip() + "\n"
-        prompts.append(prompt)
+        batch.append([{"role": "user", "content": prompt}])
 
-    document_index = 0
-    for batch in tqdm(gen_batch(prompts, batch_size=1)):
-        batch = [[{"role": "user", "content": prompt}] for prompt in batch]
-        results = openai_batch_completion(batch, model_name=model_name)
-        for result in results:
-            print("Text:", process_text(documents[document_index]["patched_text"]))
-            content = result.message.content.strip()
-            print("Answer:", content)
-            print()
-            print()
-            content = content[content.find("["):content.rfind("]") + 1]
+    progress = tqdm(total=len(batch))
+    async for document_index, result in pool.stream(batch, return_exceptions=True):
+        progress.update(1)
+        if isinstance(result, Exception):
+            print("Error:", result)
+            continue
+        print("Text:", process_text(documents[document_index]["patched_text"]))
+        content = result.strip()
+        print("Answer:", content)
+        print()
+        print()
+        content = content[content.find("["):content.rfind("]") + 1]
+        try:
             categories = json.loads(content)
-            documents[document_index]["categories"] = categories
-            yield documents[document_index]
-            document_index += 1
+        except ValueError:
+            continue
+        documents[document_index]["categories"] = categories
+        yield documents[document_index]
 
 
-def main(
+async def amain(
     documents_path,
     output_path,
     prompt_path,
     model_name,
     sample_rate,
-    seed
+    seed,
+    max_concurrency,
+    requests_per_minute,
+    tokens_per_minute
 ):
     random.seed(seed)
     documents = list(read_jsonl(documents_path, sample_rate))
     with open(prompt_path) as f:
         prompt_template = Template(f.read())
 
+    set_completion_limits(CompletionLimits(
+        max_concurrency=max_concurrency,
+        requests_per_minute=requests_per_minute,
+        tokens_per_minute=tokens_per_minute
+    ))
+    pool = AsyncCompletionPool(model_name=model_name)
     with open(output_path, "a") as w:
-        for doc in annotate_categories(documents, prompt_template, model_name):
+        async for doc in annotate_categories(documents, prompt_template, pool):
             w.write(json.dumps(doc, ensure_ascii=False) + "\n")
 
 
+def main(**kwargs):
+    asyncio.run(amain(**kwargs))
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--documents-path", type=str, required=True)
@@ -74,5 +91,8 @@ if __name__ == "__main__":
     parser.add_argument("--model-name", type=str, default="gpt-4")
     parser.add_argument("--sample-rate", type=float, default=0.001)
     parser.add_argument("--seed", type=int, default=1337)
+    parser.add_argument("--max-concurrency", type=int, default=16)
+    parser.add_argument("--requests-per-minute", type=int, default=None)
+    parser.add_argument("--tokens-per-minute", type=int, default=None)
     args = parser.parse_args()
     main(**vars(args))
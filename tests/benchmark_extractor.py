@@ -0,0 +1,129 @@
+"""Compares PostExtractor with the previous selector-based post parsing.
+
+Usage: python -m tests.benchmark_extractor [--repeats 20]
+"""
+
+import argparse
+import os
+import time
+from datetime import datetime, timezone
+
+from scrapy import Selector
+
+from crawler.extractor import (
+    PostExtractor,
+    html2text_setup,
+    parse_post_url,
+    process_views,
+    to_timestamp,
+)
+
+
+PAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "telegram_pages")
+HISTORY_PATH = "//body/main/div/section[contains(@class, 'tgme_channel_history')]/div/div"
+POST_URL_TEMPLATE = "https://t.me/{}?embed=1"
+
+
+class SelectorExtractor:
+    """CSS selectors and html2text for every post, as the spider did before."""
+
+    def __init__(self):
+        self.html2text = html2text_setup()
+
+    def __call__(self, post_element, post_url):
+        text_path = "div.tgme_widget_message_bubble > div.tgme_widget_message_text"
+        text_alt_path = "div.tgme_widget_message_bubble > div.media_supported_cont > div.tgme_widget_message_text"
+        views_path = "span.tgme_widget_message_views::text"
+        time_path = "time.time::attr(datetime)"
+        images_path = "a.tgme_widget_message_photo_wrap::attr(style)"
+        videos_path = "video.tgme_widget_message_video::attr(src)"
+        reply_path = "a.tgme_widget_message_reply::attr(href)"
+        forward_path = "a.tgme_widget_message_forwarded_from_name::attr(href)"
+
+        item = parse_post_url(post_url)
+        text_element = post_element.css(text_path)
+        text_alt_element = post_element.css(text_alt_path)
+        if not text_element and text_alt_element:
+            text_element = text_alt_element
+        if not text_element:
+            return None
+
+        item["text"] = self._parse_html(text_element.extract_first())
+        item["links"] = text_element.css("a::attr(href)").getall()
+        item["fetch_time"] = int(datetime.now().replace(tzinfo=timezone.utc).timestamp())
+
+        views_element = post_element.css(views_path)
+        if not views_element:
+            return None
+        item["views"] = process_views(views_element.get())
+        item["pub_time"] = to_timestamp(post_element.css(time_path).get())
+
+        item["images"] = []
+        for image_style in post_element.css(images_path):
+            for style in image_style.get().split(";"):
+                style = style.strip()
+                if "background-image" in style:
+                    item["images"].append(style.split("url(")[-1][1:-2])
+        item["videos"] = post_element.css(videos_path).getall()
+
+        reply_element = post_element.css(reply_path)
+        if reply_element:
+            item["reply_to"] = reply_element.get()
+        forward_element = post_element.css(forward_path)
+        if forward_element:
+            item["forward_from"] = forward_element.get()
+        return item
+
+    def _parse_html(self, html):
+        text = self.html2text.handle(html)
+        sentences = [s.strip() for s in text.strip().split("\n") if s.strip()]
+        for i, sentence in enumerate(sentences):
+            if sentence[-1].isalpha():
+                sentences[i] = sentence + "."
+        return "\n".join(sentences)
+
+
+def read_posts():
+    posts = []
+    for file_name in sorted(os.listdir(PAGES_DIR)):
+        with open(os.path.join(PAGES_DIR, file_name)) as r:
+            page = Selector(text=r.read())
+        for post in page.xpath(HISTORY_PATH):
+            post_path = post.xpath("@data-post").get()
+            if post_path:
+                posts.append((post, POST_URL_TEMPLATE.format(post_path)))
+    return posts
+
+
+def run(extractor, posts, repeats):
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        items = [extractor(post, url) for post, url in posts]
+    return items, time.perf_counter() - start_time
+
+
+def main(repeats):
+    posts = read_posts()
+    selector_extractor = SelectorExtractor()
+    post_extractor = PostExtractor()
+
+    old_items, old_time = run(selector_extractor, posts, repeats)
+    new_items, new_time = run(lambda post, url: post_extractor(post.root, url), posts, repeats)
+    for old_item, new_item in zip(old_items, new_items):
+        if old_item and new_item:
+            old_item.pop("fetch_time")
+            new_item.pop("fetch_time")
+        assert old_item == new_item, (old_item, new_item)
+
+    count = len(posts) * repeats
+    print("{} posts, {} items".format(len(posts), sum(item is not None for item in new_items)))
+    print("Selectors and html2text: {:.1f} us per post".format(old_time / count * 1e6))
+    print("PostExtractor: {:.1f} us per post".format(new_time / count * 1e6))
+    print("Speedup: {:.1f}x".format(old_time / new_time))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+    main(**vars(args))
@@ -0,0 +1,40 @@
+from typing import List
+from urllib.parse import parse_qs
+
+import httpx
+
+from nyan.client import MessageId, TelegramClient
+
+
+CLIENT_CONFIG_PATH = "configs/client_config.json"
+
+
+def test_discussion_messages() -> None:
+    client = TelegramClient(CLIENT_CONFIG_PATH)
+    client.discussion_interval = 0.0
+    texts: List[str] = []
+    responses = [
+        httpx.Response(429, json={"ok": False, "parameters": {"retry_after": 0}}),
+        httpx.Response(200, json={"ok": True}),
+        httpx.Response(200, json={"ok": True}),
+    ]
+
+    def handle(request: httpx.Request) -> httpx.Response:
+        params = parse_qs(request.content.decode("utf-8"))
+        assert params["reply_to_message_id"] == ["10"]
+        texts.extend(params["text"])
+        return responses.pop(0)
+
+    def fail(request: httpx.Request) -> httpx.Response:
+        raise AssertionError("Discussion messages use their own connection pool")
+
+    client.client = httpx.Client(transport=httpx.MockTransport(fail))
+    client.discussion_client = httpx.Client(transport=httpx.MockTransport(handle))
+    discussion_message = MessageId(message_id=10, issue="main", from_discussion=True)
+    client.queue_discussion_messages(["first", "second"], discussion_message)
+
+    # Messages without a known discussion message are not sent
+    unknown_message = MessageId(message_id=None, issue="main", from_discussion=True)
+    client.queue_discussion_messages(["third"], unknown_message)
+    client.wait_discussion_messages()
+    assert texts == ["first", "first", "second"]
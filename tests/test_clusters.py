@@ -0,0 +1,343 @@
+from typing import Any, List, Optional
+
+import pytest
+
+from nyan.client import MessageId
+from nyan.clusters import Cluster, Clusters, ClusterStats, EmbeddingIndex
+from nyan.document import Document
+
+
+CURRENT_TS = 1700000000
+OFFSET = 24 * 3600
+
+
+def make_doc(url: str, views: int = 100, embedding: Optional[List[float]] = None) -> Document:
+    return Document(
+        url="https://t.me/channel/{}".format(url),
+        channel_id="channel",
+        channel_title="Channel",
+        post_id=len(url),
+        views=views,
+        pub_time=CURRENT_TS - 3600,
+        fetch_time=CURRENT_TS,
+        text="Text of the post {}".format(url),
+        patched_text="Text of the post {}".format(url),
+        groups={"main": "purple"},
+        issue="main",
+        embedding=embedding or [1.0, 0.0, 0.0],
+    )
+
+
+def make_cluster(
+    urls: List[str], message_id: int, embedding: Optional[List[float]] = None
+) -> Cluster:
+    cluster = Cluster()
+    for url in urls:
+        cluster.add(make_doc(url, embedding=embedding))
+    cluster.messages.append(MessageId(message_id=message_id, issue="main"))
+    cluster.create_time = CURRENT_TS
+    return cluster
+
+
+def get_url(url: str) -> str:
+    return "https://t.me/channel/{}".format(url)
+
+
+def test_remove_clusters_with_shared_url() -> None:
+    clusters = Clusters()
+    cluster_a = make_cluster(["u1", "u2"], message_id=1)
+    cluster_b = make_cluster(["u2", "u3"], message_id=2)
+    clusters.add(cluster_a)
+    clusters.add(cluster_b)
+    assert clusters.url2messages[get_url("u2")]["main"].message_id == 2
+
+    clusters.remove(cluster_b.clid)
+    clusters.remove(cluster_a.clid)
+    assert not clusters.clid2cluster
+    assert not clusters.message2cluster
+    assert not clusters.url2messages
+    assert not clusters.url2positions
+    assert clusters.embedding_indices["main"].size == 0
+
+
+def test_remove_keeps_other_cluster_indices() -> None:
+    clusters = Clusters()
+    cluster_a = make_cluster(["u1", "u2"], message_id=1, embedding=[1.0, 0.0, 0.0])
+    cluster_b = make_cluster(["u2", "u3"], message_id=2, embedding=[0.0, 1.0, 0.0])
+    clusters.add(cluster_a)
+    clusters.add(cluster_b)
+
+    clusters.remove(cluster_a.clid)
+    assert get_url("u1") not in clusters.url2positions
+    assert clusters.url2positions[get_url("u2")] == {cluster_b.clid: 0}
+    assert clusters.url2messages[get_url("u3")]["main"].message_id == 2
+    closest, _ = clusters.find_closest([1.0, 0.0, 0.0], CURRENT_TS, "main")
+    assert closest is cluster_b
+
+
+def test_cluster_stats() -> None:
+    cluster = Cluster()
+    doc = make_doc("u1", views=100)
+    doc.links = ["https://example.com", "https://t.me/other"]
+    doc.groups = {"main": "blue"}
+    cluster.add(doc)
+    doc = make_doc("u2", views=1000)
+    doc.channel_id = "other_channel"
+    doc.pub_time = CURRENT_TS
+    doc.groups = {"main": "blue"}
+    cluster.add(doc)
+    doc = make_doc("u3", views=300)
+    doc.channel_id = "third_channel"
+    doc.links = ["https://example.com"]
+    doc.forward_from = "https://t.me/channel/u1"
+    cluster.add(doc)
+
+    assert cluster.views == 1400
+    assert cluster.debiased_views == 1100
+    assert [d.url for d in cluster.unique_docs] == [get_url("u1"), get_url("u2")]
+    assert cluster.channels == ["channel", "other_channel", "third_channel"]
+    assert cluster.group == "blue"
+    assert cluster.external_links == {"https://example.com": 1}
+    assert cluster.pub_time_percentile == CURRENT_TS - 3600
+    assert cluster.fetch_time == CURRENT_TS
+
+    # Stats are rebuilt after a document is added
+    saved_hash = cluster.hash
+    doc = make_doc("u4", views=200000)
+    doc.fetch_time = CURRENT_TS + 60
+    cluster.add(doc)
+    assert cluster.views == 201400
+    assert cluster.fetch_time == CURRENT_TS + 60
+    assert cluster.hash != saved_hash
+
+
+def test_stats_built_before_invalidate_are_not_saved(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    cluster = make_cluster(["u1"], message_id=1)
+    build = ClusterStats.build
+
+    # Another thread adds a document while the stats are built
+    def build_and_add(docs: List[Document]) -> ClusterStats:
+        stats = build(docs)
+        if len(cluster.docs) == 1:
+            cluster.add(make_doc("u2"))
+        return stats
+
+    monkeypatch.setattr(ClusterStats, "build", staticmethod(build_and_add))
+    assert len(cluster.stats.unique_docs) == 1
+    assert cluster.saved_stats is None
+    assert len(cluster.stats.unique_docs) == 2
+    assert cluster.saved_stats is not None
+
+
+def test_url_indices() -> None:
+    clusters = Clusters()
+    cluster_a = make_cluster(["u1", "u2"], message_id=1)
+    cluster_b = make_cluster(["u3"], message_id=2)
+    clusters.add(cluster_a)
+    clusters.add(cluster_b)
+    assert clusters.url2positions[get_url("u2")] == {cluster_a.clid: 1}
+    assert clusters.url2messages[get_url("u3")]["main"].message_id == 2
+
+    # Documents added to a posted cluster are indexed too
+    cluster_b.add(make_doc("u2"))
+    assert clusters.url2positions[get_url("u2")] == {
+        cluster_a.clid: 1,
+        cluster_b.clid: 1,
+    }
+    assert clusters.url2messages[get_url("u2")]["main"].message_id == 2
+
+
+def test_url2messages_issues() -> None:
+    clusters = Clusters()
+    cluster_a = make_cluster(["u1", "u2"], message_id=1)
+    cluster_a.messages.append(MessageId(message_id=10, issue="tech"))
+    clusters.add(cluster_a)
+    assert {
+        issue: message.message_id
+        for issue, message in clusters.url2messages[get_url("u2")].items()
+    } == {"main": 1, "tech": 10}
+
+    # The last posted cluster of an issue wins
+    cluster_b = make_cluster(["u2"], message_id=2)
+    clusters.add(cluster_b)
+    assert {
+        issue: message.message_id
+        for issue, message in clusters.url2messages[get_url("u2")].items()
+    } == {"main": 2, "tech": 10}
+
+    # The slot goes back to the previous cluster with the url
+    clusters.remove(cluster_b.clid)
+    assert {
+        issue: message.message_id
+        for issue, message in clusters.url2messages[get_url("u2")].items()
+    } == {"main": 1, "tech": 10}
+
+
+def test_find_closest_per_issue() -> None:
+    clusters = Clusters()
+    cluster_a = make_cluster(["u1"], message_id=1, embedding=[1.0, 0.0, 0.0])
+    cluster_b = make_cluster(["u2"], message_id=2, embedding=[0.0, 1.0, 0.0])
+    cluster_b.messages = [MessageId(message_id=2, issue="tech")]
+    clusters.add(cluster_a)
+    clusters.add(cluster_b)
+
+    closest, sim = clusters.find_closest([1.0, 1.0, 0.0], CURRENT_TS, "tech")
+    assert closest is cluster_b
+    assert sim == pytest.approx(0.5 ** 0.5)
+    closest, _ = clusters.find_closest([0.0, 1.0, 0.0], CURRENT_TS, "main")
+    assert closest is cluster_a
+    assert clusters.find_closest([1.0, 0.0, 0.0], CURRENT_TS, "economy") == (None, 0.0)
+
+
+def test_documents_update() -> None:
+    clusters = Clusters()
+    cluster_a = make_cluster(["u1", "u2"], message_id=1)
+    cluster_b = make_cluster(["u2", "u3"], message_id=2)
+    clusters.add(cluster_a)
+    clusters.add(cluster_b)
+    assert cluster_a.clid is not None and cluster_b.clid is not None
+    clusters.reset_changes([cluster_a.clid, cluster_b.clid])
+    clusters.dirty_clids.clear()
+
+    text_doc = make_doc("u1")
+    text_doc.patched_text = "New text"
+    update = clusters.update_documents(
+        [text_doc, make_doc("u2", views=150), make_doc("u3"), make_doc("u4")]
+    )
+    assert update.updates_count == 3
+    assert update.views_deltas == {cluster_a.clid: 50, cluster_b.clid: 50}
+    assert update.changed_clids == {cluster_a.clid, cluster_b.clid}
+    assert update.text_changed_clids == {cluster_a.clid}
+    assert clusters.dirty_clids == update.changed_clids
+    assert cluster_a.docs[0].patched_text == "New text"
+    assert cluster_b.docs[0].views == 150
+
+    # Views are a part of the hash only in steps of 100000
+    assert not cluster_b.changed()
+    cluster_b.add(make_doc("u5", views=200000))
+    assert cluster_b.changed()
+    clusters.reset_changes([cluster_b.clid])
+    assert not cluster_b.changed()
+
+
+def test_embedding_index() -> None:
+    index = EmbeddingIndex(max_age=3600)
+    clusters = []
+    for i in range(20):
+        embedding = [0.0] * 20
+        embedding[i] = float(i + 1)
+        cluster = make_cluster(["u{}".format(i)], message_id=i, embedding=embedding)
+        cluster.clid = i
+        index.add(cluster)
+        clusters.append(cluster)
+    index.add(clusters[0])
+    assert index.size == 20
+
+    query = [0.0] * 20
+    query[7] = 1.0
+    closest, sim = index.find_closest(query, CURRENT_TS)
+    assert closest is clusters[7]
+    assert sim == pytest.approx(1.0)
+
+    index.remove(7)
+    assert index.size == 19
+    closest, sim = index.find_closest(query, CURRENT_TS)
+    assert closest is not clusters[7]
+    assert sim == pytest.approx(0.0)
+    assert index.clids[8] == 7
+
+    # Clusters out of max_age are not found and are dropped eventually
+    query[8] = 1.0
+    assert index.find_closest(query, CURRENT_TS + 3600 * 2) == (None, 0.0)
+    assert index.size == 0
+
+
+@pytest.fixture
+def mongo_clusters(monkeypatch: pytest.MonkeyPatch) -> Any:
+    mongomock = pytest.importorskip("mongomock")
+    collection = mongomock.MongoClient()["nyan"]["clusters"]
+    monkeypatch.setattr(
+        "nyan.clusters.get_clusters_collection", lambda _: collection
+    )
+    clusters = Clusters()
+    clusters.add(make_cluster(["u1", "u2"], message_id=1))
+    clusters.add(make_cluster(["u2", "u3"], message_id=2))
+    clusters.save_to_mongo("mongo_config.json")
+    return collection
+
+
+def load_lazy() -> Clusters:
+    return Clusters.load_from_mongo("mongo_config.json", CURRENT_TS, OFFSET, lazy=True)
+
+
+def test_lazy_load(mongo_clusters: Any) -> None:
+    clusters = load_lazy()
+    assert len(clusters) == 2
+    for cluster in clusters.clid2cluster.values():
+        assert not cluster.is_hydrated
+        assert cluster.docs[0].text is None
+        assert cluster.docs[0].patched_text is not None
+        assert cluster.embedding is not None
+    assert set(clusters.url2positions[get_url("u2")]) == set(clusters.clid2cluster)
+    assert clusters.embedding_indices["main"].size == 2
+
+
+def test_hydrate(mongo_clusters: Any) -> None:
+    clusters = load_lazy()
+    cluster = clusters.clid2cluster[min(clusters.clid2cluster)]
+    clusters.hydrate([cluster])
+    assert cluster.is_hydrated
+    assert [doc.url for doc in cluster.docs] == [get_url("u1"), get_url("u2")]
+    assert cluster.annotation_doc.embedding is not None
+
+    # A removed cluster is not hydrated
+    other_cluster = clusters.clid2cluster[max(clusters.clid2cluster)]
+    clusters.remove(other_cluster.clid)
+    clusters.hydrate([other_cluster])
+    assert not other_cluster.is_hydrated
+
+
+def test_update_documents_hydrates_changed_clusters(mongo_clusters: Any) -> None:
+    clusters = load_lazy()
+    unchanged_update = clusters.update_documents([make_doc("u1")])
+    assert unchanged_update.updates_count == 0
+    assert not any(cl.is_hydrated for cl in clusters.clid2cluster.values())
+
+    update = clusters.update_documents([make_doc("u3", views=150)])
+    clid = max(clusters.clid2cluster)
+    assert update.views_deltas == {clid: 50}
+    assert not update.text_changed_clids
+    assert clusters.clid2cluster[clid].is_hydrated
+    assert not clusters.clid2cluster[min(clusters.clid2cluster)].is_hydrated
+
+
+def test_find_similar_hydrates(mongo_clusters: Any) -> None:
+    clusters = load_lazy()
+    similar_cluster = clusters.find_similar(make_cluster(["u3"], message_id=3), "main")
+    assert similar_cluster is not None
+    assert similar_cluster.clid == max(clusters.clid2cluster)
+    assert similar_cluster.is_hydrated
+
+
+def test_refresh_from_mongo(mongo_clusters: Any) -> None:
+    clusters = load_lazy()
+    clid = max(clusters.clid2cluster)
+
+    # Another process has updated the cluster with the shared url
+    other_clusters = load_lazy()
+    other_clusters.update_documents([make_doc("u2", views=300)])
+    other_clusters.save_to_mongo("mongo_config.json")
+
+    assert clusters.refresh_from_mongo(CURRENT_TS + 1, OFFSET) == 2
+    assert len(clusters) == 2
+    assert clusters.clid2cluster[clid].docs[0].views == 300
+    assert set(clusters.url2positions[get_url("u2")]) == set(clusters.clid2cluster)
+    assert clusters.embedding_indices["main"].size == 2
+
+    # Outdated clusters are dropped
+    assert clusters.refresh_from_mongo(CURRENT_TS + OFFSET + 1, OFFSET) == 0
+    assert not clusters.clid2cluster
+    assert not clusters.url2messages
+    assert not clusters.url2positions
@@ -0,0 +1,125 @@
+from pathlib import Path
+from typing import List
+
+from nyan.clusters import Cluster, Clusters
+from nyan.document import Document
+
+
+def make_doc(index: int) -> Document:
+    return Document(
+        url="https://t.me/channel/{}".format(index),
+        channel_id="channel",
+        channel_title="Channel",
+        post_id=index,
+        views=100,
+        pub_time=1700000000 + index,
+        patched_text="Text of the post {}".format(index),
+        groups={"main": "purple"},
+        issue="main",
+        embedding=[0.1, 0.2, 0.3],
+    )
+
+
+def make_clusters(count: int) -> Clusters:
+    clusters = Clusters()
+    for index in range(count):
+        cluster = Cluster()
+        cluster.add(make_doc(index))
+        clusters.add(cluster)
+    return clusters
+
+
+def read_lines(path: Path) -> List[str]:
+    with open(path) as r:
+        return [line for line in r if line.strip()]
+
+
+def get_views(clusters: Clusters) -> List[int]:
+    return [
+        cluster.docs[0].views for _, cluster in sorted(clusters.clid2cluster.items())
+    ]
+
+
+def test_journal_save_and_load(tmp_path: Path) -> None:
+    path = tmp_path / "clusters.jsonl"
+    clusters = make_clusters(3)
+    clusters.save(str(path))
+    assert len(read_lines(path)) == 3
+
+    # Only changed clusters are appended
+    clid = min(clusters.clid2cluster)
+    doc = make_doc(0)
+    doc.views = 200
+    clusters.update_documents([doc])
+    clusters.save(str(path))
+    assert len(read_lines(path)) == 4
+    clusters.save(str(path))
+    assert len(read_lines(path)) == 4
+
+    loaded = Clusters.load(str(path))
+    assert sorted(loaded.clid2cluster) == sorted(clusters.clid2cluster)
+    assert loaded.clid2cluster[clid].docs[0].views == 200
+    assert get_views(loaded) == get_views(clusters)
+    assert loaded.journal_path == str(path)
+    assert loaded.journal_size == 4
+    assert not loaded.dirty_clids
+
+
+def test_journal_compaction(tmp_path: Path) -> None:
+    path = tmp_path / "clusters.jsonl"
+    clusters = make_clusters(2)
+    clusters.compaction_ratio = 2
+    clusters.save(str(path))
+
+    for views in range(101, 104):
+        doc = make_doc(0)
+        doc.views = views
+        clusters.update_documents([doc])
+        clusters.save(str(path))
+    clusters.wait_compaction()
+
+    assert clusters.compaction_thread is None
+    assert not (tmp_path / "clusters.jsonl.compact").exists()
+    assert len(read_lines(path)) == 2
+    assert clusters.journal_size == 2
+    assert get_views(Clusters.load(str(path))) == get_views(clusters)
+
+
+def test_journal_compaction_keeps_buffered_records(tmp_path: Path) -> None:
+    path = tmp_path / "clusters.jsonl"
+    clusters = make_clusters(2)
+    clusters.save(str(path))
+
+    # A record appended while the snapshot is written is kept after the move
+    snapshot = clusters._serialize_all()
+    clusters.compaction_buffer = []
+    doc = make_doc(1)
+    doc.views = 300
+    clusters.update_documents([doc])
+    clusters.save(str(path))
+    clusters._compact(str(path), snapshot)
+
+    assert clusters.compaction_buffer is None
+    assert len(read_lines(path)) == 3
+    assert clusters.journal_size == 3
+    assert get_views(Clusters.load(str(path))) == [100, 300]
+
+
+def test_journal_torn_tail(tmp_path: Path) -> None:
+    path = tmp_path / "clusters.jsonl"
+    clusters = make_clusters(3)
+    clusters.save(str(path))
+    with open(path, "a") as w:
+        w.write(clusters.clid2cluster[min(clusters.clid2cluster)].serialize()[:50])
+
+    loaded = Clusters.load(str(path))
+    assert len(loaded.clid2cluster) == 3
+    assert loaded.journal_path is None
+
+    # The broken record is not appended to, the journal is rewritten instead
+    loaded.save(str(path))
+    lines = read_lines(path)
+    assert len(lines) == 3
+    assert all(line.endswith("\n") for line in lines)
+    assert loaded.journal_path == str(path)
+    assert len(Clusters.load(str(path)).clid2cluster) == 3
@@ -0,0 +1,94 @@
+import json
+from pathlib import Path
+from typing import Any, Dict, List
+
+from nyan.document import DocumentSegments
+
+
+CURRENT_TS = 1700100000
+OFFSET = 86400
+
+
+def make_record(post_id: int, pub_time: int, views: int = 100) -> Dict[str, Any]:
+    return {
+        "url": "https://t.me/channel/{}".format(post_id),
+        "channel_id": "channel",
+        "post_id": post_id,
+        "views": views,
+        "pub_time": pub_time,
+        "text": "Text of the post {}".format(post_id),
+    }
+
+
+def write_records(path: Path, records: List[Dict[str, Any]], mode: str = "a") -> None:
+    with open(path, mode) as w:
+        for record in records:
+            w.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def read_views(segments: DocumentSegments) -> Dict[int, int]:
+    docs = segments.read(CURRENT_TS, OFFSET)
+    return {doc.post_id: doc.views for doc in docs}
+
+
+def test_segments_offsets(tmp_path: Path) -> None:
+    path = tmp_path / "00000000.jsonl"
+    write_records(path, [make_record(1, CURRENT_TS), make_record(2, CURRENT_TS)])
+    segments = DocumentSegments(str(tmp_path))
+    assert read_views(segments) == {1: 100, 2: 100}
+    assert segments.offsets["00000000.jsonl"] == path.stat().st_size
+
+    # Only appended lines are parsed, the last record of a url wins
+    write_records(path, [make_record(2, CURRENT_TS, views=200)])
+    write_records(tmp_path / "00000001.jsonl", [make_record(3, CURRENT_TS)])
+    assert read_views(segments) == {1: 100, 2: 200, 3: 100}
+    assert segments.offsets["00000000.jsonl"] == path.stat().st_size
+
+
+def test_segments_partial_line(tmp_path: Path) -> None:
+    path = tmp_path / "00000000.jsonl"
+    write_records(path, [make_record(1, CURRENT_TS)])
+    line = json.dumps(make_record(2, CURRENT_TS))
+    with open(path, "a") as w:
+        w.write(line[:20])
+
+    # A line being written is read after it is finished
+    segments = DocumentSegments(str(tmp_path))
+    assert read_views(segments) == {1: 100}
+    with open(path, "a") as w:
+        w.write(line[20:] + "\n")
+    assert read_views(segments) == {1: 100, 2: 100}
+
+
+def test_segments_truncation(tmp_path: Path) -> None:
+    path = tmp_path / "00000000.jsonl"
+    write_records(path, [make_record(i, CURRENT_TS) for i in range(3)])
+    segments = DocumentSegments(str(tmp_path))
+    assert len(read_views(segments)) == 3
+
+    # A file that shrank is read from the start
+    write_records(path, [make_record(1, CURRENT_TS, views=300)], mode="w")
+    assert read_views(segments) == {0: 100, 1: 300, 2: 100}
+    assert segments.offsets["00000000.jsonl"] == path.stat().st_size
+
+    (tmp_path / "00000000.jsonl").unlink()
+    write_records(tmp_path / "00000001.jsonl", [make_record(4, CURRENT_TS)])
+    read_views(segments)
+    assert list(segments.offsets) == ["00000001.jsonl"]
+
+
+def test_segments_retirement(tmp_path: Path) -> None:
+    old_time = CURRENT_TS - OFFSET - 1
+    write_records(tmp_path / "00000000.jsonl", [make_record(1, old_time)])
+    write_records(
+        tmp_path / "00000001.jsonl",
+        [make_record(2, old_time), make_record(3, CURRENT_TS)],
+    )
+    write_records(tmp_path / "00000002.jsonl", [make_record(4, old_time)])
+
+    # The last segment is kept, it can still be written to
+    segments = DocumentSegments(str(tmp_path))
+    assert read_views(segments) == {3: 100}
+    file_names = sorted(p.name for p in tmp_path.iterdir())
+    assert file_names == ["00000001.jsonl", "00000002.jsonl"]
+    assert sorted(segments.offsets) == file_names
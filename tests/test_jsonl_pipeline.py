@@ -0,0 +1,82 @@
+import dbm
+from pathlib import Path
+from typing import Any, Dict, List
+
+from crawler.pipelines import JsonlPipeline
+
+
+CURRENT_TS = 1700000000
+
+
+class Spider:
+    def __init__(self, until_ts: int) -> None:
+        self.until_ts = until_ts
+        self.confirmed_urls: List[str] = []
+
+    def confirm_items(self, items: List[Dict[str, Any]]) -> None:
+        self.confirmed_urls.extend(item["url"] for item in items)
+
+
+def make_item(post_id: int, pub_time: int, views: int = 100) -> Dict[str, Any]:
+    return {
+        "url": "https://t.me/channel/{}".format(post_id),
+        "text": "Text of the post {}".format(post_id),
+        "pub_time": pub_time,
+        "views": views,
+        "fetch_time": CURRENT_TS,
+    }
+
+
+def read_lines(dir_path: Path) -> List[str]:
+    lines = []
+    for path in sorted(dir_path.glob("*.jsonl")):
+        with open(path) as r:
+            lines.extend(line for line in r if line.strip())
+    return lines
+
+
+def read_index_urls(dir_path: Path) -> List[str]:
+    with dbm.open(str(dir_path / "index"), "r") as index:
+        return sorted(key.decode("utf-8") for key in index.keys())
+
+
+def test_jsonl_pipeline_dedup(tmp_path: Path) -> None:
+    spider = Spider(until_ts=CURRENT_TS - 3600)
+    pipeline = JsonlPipeline(output_dir=str(tmp_path), segment_max_items=2)
+    pipeline.open_spider(spider)
+    pipeline.process_item(make_item(1, CURRENT_TS), spider)
+    item = make_item(1, CURRENT_TS)
+    item["fetch_time"] = CURRENT_TS + 60
+    pipeline.process_item(item, spider)
+    pipeline.process_item(make_item(1, CURRENT_TS, views=200), spider)
+    pipeline.process_item(make_item(2, CURRENT_TS), spider)
+    pipeline.close_spider(spider)
+
+    assert len(read_lines(tmp_path)) == 3
+    assert len(list(tmp_path.glob("*.jsonl"))) == 2
+    assert len(spider.confirmed_urls) == 4
+
+
+def test_jsonl_pipeline_index_pruning(tmp_path: Path) -> None:
+    spider = Spider(until_ts=CURRENT_TS - 3600)
+    pipeline = JsonlPipeline(output_dir=str(tmp_path), segment_max_items=2)
+    pipeline.open_spider(spider)
+    pipeline.process_item(make_item(1, CURRENT_TS - 7200), spider)
+    pipeline.process_item(make_item(2, CURRENT_TS), spider)
+    pipeline.process_item(make_item(3, CURRENT_TS), spider)
+
+    # Old posts are dropped from the index when a segment is finished
+    assert "https://t.me/channel/1" not in {
+        key.decode("utf-8") for key in pipeline.index.keys()
+    }
+    pipeline.close_spider(spider)
+    assert read_index_urls(tmp_path) == [
+        "https://t.me/channel/2",
+        "https://t.me/channel/3",
+    ]
+
+    # The window moves between runs
+    spider = Spider(until_ts=CURRENT_TS + 1)
+    pipeline.open_spider(spider)
+    pipeline.close_spider(spider)
+    assert read_index_urls(tmp_path) == []
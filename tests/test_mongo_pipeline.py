@@ -0,0 +1,94 @@
+from concurrent.futures import Future
+from typing import Any, Dict, List
+
+from pymongo import ReplaceOne
+
+from crawler.pipelines import MongoPipeline
+
+
+class Collection:
+    def __init__(self, docs: List[Dict[str, Any]]) -> None:
+        self.docs = {doc["url"]: doc for doc in docs}
+        self.find_calls = 0
+        self.batches: List[List[ReplaceOne]] = []
+
+    def find(self, query: Dict[str, Any]) -> List[Dict[str, Any]]:
+        self.find_calls += 1
+        urls = query["url"]["$in"]
+        return [self.docs[url] for url in urls if url in self.docs]
+
+    def bulk_write(self, requests: List[ReplaceOne], ordered: bool = True) -> None:
+        self.batches.append(requests)
+
+
+class Spider:
+    def __init__(self) -> None:
+        self.confirmed_urls: List[str] = []
+
+    def confirm_items(self, items: List[Dict[str, Any]]) -> None:
+        self.confirmed_urls.extend(item["url"] for item in items)
+
+
+def make_item(post_id: int, views: int = 100, fetch_time: int = 0) -> Dict[str, Any]:
+    return {
+        "url": "https://t.me/channel/{}".format(post_id),
+        "text": "Text of the post {}".format(post_id),
+        "pub_time": 1700000000,
+        "views": views,
+        "fetch_time": fetch_time,
+    }
+
+
+def make_pipeline(collection: Collection, spider: Spider) -> MongoPipeline:
+    pipeline = MongoPipeline("mongo_config.json", buffer_size=10)
+    pipeline.collection = collection
+    pipeline.spider = spider
+    pipeline.buffer = []
+    pipeline.retry_time = 0.0
+    pipeline.digests = dict()
+    return pipeline
+
+
+def test_mongo_pipeline_write() -> None:
+    stored_doc = dict(make_item(1, fetch_time=1), _id="id")
+    collection = Collection([stored_doc])
+    pipeline = make_pipeline(collection, Spider())
+
+    # Documents that differ only by fetch time are not written
+    items = [make_item(1, fetch_time=2), make_item(2, views=1), make_item(2, views=2)]
+    written_items = pipeline.write(items)
+    assert written_items == [items[0], items[2]]
+    assert collection.batches == [
+        [ReplaceOne({"url": items[2]["url"]}, items[2], upsert=True)]
+    ]
+
+    # Digests of written documents are kept
+    assert pipeline.write([make_item(1), make_item(2, views=2)])
+    assert collection.find_calls == 1
+    assert len(collection.batches) == 1
+    pipeline.write([make_item(1, views=200)])
+    assert collection.find_calls == 1
+    assert len(collection.batches) == 2
+
+
+def test_mongo_pipeline_retry() -> None:
+    spider = Spider()
+    pipeline = make_pipeline(Collection([]), spider)
+    pipeline.process_item(make_item(3), spider)
+    assert len(pipeline.buffer) == 1
+
+    # Failed items go back before newer ones and are not confirmed
+    items = [make_item(1), make_item(2)]
+    future: "Future[List[Dict[str, Any]]]" = Future()
+    future.set_exception(RuntimeError("Mongo is down"))
+    pipeline.on_written(items, future)
+    assert [item["url"] for item in pipeline.buffer] == [
+        make_item(i)["url"] for i in (1, 2, 3)
+    ]
+    assert pipeline.retry_time > 0.0
+    assert not spider.confirmed_urls
+
+    future = Future()
+    future.set_result(items)
+    pipeline.on_written(items, future)
+    assert spider.confirmed_urls == [item["url"] for item in items]
@@ -0,0 +1,97 @@
+import json
+from pathlib import Path
+from typing import Any, Dict, List
+
+from nyan.clusters import Cluster
+from nyan.document import Document
+from nyan.ranker import ClusterFeatures, Ranker
+
+
+CURRENT_TS = 1700000000
+
+
+def make_cluster(
+    index: int,
+    channels_count: int = 3,
+    views: int = 3600,
+    age_minutes: int = 60,
+    language: str = "ru",
+) -> Cluster:
+    cluster = Cluster()
+    for channel_index in range(channels_count):
+        cluster.add(
+            Document(
+                url="https://t.me/channel{}/{}".format(channel_index, index),
+                channel_id="channel{}".format(channel_index),
+                channel_title="Channel",
+                post_id=index,
+                views=views,
+                pub_time=CURRENT_TS - age_minutes * 60,
+                fetch_time=CURRENT_TS,
+                text="Text of the post {}".format(index),
+                patched_text="Text of the post {}".format(index),
+                language=language,
+                groups={"main": "purple"},
+                issue="tech",
+                embedding=[1.0, 0.0, 0.0],
+            )
+        )
+    cluster.clid = index
+    return cluster
+
+
+def make_ranker(tmp_path: Path, **issue_config: Any) -> Ranker:
+    config: Dict[str, Any] = {
+        "issue_name": "tech",
+        "min_channels": 2,
+        "max_age_minutes": 120,
+        "views_percentile": 50,
+        "higher_views_percentile": 90,
+        "higher_trigger_age_minutes": 0,
+    }
+    config.update(issue_config)
+    config_path = tmp_path / "ranker_config.json"
+    with open(config_path, "w") as w:
+        json.dump({"issues": [config]}, w)
+    return Ranker(str(config_path))
+
+
+def get_clids(clusters: List[Cluster]) -> List[int]:
+    return [cluster.clid for cluster in clusters if cluster.clid is not None]
+
+
+def test_cluster_features() -> None:
+    clusters = [make_cluster(0), make_cluster(1, channels_count=1, language="en")]
+    features = ClusterFeatures.build(clusters, ["main", "tech", "economy"])
+    assert features.channels_count.tolist() == [3, 1]
+    assert features.has_ru.tolist() == [True, False]
+    assert features.age.tolist() == [3600, 3600]
+    assert features.views_per_hour.tolist() == [10800, 3600]
+    assert features.issues.tolist() == [0b11, 0b11]
+
+
+def test_ranker_filters(tmp_path: Path) -> None:
+    clusters = [
+        make_cluster(0, channels_count=1),
+        make_cluster(1, age_minutes=180),
+        make_cluster(2, language="en"),
+    ]
+    clusters += [make_cluster(i, views=i * 100) for i in range(3, 9)]
+    ranked_clusters = make_ranker(tmp_path)(clusters)
+    assert list(ranked_clusters) == ["tech"]
+    assert get_clids(ranked_clusters["tech"]) == [6, 7, 8]
+    assert not any(cluster.is_important for cluster in clusters)
+
+
+def test_ranker_few_clusters(tmp_path: Path) -> None:
+    clusters = [make_cluster(0, views=100), make_cluster(1, views=10000)]
+    ranked_clusters = make_ranker(tmp_path)(clusters)
+    assert get_clids(ranked_clusters["tech"]) == [0, 1]
+
+
+def test_ranker_important(tmp_path: Path) -> None:
+    clusters = [make_cluster(i, views=i * 100) for i in range(1, 7)]
+    ranker = make_ranker(tmp_path, higher_trigger_age_minutes=120)
+    ranked_clusters = ranker(clusters)
+    assert get_clids(ranked_clusters["tech"]) == [6]
+    assert [cluster.is_important for cluster in clusters] == [False] * 5 + [True]
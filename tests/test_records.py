@@ -0,0 +1,130 @@
+from pathlib import Path
+from typing import Any, List
+
+import pytest
+
+from nyan.diff import DiffCache, DiffRecord, FileDiffCache, MongoDiffCache
+from nyan.discussions import DiscussionRecord, FileDiscussionsStore
+from nyan.media import FileMediaCache, MediaRecord, MongoMediaCache
+
+
+CURRENT_TS = 1700000000
+
+
+def read_lines(path: Path) -> List[str]:
+    with open(path) as r:
+        return [line for line in r if line.strip()]
+
+
+def test_diff_cache_in_memory() -> None:
+    cache = DiffCache()
+    cache.add(DiffRecord(key="a", diff=[{"text": "new"}], create_time=CURRENT_TS))
+    assert "a" in cache
+    assert cache.get("a") == [{"text": "new"}]
+    assert cache.get("b") is None
+    assert cache.load() == []
+
+
+def test_file_store_prune(tmp_path: Path) -> None:
+    path = tmp_path / "diffs.jsonl"
+    cache = FileDiffCache(str(path))
+    cache.add(DiffRecord(key="old", create_time=CURRENT_TS - 100))
+    cache.add(DiffRecord(key="new", create_time=CURRENT_TS))
+    assert len(read_lines(path)) == 2
+
+    assert cache.prune(CURRENT_TS - 50) == 1
+    assert "old" not in cache
+    assert len(read_lines(path)) == 1
+    assert cache.prune(CURRENT_TS - 50) == 0
+
+    loaded = FileDiffCache(str(path))
+    assert [r.key for r in loaded.load()] == ["new"]
+
+
+def test_file_store_load_compaction(tmp_path: Path) -> None:
+    path = tmp_path / "media.jsonl"
+    cache = FileMediaCache(str(path))
+    cache.add(MediaRecord("bot", "url1", "file1", create_time=CURRENT_TS - 100))
+    cache.add(MediaRecord("bot", "url2", "file2", create_time=CURRENT_TS))
+    cache.add(MediaRecord("bot", "url2", "file2", create_time=CURRENT_TS))
+    cache.add(MediaRecord("bot", "url2", "file3", create_time=CURRENT_TS))
+    assert len(read_lines(path)) == 3
+
+    # Old and overwritten records are dropped from the file on load
+    loaded = FileMediaCache(str(path))
+    assert len(loaded.load(CURRENT_TS - 50)) == 1
+    assert loaded.get("bot", "url2") == "file3"
+    assert loaded.get("bot", "url1") is None
+    assert len(read_lines(path)) == 1
+
+
+def test_file_store_remove(tmp_path: Path) -> None:
+    path = tmp_path / "media.jsonl"
+    cache = FileMediaCache(str(path))
+    cache.add(MediaRecord("bot", "url1", "file1", create_time=CURRENT_TS))
+    cache.add(MediaRecord("bot", "url2", "file2", create_time=CURRENT_TS))
+    cache.remove("bot", "url1")
+    cache.remove("bot", "url3")
+    assert cache.get("bot", "url1") is None
+
+    loaded = FileMediaCache(str(path))
+    loaded.load()
+    assert loaded.get("bot", "url1") is None
+    assert loaded.get("bot", "url2") == "file2"
+
+
+def test_file_discussions_store(tmp_path: Path) -> None:
+    path = tmp_path / "discussions.jsonl"
+    store = FileDiscussionsStore(str(path))
+    store.add(DiscussionRecord("main", 1, 10, create_time=CURRENT_TS))
+    store.add(DiscussionRecord("main", 2, 20, create_time=CURRENT_TS))
+    assert not path.exists()
+    assert store.flush() == 2
+    assert store.flush() == 0
+    assert ("main", 1) in store
+
+    loaded = FileDiscussionsStore(str(path))
+    records = loaded.load()
+    assert sorted(r.discussion_message_id for r in records) == [10, 20]
+
+
+@pytest.fixture
+def mongo_db(monkeypatch: pytest.MonkeyPatch) -> Any:
+    mongomock = pytest.importorskip("mongomock")
+    db = mongomock.MongoClient()["nyan"]
+    monkeypatch.setattr("nyan.diff.get_diffs_collection", lambda _: db["diffs"])
+    monkeypatch.setattr("nyan.media.get_media_collection", lambda _: db["media"])
+    return db
+
+
+def test_mongo_store_prune(mongo_db: Any) -> None:
+    collection = mongo_db["diffs"]
+    cache = MongoDiffCache("mongo_config.json")
+    assert "key_1" in collection.index_information()
+    cache.add(DiffRecord(key="old", create_time=CURRENT_TS - 100))
+    cache.add(DiffRecord(key="new", create_time=CURRENT_TS))
+    cache.add(DiffRecord(key="new", diff=[{"text": "new"}], create_time=CURRENT_TS))
+    assert collection.count_documents({}) == 2
+
+    # Records loaded by no process are pruned too
+    collection.insert_one({"key": "older", "diff": [], "create_time": 0})
+    assert cache.prune(CURRENT_TS - 50) == 1
+    assert [d["key"] for d in collection.find()] == ["new"]
+
+    loaded = MongoDiffCache("mongo_config.json")
+    assert len(loaded.load()) == 1
+    assert loaded.get("new") == [{"text": "new"}]
+
+
+def test_mongo_store_remove(mongo_db: Any) -> None:
+    collection = mongo_db["media"]
+    cache = MongoMediaCache("mongo_config.json")
+    cache.add(MediaRecord("bot", "url1", "file1", create_time=CURRENT_TS))
+    cache.add(MediaRecord("bot", "url2", "file2", create_time=CURRENT_TS))
+    cache.remove("bot", "url1")
+    assert [d["url"] for d in collection.find()] == ["url2"]
+
+    loaded = MongoMediaCache("mongo_config.json")
+    loaded.load()
+    assert loaded.get("bot", "url1") is None
+    assert loaded.get("bot", "url2") == "file2"
@@ -0,0 +1,94 @@
+from typing import List
+
+import pytest
+
+from nyan.clusters import Cluster
+from nyan.document import Document
+from nyan.renderer import Renderer
+
+
+CURRENT_TS = 1700000000
+CHANNEL_IDS = ("rian_ru", "rbc_news", "mash")
+
+
+def make_doc(index: int, views: int = 1000) -> Document:
+    channel_id = CHANNEL_IDS[index % len(CHANNEL_IDS)]
+    return Document(
+        url="https://t.me/{}/{}".format(channel_id, index),
+        channel_id=channel_id,
+        channel_title="Channel {}".format(index),
+        post_id=index,
+        views=views,
+        pub_time=CURRENT_TS - 600,
+        fetch_time=CURRENT_TS,
+        text="Text of the post {}".format(index),
+        patched_text="Text of the post {}".format(index),
+        language="ru",
+        groups={"main": "purple"},
+        embedding=[1.0, 0.0, 0.0],
+    )
+
+
+def make_cluster(docs: List[Document]) -> Cluster:
+    cluster = Cluster()
+    for doc in docs:
+        cluster.add(doc)
+    return cluster
+
+
+def test_render_cluster_cache(
+    renderer: Renderer, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    render_calls: List[Cluster] = []
+    render = renderer._render_cluster
+
+    def count_render(cluster: Cluster, issue_name: str) -> str:
+        render_calls.append(cluster)
+        return render(cluster, issue_name)
+
+    monkeypatch.setattr(renderer, "_render_cluster", count_render)
+    cluster = make_cluster([make_doc(0), make_doc(1)])
+    text = renderer.render_cluster(cluster, "main")
+    assert renderer.render_cluster(cluster, "main") == text
+    assert renderer.render_cluster(make_cluster([make_doc(0), make_doc(1)]), "main") == text
+    assert len(render_calls) == 1
+
+    # Views are rendered rounded
+    cluster.docs[0].views = 1010
+    cluster.invalidate()
+    assert renderer.render_cluster(cluster, "main") == text
+    assert len(render_calls) == 1
+    cluster.docs[0].views = 1500
+    cluster.invalidate()
+    assert renderer.render_cluster(cluster, "main") != text
+    assert len(render_calls) == 2
+
+    cluster.add(make_doc(2))
+    renderer.render_cluster(cluster, "main")
+    cluster.saved_diff = [{"text": "New details.", "channels": "Channel"}]
+    renderer.render_cluster(cluster, "main")
+    renderer.render_cluster(cluster, "tech")
+    assert len(render_calls) == 5
+
+
+def test_render_cluster_cache_size(renderer: Renderer) -> None:
+    renderer.cache_size = 2
+    clusters = [make_cluster([make_doc(i)]) for i in range(3)]
+    for cluster in clusters:
+        renderer.render_cluster(cluster, "main")
+    assert len(renderer.cache) == 2
+    assert renderer.calc_fingerprint(clusters[0], "main") not in renderer.cache
+    assert renderer.calc_fingerprint(clusters[2], "main") in renderer.cache
+
+
+def test_render_discussion_messages(renderer: Renderer) -> None:
+    docs = [make_doc(i) for i in range(5)]
+    lines = [renderer.render_discussion_message(doc) for doc in docs]
+    renderer.discussion_max_length = max(len(line) for line in lines) * 2 + 1
+    messages = renderer.render_discussion_messages(docs)
+    assert messages == [
+        "\n".join(lines[:2]),
+        "\n".join(lines[2:4]),
+        lines[4],
+    ]
+    assert renderer.render_discussion_messages([]) == []
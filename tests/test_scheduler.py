@@ -0,0 +1,55 @@
+from crawler.scheduler import ChannelScheduler
+
+
+CURRENT_TS = 1700000000
+
+
+def test_scheduler_pop_due() -> None:
+    scheduler = ChannelScheduler(requests_per_minute=2)
+    scheduler.add("a", CURRENT_TS - 10)
+    scheduler.add("b", CURRENT_TS - 20)
+    scheduler.add("c", CURRENT_TS - 5)
+    scheduler.add("d", CURRENT_TS + 10)
+
+    # Rescheduled channels are popped at their last due time only
+    scheduler.schedule("a", CURRENT_TS + 5)
+    assert scheduler.pop_due(CURRENT_TS) == ["b", "c"]
+    assert not scheduler.is_scheduled("b")
+    assert scheduler.is_scheduled("a")
+
+    # Requests are limited per minute
+    scheduler.record_request(CURRENT_TS)
+    scheduler.record_request(CURRENT_TS)
+    assert scheduler.pop_due(CURRENT_TS + 10) == []
+    assert scheduler.pop_due(CURRENT_TS + 60) == ["a", "d"]
+
+
+def test_scheduler_intervals() -> None:
+    scheduler = ChannelScheduler(
+        min_interval=60, max_interval=3600, interest_weight=4.0, rate_smoothing=0.5
+    )
+    scheduler.add("a", CURRENT_TS, min_interval=120)
+    assert scheduler.get_interval("a") == 120
+
+    # 10 posts per hour, one post per fetch
+    scheduler.update("a", max_post_id=100, fetch_time=CURRENT_TS)
+    scheduler.update("a", max_post_id=110, fetch_time=CURRENT_TS + 3600)
+    assert scheduler.stats["a"]["rate"] == 10.0
+    assert scheduler.get_interval("a") == 360
+    assert scheduler.due_times["a"] == CURRENT_TS + 3600 + 360
+
+    # Rates are smoothed
+    scheduler.update("a", max_post_id=140, fetch_time=CURRENT_TS + 7200)
+    assert scheduler.stats["a"]["rate"] == 20.0
+    assert scheduler.get_interval("a") == 180
+
+    # Interesting channels are fetched more often, but not too often
+    scheduler.set_interest({"a": 0.25})
+    assert scheduler.get_interval("a") == 120
+    scheduler.set_interest({})
+    assert scheduler.get_interval("a") == 180
+
+    # Silent channels are fetched rarely
+    scheduler.update("b", max_post_id=10, fetch_time=CURRENT_TS)
+    scheduler.update("b", max_post_id=10, fetch_time=CURRENT_TS + 600)
+    assert scheduler.get_interval("b") == 3600
@@ -0,0 +1,56 @@
+from typing import List
+
+import numpy as np
+
+from nyan.document import Document
+from nyan.title import calc_cosine_distances, choose_title
+
+
+CURRENT_TS = 1700000000
+
+
+def make_doc(index: int, embedding: List[float], language: str = "ru") -> Document:
+    return Document(
+        url="https://t.me/channel/{}".format(index),
+        channel_id="channel",
+        channel_title="Channel",
+        post_id=index,
+        views=100,
+        pub_time=CURRENT_TS - 600,
+        fetch_time=CURRENT_TS,
+        text="Text of the post {}".format(index),
+        patched_text="Text of the post {}".format(index),
+        language=language,
+        groups={"main": "purple"},
+        embedding=embedding,
+    )
+
+
+def test_cosine_distances() -> None:
+    docs = [make_doc(0, [1.0, 0.0]), make_doc(1, [0.0, 2.0]), make_doc(2, [1.0, 1.0])]
+    distances = calc_cosine_distances(docs)
+    assert distances.shape == (3, 3)
+    assert np.allclose(np.diag(distances), 0.0)
+    assert distances[0, 1] == 1.0
+    assert np.isclose(distances[0, 2], 1.0 - 0.5 ** 0.5)
+
+
+def test_choose_central_title() -> None:
+    docs = [make_doc(0, [1.0, 0.0]), make_doc(1, [0.0, 1.0]), make_doc(2, [1.0, 1.0])]
+    assert choose_title(docs, ["main"]) is docs[2]
+
+    # The hard filter of languages goes first
+    docs[2].language = "en"
+    assert choose_title(docs, ["main"]) is docs[0]
+
+
+def test_choose_title_with_distances() -> None:
+    docs = [make_doc(i, [1.0, 0.0]) for i in range(3)]
+    # Ties are broken by the order of documents
+    assert choose_title(docs, ["main"]) is docs[0]
+
+    distances = np.array([[0.0, 0.5, 0.5], [0.5, 0.0, 0.1], [0.5, 0.1, 0.0]])
+    assert choose_title(docs, ["main"], distances) is docs[1]
+
+    # Distances saved for other documents are not used
+    assert choose_title(docs, ["main"], distances[:2, :2]) is docs[0]